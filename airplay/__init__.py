@@ -1,2 +1,15 @@
+import sys
+
 from .airplay import AirPlay  # NOQA
+from .events import EventHub  # NOQA
+from .group import DeviceGroup  # NOQA
+from .sync import SyncedPlayback  # NOQA
+from .playback import PlaybackState  # NOQA
+from .models import PlaybackEvent, PlaybackInfo  # NOQA
+from .pipeline import Pipeline  # NOQA
 from .http_server import RangeHTTPServer  # NOQA
+from .media_server import MediaServer  # NOQA
+
+# asyncio support needs async generators
+if sys.version_info >= (3, 6):
+    from .aio import AsyncAirPlay  # NOQA
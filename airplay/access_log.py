@@ -0,0 +1,109 @@
+import json
+import threading
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+
+class AccessLog(object):
+    """Write one JSON object per line for each request handled by a media server
+
+    Requests are handed to a background thread which encodes and writes them in
+    batches, so logging never blocks a transfer.  If the writer falls too far
+    behind, or a write fails, records are dropped (and counted) rather than
+    queued without limit.
+    """
+
+    # Seconds close() waits for the writer to finish
+    close_timeout = 5
+
+    def __init__(self, path, max_queue=10000):
+        """Create an access log and start its writer
+
+        Args:
+            path(str|file):     A path to append to, or an open file object
+            max_queue(int):     Optional. The most records waiting to be written
+        """
+        if hasattr(path, 'write'):
+            self._fh = path
+            self._owned = False
+        else:
+            self._fh = open(path, 'a')
+            self._owned = True
+
+        self.written = 0
+        self.dropped = 0
+
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name='airplay-access-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def log(self, record):
+        """Queue a record to be written
+
+        Args:
+            record(dict):   The record, it must be serializable by json.dumps()
+        """
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        """Returns:
+            dict:   The number of records written, dropped and waiting to be written
+        """
+        return {
+            'written': self.written,
+            'dropped': self.dropped,
+            'queued': self._queue.qsize(),
+        }
+
+    def close(self):
+        """Write any queued records and stop the writer"""
+        if self._thread is None:
+            return
+
+        # a writer that has died, or is stuck writing, won't take anything else from the queue
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=self.close_timeout)
+            except queue.Full:
+                pass
+            self._thread.join(self.close_timeout)
+        self._thread = None
+
+        if self._owned:
+            self._fh.close()
+
+    def _run(self):
+        """Write records from the queue until close() is called"""
+        while True:
+            records = [self._queue.get()]
+
+            # take everything else that's waiting, so it goes out in a single write
+            while records[-1] is not None:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            done = records[-1] is None
+            if done:
+                records.pop()
+
+            if records:
+                try:
+                    self._fh.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in records))
+                    self._fh.flush()
+                except (EnvironmentError, ValueError):
+                    # the disk is full, or the file was closed under us, try again with the next batch
+                    self.dropped += len(records)
+                else:
+                    self.written += len(records)
+
+            if done:
+                return
@@ -0,0 +1,344 @@
+import asyncio
+import functools
+
+from .airplay import AirPlay, keepalive
+from .events import matches
+from .media_server import MediaServer
+from .protocol import (
+    BINARY_PLIST, EVENT_RESPONSE, UPGRADE_REQUEST, EventParser, ResponseParser, accept_headers, build_request,
+    decode_response, play_body, playback_info_result, property_body, property_result, property_uri,
+    require_binary_plists, scrub_result
+)
+
+
+class AsyncAirPlay(object):
+    """Control devices supporting the AirPlay server protocol for video with asyncio
+
+    The methods mirror those of AirPlay, but are coroutines.  Requests are built,
+    and responses and events parsed, by the same code as AirPlay (see protocol.py)
+
+        async with AsyncAirPlay('192.0.2.23') as ap:
+            await ap.play('http://192.0.2.114/home_movie.mp4')
+
+            async for event in ap.events():
+                print(event)
+    """
+    RECV_SIZE = AirPlay.RECV_SIZE
+    ACCEPT_BINARY_PLISTS = AirPlay.ACCEPT_BINARY_PLISTS
+    MAX_BACKOFF = AirPlay.MAX_BACKOFF
+
+    _backoff = AirPlay._backoff
+
+    def __init__(self, host, port=7000, name=None, timeout=5, retries=3, backoff=0.5):
+        """Create a client for an AirPlay device on `host`:`port` optionally named `name`
+
+        It isn't connected until connect() is awaited, or it's used with `async with`
+
+        Args:
+            host(string):   Hostname or IP address of the device to connect to
+            port(int):      Port to use when connectiong
+            name(string):   Optional. The name of the device.
+            timeout(int):   Optional. A timeout for connecting and waiting for responses
+            retries(int):   Optional. How many times to try to make the event connection again when it's lost
+            backoff(float): Optional. Seconds to wait before the second attempt to reconnect, doubling
+                            for each one after.  The first is made right away.
+        """
+        self.host = host
+        self.port = port
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self._reader = None
+        self._writer = None
+
+        # responses from the control connection, which may arrive in pieces
+        self._parser = ResponseParser()
+        self._responses = []
+
+        # only one command can be waiting for a response at a time
+        self._lock = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def connect(self):
+        """Connect the control connection
+
+        Raises:
+            ValueError:     Unable to connect to the specified host/port
+        """
+        try:
+            self._reader, self._writer = await self._open()
+        except (OSError, asyncio.TimeoutError) as exc:
+            raise ValueError("Unable to connect to {0}:{1}: {2}".format(self.host, self.port, exc))
+
+        self._parser.reset()
+        self._responses = []
+        self._lock = asyncio.Lock()
+
+    async def close(self):
+        """Close the control connection"""
+        if self._writer is None:
+            return
+
+        writer, self._reader, self._writer = self._writer, None, None
+        writer.close()
+
+        self._parser.reset()
+        self._responses = []
+
+    async def _open(self):
+        """Open a connection to the device, with TCP keepalive turned on"""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        keepalive(writer.get_extra_info('socket'))
+
+        return reader, writer
+
+    async def _command(self, uri, method='GET', body='', **kwargs):
+        """Makes an HTTP request through to an AirPlay server, see AirPlay._command()
+
+        If the command fails, times out or is cancelled, the control connection is closed, as a late
+        response would be returned to the next command.  connect() has to be awaited again to send more.
+
+        Raises:
+            RuntimeError:   connect() hasn't been called
+        """
+        if self._writer is None:
+            raise self._not_connected()
+
+        kwargs['headers'] = accept_headers(method, kwargs.get('headers'), self.ACCEPT_BINARY_PLISTS)
+
+        async with self._lock:
+            # a command we were waiting behind may have failed and closed the connection
+            if self._writer is None:
+                raise self._not_connected()
+
+            try:
+                self._writer.write(build_request(uri, method, body, **kwargs))
+                await self._writer.drain()
+
+                resp = await asyncio.wait_for(self._read_response(), self.timeout)
+            except BaseException:
+                # CancelledError isn't an Exception on newer pythons, but leaves the connection out of step too
+                await self.close()
+                raise
+
+        return decode_response(resp)
+
+    def _not_connected(self):
+        """Returns the error raised by commands sent while not connected"""
+        return RuntimeError('Not connected to {0}:{1}, call connect() first'.format(self.host, self.port))
+
+    async def _read_response(self):
+        """Read the next response from the control connection
+
+        Raises:
+            ConnectionError:        The device closed the connection before the response was complete
+            protocol.ProtocolError: The device sent something we can't parse
+        """
+        while not self._responses:
+            data = await self._reader.read(self.RECV_SIZE)
+            if not data:
+                raise ConnectionError('The AirPlay device closed the connection')
+
+            self._responses.extend(self._parser.feed(data))
+
+        return self._responses.pop(0)
+
+    async def get_property(self, name):
+        """See AirPlay.get_property()"""
+        require_binary_plists()
+
+        return property_result(await self._command(property_uri('getProperty', name)))
+
+    async def set_property(self, name, value):
+        """See AirPlay.set_property()"""
+        return property_result(await self._command(
+            property_uri('setProperty', name), 'PUT', property_body(value), headers={'Content-Type': BINARY_PLIST}
+        ))
+
+    async def server_info(self):
+        """See AirPlay.server_info()"""
+        return await self._command('/server-info')
+
+    async def play(self, url, position=0.0):
+        """See AirPlay.play()"""
+        return await self._command('/play', 'POST', play_body(url, position))
+
+    async def rate(self, rate):
+        """See AirPlay.rate()"""
+        return await self._command('/rate', 'POST', value=float(rate))
+
+    async def stop(self):
+        """See AirPlay.stop()"""
+        return await self._command('/stop', 'POST')
+
+    async def playback_info(self):
+        """See AirPlay.playback_info()"""
+        return playback_info_result(await self._command('/playback-info'))
+
+    async def scrub(self, position=None):
+        """See AirPlay.scrub()"""
+        if position:
+            await self._command('/scrub', 'POST', position=position)
+
+        return scrub_result(await self._command('/scrub'))
+
+    async def serve(self, path, **options):
+        """See AirPlay.serve(), the media server is started and the file registered in an executor
+
+        Returns:
+            str:    An absolute url to the `path` suitable for passing to play()
+
+        Raises:
+            RuntimeError:   connect() hasn't been called
+        """
+        if self._writer is None:
+            raise self._not_connected()
+
+        loop = asyncio.get_event_loop()
+
+        server = await loop.run_in_executor(None, functools.partial(MediaServer.shared, **options))
+        url_path = await loop.run_in_executor(None, server.register, path, self.host)
+
+        return 'http://{0}:{1}{2}'.format(
+            self._writer.get_extra_info('sockname')[0],
+            server.server_address[1],
+            url_path
+        )
+
+    async def events(self, categories=('video',), states=None):
+        """An asynchronous iterator of the events sent by the device
+
+        A second connection is opened to the device and upgraded to Reverse HTTP.
+        If it's lost it's made again, like AirPlay.events().  It's closed when the
+        iterator is closed.
+
+            async for event in ap.events():
+                print(event['state'])
+
+        Args:
+            categories(list):   Optional. The categories of events to receive, or None for all of them
+            states(list):       Optional. The states of events to receive, or None for all of them
+
+        Yields:
+            dict:   An event provided by the AirPlay server
+
+        Raises:
+            RuntimeError:   The device didn't accept the upgrade, or sent an invalid event
+            OSError:        The connection for events was lost, and couldn't be made again
+        """
+        reader, writer, data = await self._open_events()
+
+        try:
+            events = EventParser()
+
+            # now we loop forever, receiving events as HTTP POSTs to us
+            while True:
+                pending = events.feed(data)
+
+                # acknowledge them
+                lost = False
+                if pending:
+                    try:
+                        writer.write(EVENT_RESPONSE * len(pending))
+                        await writer.drain()
+                    except OSError:
+                        lost = True
+
+                for event in pending:
+                    if matches(event, categories, states):
+                        yield event
+
+                if not lost:
+                    try:
+                        data = await reader.read(self.RECV_SIZE)
+                    except OSError:
+                        data = b''
+
+                    lost = not data
+
+                # the connection was lost, make a new one
+                if lost:
+                    writer.close()
+                    reader, writer, data = await self._open_events()
+                    events = EventParser()
+        finally:
+            writer.close()
+
+    async def _open_events(self):
+        """Open a connection to the device and upgrade it to Reverse HTTP, retrying if the connection fails,
+        see AirPlay._open_event_socket()
+
+        Returns:
+            (StreamReader, StreamWriter, bytes):    The connection, and anything received after the upgrade response
+
+        Raises:
+            OSError:        Unable to connect after `retries` attempts
+            RuntimeError:   The device didn't accept the upgrade
+        """
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(self._backoff(attempt))
+
+            writer = None
+            try:
+                reader, writer = await self._open()
+
+                writer.write(UPGRADE_REQUEST)
+                await writer.drain()
+
+                parser = ResponseParser()
+                responses = []
+                while not responses:
+                    data = await asyncio.wait_for(reader.read(self.RECV_SIZE), self.timeout)
+                    if not data:
+                        raise ConnectionError('The AirPlay device closed the connection')
+                    responses = parser.feed(data)
+            except (OSError, asyncio.TimeoutError):
+                if writer is not None:
+                    writer.close()
+                if attempt >= self.retries:
+                    raise
+                continue
+            except BaseException:
+                if writer is not None:
+                    writer.close()
+                raise
+
+            # if it was successfully, we should get code 101 'switching protocols'
+            if responses[0].status != 101:
+                writer.close()
+                raise RuntimeError(
+                    "Unexpected response from AirPlay when setting up event listener.\n"
+                    "Expected: HTTP/1.1 101 Switching Protocols\n\n"
+                    "Received: {0}".format(responses[0])
+                )
+
+            # the first events may have arrived with the upgrade response
+            return reader, writer, parser.unparsed()
+
+    @classmethod
+    async def find(cls, timeout=10, fast=False):
+        """Use Zeroconf/Bonjour to locate AirPlay servers on the local network, see AirPlay.find()
+
+        Discovery runs in an executor, then a connection is made to each server found.
+
+        Returns:
+            list:   A list of connected AsyncAirPlay() objects; one for each AirPlay server found
+        """
+        loop = asyncio.get_event_loop()
+
+        found = await loop.run_in_executor(None, AirPlay._discover, timeout, fast)
+        if found is None:
+            return None
+
+        devices = [cls(host, port, name) for (name, host, port) in found]
+        await asyncio.gather(*[device.connect() for device in devices])
+
+        return devices
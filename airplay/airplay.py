@@ -1,27 +1,12 @@
-import atexit
-import email
-import os
 import socket
 import time
 import warnings
 
-from multiprocessing import Process, Queue
-
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler
 except ImportError:
     from http.server import BaseHTTPRequestHandler
 
-try:
-    from httplib import HTTPResponse
-except ImportError:
-    from http.client import HTTPResponse
-
-try:
-    from plistlib import readPlistFromString as plist_loads
-except ImportError:
-    from plistlib import loads as plist_loads
-
 try:
     from Queue import Empty
 except ImportError:
@@ -32,19 +17,55 @@ try:
 except ImportError:
     from io import BytesIO as StringIO
 
-try:
-    from urllib import urlencode
-    from urllib import pathname2url
-except ImportError:
-    from urllib.parse import urlencode
-    from urllib.request import pathname2url
-
 try:
     from zeroconf import ServiceBrowser, ServiceStateChange, Zeroconf
 except ImportError:
     pass
 
-from .http_server import RangeHTTPServer
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+from .events import EventMonitor, Subscription
+from .media_server import MediaServer
+from .pipeline import Pipeline
+from .stats import CommandStats
+from .protocol import (
+    BINARY_PLIST, BINARY_PLISTS, UPGRADE_REQUEST, ResponseParser, accept_headers, build_request,
+    decode_event, decode_response, play_body, playback_info_result, property_body, property_result, property_uri,
+    require_binary_plists, scrub_result
+)
+
+
+def keepalive(sock, idle=10, interval=5, count=3):
+    """Turn on TCP keepalive for `sock`, so a device that goes away is noticed even when the connection is idle
+
+    Options the platform doesn't support are skipped.
+
+    Args:
+        sock(socket):   The socket
+        idle(int):      Seconds the connection is idle before the first probe
+        interval(int):  Seconds between probes
+        count(int):     Probes that go unanswered before the connection is dropped
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    options = (
+        # macOS calls TCP_KEEPIDLE TCP_KEEPALIVE
+        (getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None)), idle),
+        (getattr(socket, 'TCP_KEEPINTVL', None), interval),
+        (getattr(socket, 'TCP_KEEPCNT', None), count),
+    )
+
+    for (option, value) in options:
+        if option is None:
+            continue
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, option, value)
+        except socket.error:
+            pass
 
 
 class FakeSocket():
@@ -68,23 +89,13 @@ class AirPlayEvent(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """Called when a new event has been received"""
-
-        # make sure this is what we expect
-        if self.path != '/event':
-            raise RuntimeError('Unexpected path when parsing event: {0}'.format(self.path))
-
-        # validate our content type
-        content_type = self.headers.get('content-type', None)
-        if content_type != 'text/x-apple-plist+xml':
-            raise RuntimeError('Unexpected Content-Type when parsing event: {0}'.format(content_type))
-
-        # and the body length
         content_length = int(self.headers.get('content-length', 0))
-        if content_length == 0:
-            raise RuntimeError('Received an event with a zero length body.')
 
-        # parse XML plist
-        self.event = plist_loads(self.rfile.read(content_length))
+        self.event = decode_event(
+            self.path,
+            self.headers.get('content-type', None),
+            self.rfile.read(content_length) if content_length else b''
+        )
 
 
 class AirPlay(object):
@@ -94,16 +105,35 @@ class AirPlay(object):
     For detailed information on most methods and responses, please see the specification.
 
     """
-    RECV_SIZE = 8192
+    RECV_SIZE = 65536
+
+    # the longest we'll wait between attempts to reconnect
+    MAX_BACKOFF = 30
+
+    # commands (besides GETs) that can safely be sent again if the connection fails before they are answered
+    IDEMPOTENT = frozenset(['/rate', '/scrub', '/stop'])
+
+    # a control socket idle for longer than this is checked before it's used, in case the device closed it
+    IDLE_CHECK = 1.0
 
-    def __init__(self, host, port=7000, name=None, timeout=5):
+    # ask for binary plists in GET requests, the device answers with an XML plist if it doesn't have them
+    ACCEPT_BINARY_PLISTS = BINARY_PLISTS
+
+    def __init__(self, host, port=7000, name=None, timeout=5, retries=3, backoff=0.5):
         """Connect to an AirPlay device on `host`:`port` optionally named `name`
 
+        If the connection to the device is lost, it's reconnected the next time
+        a command is sent.  Commands that fail because the connection was lost
+        are sent again if it's safe to: GETs, /rate, /scrub and /stop.
+
         Args:
             host(string):   Hostname or IP address of the device to connect to
             port(int):      Port to use when connectiong
             name(string):   Optional. The name of the device.
             timeout(int):   Optional. A timeout for socket operations
+            retries(int):   Optional. How many times to reconnect and retry a command before giving up
+            backoff(float): Optional. Seconds to wait before the second attempt to reconnect, doubling
+                            for each one after.  The first is made right away.
 
         Raises:
             ValueError:     Unable to connect to the specified host/port
@@ -112,147 +142,220 @@ class AirPlay(object):
         self.host = host
         self.port = port
         self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        # responses from the control socket, which may arrive in pieces
+        self._parser = ResponseParser()
+        self._responses = []
+
+        # receives events once events() is called
+        self._event_monitor = None
+
+        # what's been sent and received, see stats()
+        self._stats = CommandStats()
 
         # connect the control socket
+        self.control_socket = None
+        self._last_used = None
         try:
-            self.control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.control_socket.settimeout(timeout)
-            self.control_socket.connect((host, port))
+            self._connect()
         except socket.error as exc:
             raise ValueError("Unable to connect to {0}:{1}: {2}".format(host, port, exc))
 
-    def _monitor_events(self, event_queue, control_queue):  # pragma: no cover
-        """Connect to `host`:`port` and use reverse HTTP to receive events.
+    def _connect(self):
+        """Connect the control socket, replacing the current one
+
+        Raises:
+            socket.error:   Unable to connect
+        """
+        self._disconnect()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            keepalive(sock)
+            sock.connect((self.host, self.port))
+        except socket.error:
+            sock.close()
+            raise
 
-        This function will block until any message is received via `control_queue`
-        Which a message is received via that queue, the event socket is closed, and this
-        method will return.
+        self._stats.connected(reconnect=self._last_used is not None)
 
+        self.control_socket = sock
+        self._last_used = monotonic()
 
-        Args:
-            event_queue(Queue):     A queue which events will be put into as they are received
-            control_queue(Queue):   If any messages are received on this queue, this function will exit
+    def _disconnect(self):
+        """Close the control socket and drop anything received on it"""
+        self._parser.reset()
+        self._responses = []
 
-        Raises:
-            Any exceptions raised by this method are caught and sent through
-            the `event_queue` and handled in the main process
+        if self.control_socket is None:
+            return
+
+        sock, self.control_socket = self.control_socket, None
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def _stale(self):
+        """Returns True if the device has closed the control socket
+
+        Only sockets that have been idle for IDLE_CHECK seconds are checked.
         """
+        if monotonic() - self._last_used < self.IDLE_CHECK:
+            return False
 
+        # an idle socket shouldn't be readable, unless it has been closed
+        self.control_socket.settimeout(0)
         try:
-            # connect to the host
-            event_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            event_socket.connect((self.host, self.port))
+            return self.control_socket.recv(1, socket.MSG_PEEK) == b''
+        except socket.error:
+            return False
+        finally:
+            self.control_socket.settimeout(self.timeout)
 
-            # "upgrade" this connection to Reverse HTTP
-            raw_request = b"POST /reverse HTTP/1.1\r\nUpgrade: PTTH/1.0\r\nConnection: Upgrade\r\n\r\n"
-            event_socket.send(raw_request)
+    def _ensure_connected(self):
+        """Reconnect the control socket if it was lost, or closed by the device while it was idle
 
-            raw_response = event_socket.recv(AirPlay.RECV_SIZE)
-            resp = HTTPResponse(FakeSocket(raw_response))
-            resp.begin()
+        Raises:
+            socket.error:   Unable to reconnect
+        """
+        if self.control_socket is None or self._stale():
+            self._connect()
 
-            # if it was successfully, we should get code 101 'switching protocols'
-            if resp.status != 101:
-                raise RuntimeError(
-                    "Unexpected response from AirPlay when setting up event listener.\n"
-                    "Expected: HTTP/1.1 101 Switching Protocols\n\n"
-                    "Sent:\n{0}Received:\n{1}".format(raw_request, raw_response)
-                )
+    def _backoff(self, attempt):
+        """Seconds to wait before the `attempt`th reconnect: none for the first, then `backoff` doubling each time"""
+        if attempt <= 1:
+            return 0
 
-            # now we loop forever, receiving events as HTTP POSTs to us
-            event_socket.settimeout(.1)
+        return min(self.backoff * 2 ** (attempt - 2), self.MAX_BACKOFF)
 
-            while True:
-                # see if the parent asked us to exit
-                try:
-                    control_queue.get(block=False)
-                    event_socket.close()
-                    return
-                except Empty:
-                    pass
+    def _open_event_socket(self, stop=None):
+        """Connect a new socket to the device and upgrade it to Reverse HTTP, retrying if the connection fails
 
-                # receive a request
-                try:
-                    raw_request = event_socket.recv(AirPlay.RECV_SIZE)
-                except socket.timeout:
-                    continue
+        Args:
+            stop(threading.Event):  Optional. When set, give up instead of waiting to try again
 
-                # parse it
-                try:
-                    req = AirPlayEvent(FakeSocket(raw_request), event_socket.getpeername(), None)
-                except RuntimeError as exc:
-                    raise RuntimeError(
-                        "Unexpected request from AirPlay while processing events\n"
-                        "Error: {0}\nReceived:\n{1}".format(exc, raw_request)
-                    )
+        Returns:
+            (socket, bytes):    The upgraded socket, and anything received after the upgrade response.
+                                (None, b'') if `stop` was set.
 
-                # acknowledge it
-                event_socket.send(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        Raises:
+            socket.error:   Unable to connect after `retries` attempts
+            RuntimeError:   The device didn't accept the upgrade
+        """
+        for attempt in range(self.retries + 1):
+            if stop is None:
+                time.sleep(self._backoff(attempt))
+            elif stop.wait(self._backoff(attempt)):
+                return None, b''
 
-                # skip non-video events
-                if req.event.get('category', None) != 'video':
-                    continue
+            # connect to the host
+            event_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                event_socket.settimeout(self.timeout)
+                keepalive(event_socket)
+                event_socket.connect((self.host, self.port))
+
+                # "upgrade" this connection to Reverse HTTP
+                raw_request = UPGRADE_REQUEST
+                event_socket.sendall(raw_request)
+
+                parser = ResponseParser()
+                responses = []
+                raw_response = b''
+                while not responses:
+                    data = event_socket.recv(AirPlay.RECV_SIZE)
+                    if not data:
+                        raise socket.error('The AirPlay device closed the connection')
+
+                    raw_response += data
+                    responses = parser.feed(data)
+            except socket.error:
+                event_socket.close()
+                if attempt >= self.retries:
+                    raise
+                continue
 
-                # send the event back to the parent process
-                event_queue.put(req.event)
+            # if it was successfully, we should get code 101 'switching protocols'
+            if responses[0].status != 101:
+                event_socket.close()
+                raise RuntimeError(
+                    "Unexpected response from AirPlay when setting up event listener.\n"
+                    "Expected: HTTP/1.1 101 Switching Protocols\n\n"
+                    "Sent:\n{0}Received:\n{1}".format(raw_request, raw_response)
+                )
 
-        except KeyboardInterrupt:
-            return
-        except Exception as exc:
-            event_queue.put(exc)
-            return
+            return event_socket, parser.unparsed()
 
-    def events(self, block=True):
+    def events(self, block=True, categories=('video',), states=None, maxsize=0, overflow='drop-oldest'):
         """A generator that produces a list of events from the AirPlay Server
 
+        Events are received on a background thread (see events.EventMonitor),
+        which is started the first time this is called.  The filter and queue
+        options of that call are used until close().
+
         Args:
-            block(bool):    If true, this function will block until an event is available
-                            If false, the generator will stop when there are no more events
+            block(bool):        If true, this function will block until an event is available
+                                If false, the generator will stop when there are no more events
+            categories(list):   Optional. The categories of events to receive, or None for all of them
+            states(list):       Optional. The states of events to receive, or None for all of them
+            maxsize(int):       Optional. The most events to queue, 0 for no limit
+            overflow(str):      Optional. What to do with events that arrive when the queue is full,
+                                see events.Subscription
 
         Yields:
             dict:           An event provided by the AirPlay server
 
+        Raises:
+            RuntimeError:   The device didn't accept the upgrade to Reverse HTTP, or sent an invalid event
+            socket.error:   The connection for events was lost, and couldn't be made again
+            ValueError:     `overflow` isn't valid
         """
-        # set up our event socket reader in another process if we haven't
-        # already done so.
-        try:
-            getattr(self, 'event_queue')
-        except AttributeError:
-            # TODO: switch to Pipe?
-            self.event_queue = Queue()
-            self.event_control = Queue()
-
-            self.event_monitor = Process(target=self._monitor_events, args=[self.event_queue, self.event_control])
-            self.event_monitor.start()
-
-            # ensure when we shutdown, that the child proess does as well
-            # this needs to be called _after_ the call to Process.start()
-            # as multiprocessing also registers atexit handlers, and we want
-            # ours to run first, Since atexit is LIFO we go last to get run first
-            atexit.register(lambda: self.event_control.put(True))
-
-        # loop forever processing events sent to us by the child process
+        if self._event_monitor is None:
+            self._event_monitor = EventMonitor(self, Subscription(categories, states, None, maxsize, overflow))
+
         while True:
             try:
-                event = self.event_queue.get(block=block, timeout=None)
-                # if we were sent an exception, then something went wrong
-                # in the child process, so reraise it here
-                if isinstance(event, Exception):
-                    raise event
-
-                # otherwise, it's just an event
-                yield event
+                event = self._event_monitor.get(block=block)
             except Empty:
                 return
 
+            # if we were sent an exception, then something went wrong
+            # on the monitor's thread, which has stopped, so reraise it here
+            if isinstance(event, Exception):
+                self._event_monitor.close()
+                self._event_monitor = None
+                raise event
+
+            # otherwise, it's just an event
+            yield event
+
+    def close(self):
+        """Stop receiving events, and close the connections to the device
+
+        The control connection is made again if another command is sent.
+        """
+        if self._event_monitor is not None:
+            self._event_monitor.close()
+            self._event_monitor = None
+
+        self._disconnect()
+
     def _command(self, uri, method='GET', body='', **kwargs):
         """Makes an HTTP request through to an AirPlay server
 
+        GETs ask for a binary plist if ACCEPT_BINARY_PLISTS is set, see protocol.ACCEPT_PLISTS
+
         Args:
             uri(string):    The URI to request
             method(string): The HTTP verb to use when requesting `uri`, defaults to GET
             body(string):   If provided, will be sent witout alteration as the request body.
                             Content-Length header will be set to len(`body`)
+            headers(dict):  Optional. More headers to send
             **kwargs:       If provided, Will be converted to a query string and appended to `uri`
 
         Returns:
@@ -260,62 +363,133 @@ class AirPlay(object):
             False: Request returned something other than 200 OK, with no response body
 
             Mixed: The body of the HTTP response
+
+        Raises:
+            socket.error:           The connection failed, and the command couldn't be retried or failed `retries` times
+            protocol.ProtocolError: The device sent something we can't parse.  The connection is made again
+                                    for the next command.
         """
+        kwargs['headers'] = accept_headers(method, kwargs.get('headers'), self.ACCEPT_BINARY_PLISTS)
 
-        # generate the request
-        if len(kwargs):
-            uri = uri + '?' + urlencode(kwargs)
+        request = build_request(uri, method, body, **kwargs)
+        replayable = method == 'GET' or uri in self.IDEMPOTENT
+        endpoint = method + ' ' + uri.split('?', 1)[0]
 
-        request = method + " " + uri + " HTTP/1.1\r\nContent-Length: " + str(len(body)) + "\r\n\r\n" + body
+        attempt = 0
+        start = monotonic()
+        while True:
+            sent = False
+            try:
+                self._ensure_connected()
+
+                sent = True
+                self.control_socket.sendall(request)
+                self._stats.sent(len(request))
+                response = self._read_response()
+                break
+            except socket.error:
+                self._disconnect()
+
+                # the device may have acted on it, so only resend it if that's harmless
+                if (sent and not replayable) or attempt >= self.retries:
+                    self._stats.command(endpoint, monotonic() - start, error=True)
+                    raise
+
+                attempt += 1
+                self._stats.retried()
+                time.sleep(self._backoff(attempt))
+            except Exception:
+                # what's left in the parser can't be trusted, so start again on a new connection
+                self._disconnect()
+                self._stats.command(endpoint, monotonic() - start, error=True)
+                raise
+
+        self._last_used = monotonic()
+        self._stats.command(endpoint, self._last_used - start, error=response.status >= 400)
+
+        return decode_response(response)
+
+    def _read_response(self):
+        """Read the next response from the control socket
 
-        try:
-            request = bytes(request, 'UTF-8')
-        except TypeError:
-            pass
+        Returns:
+            protocol.Response:  The response
 
-        # send it
-        self.control_socket.send(request)
+        Raises:
+            socket.error:           The device closed the connection before the response was complete
+            protocol.ProtocolError: The device sent something we can't parse
+        """
+        while not self._responses:
+            data = self.control_socket.recv(self.RECV_SIZE)
+            if not data:
+                raise socket.error('The AirPlay device closed the connection')
 
-        # parse our response
-        result = self.control_socket.recv(self.RECV_SIZE)
-        resp = HTTPResponse(FakeSocket(result))
-        resp.begin()
+            self._stats.received(len(data))
+            self._responses.extend(self._parser.feed(data))
 
-        # if our content length is zero, then return bool based on result code
-        if int(resp.getheader('content-length', 0)) == 0:
-            if resp.status == 200:
-                return True
-            else:
-                return False
+        return self._responses.pop(0)
 
-        # else, parse based on provided content-type
-        # and return the response body
-        content_type = resp.getheader('content-type')
+    def stats(self):
+        """Returns what has been sent to the device on the control connection, and how long it took to answer
 
-        if content_type is None:
-            raise RuntimeError('Response returned without a content type!')
+        Latencies are from sending a command to receiving its response, including any
+        reconnects and retries, and are counted in fixed buckets so keeping them is cheap.
 
-        if content_type == 'text/parameters':
-            body = resp.read()
-            try:
-                body = str(body, 'UTF-8')
-            except TypeError:
-                pass
+        Returns:
+            dict:   Keys are:
+                        commands:           Commands sent
+                        errors:             Commands that failed, or were answered with a 4xx or 5xx status
+                        bytes_sent:         Bytes sent
+                        bytes_received:     Bytes received
+                        connects:           Control connections made
+                        reconnects:         Of those, connections made again after one was lost
+                        retries:            Commands sent again after a connection was lost
+                        endpoints:          For each endpoint (like 'GET /scrub') the count, errors, the mean,
+                                            min and max latency, approximate p50, p90 and p99 latencies (the
+                                            upper bound of their bucket), and the count in each bucket
+        """
+        return self._stats.snapshot()
 
-            return email.message_from_string(body)
+    def reset_stats(self):
+        """Start counting the stats() again from zero"""
+        self._stats.reset()
 
-        if content_type == 'text/x-apple-plist+xml':
-            return plist_loads(resp.read())
+    def get_property(self, name):
+        """Read a property of the current playback, such as playbackAccessLog or playbackErrorLog
 
-        raise RuntimeError('Response received with unknown content-type: {0}'.format(content_type))
+        Args:
+            name(string):   The name of the property
+
+        Returns:
+            Mixed:  The value of the property
+            False:  The device doesn't have it
+
+        Raises:
+            NotImplementedError:    Binary plists aren't supported by this version of Python
+            RuntimeError:           The device returned an error code
+        """
+        require_binary_plists()
+
+        return property_result(self._command(property_uri('getProperty', name)))
+
+    def set_property(self, name, value):
+        """Change a property of the current playback, such as forwardEndTime or reverseEndTime
 
-    def get_property(self, *args, **kwargs):
-        """What it says on the tin"""
-        raise NotImplementedError('Methods that require binary plists are not supported.')
+        Args:
+            name(string):   The name of the property
+            value(Mixed):   Its new value, anything that can be stored in a plist
+
+        Returns:
+            True:   The property was set
+            False:  The device doesn't have it
 
-    def set_property(self, *args, **kwargs):
-        """What it says on the tin"""
-        raise NotImplementedError('Methods that require binary plists are not supported.')
+        Raises:
+            NotImplementedError:    Binary plists aren't supported by this version of Python
+            RuntimeError:           The device returned an error code
+        """
+        return property_result(self._command(
+            property_uri('setProperty', name), 'PUT', property_body(value), headers={'Content-Type': BINARY_PLIST}
+        ))
 
     def server_info(self):
         """Fetch general informations about the AirPlay server.
@@ -339,11 +513,7 @@ class AirPlay(object):
         that the AirPlay server accepted the request and will *attempt* playback
         """
 
-        return self._command(
-            '/play',
-            'POST',
-            "Content-Location: {0}\nStart-Position: {1}\n\n".format(url, float(position))
-        )
+        return self._command('/play', 'POST', play_body(url, position))
 
     def rate(self, rate):
         """Change the playback rate.
@@ -371,11 +541,11 @@ class AirPlay(object):
         """Retrieve playback informations such as position, duration, rate, buffering status and more.
 
         Returns:
-            dict: key/value pairs describing the playback state
+            PlaybackInfo: key/value pairs describing the playback state, see models.PlaybackInfo
             False: Nothing is currently being played
         """
 
-        return self._command('/playback-info')
+        return playback_info_result(self._command('/playback-info'))
 
     def scrub(self, position=None):
         """Return the current position or seek to a specific position
@@ -405,31 +575,78 @@ class AirPlay(object):
         if position:
             return self.scrub()
 
-        # convert the strings we get back to floats (which they should be)
-        return {kk: float(vv) for (kk, vv) in response.items()}
+        return scrub_result(response)
+
+    def pipeline(self):
+        """Queue commands and send them to the device together, in a single write
+
+        Commands are queued by calling the methods of the returned Pipeline, which
+        mirror the ones on this object.  They are sent when the `with` block ends
+        (or execute() is called) and the responses are matched to them in order, so
+        the whole batch takes one round trip instead of one per command.
 
-    def serve(self, path):
-        """Start a HTTP server to serve local content to the AirPlay device
+            >>> with ap.pipeline() as batch:
+            ...     info = batch.playback_info()
+            ...     position = batch.scrub()
+            >>> position.value
+            {'duration': 60.095, 'position': 12.5}
+
+        Returns:
+            Pipeline:   The pipeline
+        """
+        return Pipeline(self)
+
+    def serve(self, path, max_connections=16, keep_alive_timeout=15, cache_bytes=64 * 1024 * 1024,
+              rate_limit=None, client_rate_limit=None, read_ahead=None, access_log=None, mode='process'):
+        """Serve a local file to the AirPlay device
+
+        All AirPlay instances share a single HTTP server that is started the first
+        time this is called.  Later calls add files to it and return immediately.
 
         Args:
-            path(str):  An absoulte path to a local file to be served.
+            path(str):                  An absoulte path to a local file to be served.
+            max_connections(int):       Optional. The number of connections the server keeps open,
+                                        the longest idle is closed to make room for more.
+                                        If None, connections are handled one at a time.
+            keep_alive_timeout(int):    Optional. Seconds an idle persistent connection is kept open.
+                                        If None, connections are closed after each request.
+            cache_bytes(int):           Optional. The most memory the server may use to cache frequently read
+                                        parts of files.  If 0 or None, nothing is cached.
+            rate_limit(int):            Optional. The most bytes per second the server sends to all devices,
+                                        shared fairly between them.  If None, there is no limit.
+            client_rate_limit(int):     Optional. The most bytes per second the server sends to any one device.
+                                        If None, there is no limit.
+            read_ahead(int):            Optional. How many bytes of the file to read ahead of each device
+                                        on a background thread.  If 0 or None, nothing is read ahead.
+            access_log(str):            Optional. A file the server appends a JSON line to for every request,
+                                        with its range, status, bytes sent and timings.  If None, nothing is logged.
+            mode(str):                  Optional. 'process' to run the server in a child process, or
+                                        'thread' to run it on a background thread in this process.
+
+            The server options only take effect when the server is started.
 
         Returns:
             str:    An absolute url to the `path` suitable for passing to play()
         """
 
-        q = Queue()
-        self._http_server = Process(target=RangeHTTPServer.start, args=(path, self.host, q))
-        self._http_server.start()
-
-        atexit.register(lambda: self._http_server.terminate())
+        server = MediaServer.shared(
+            max_connections=max_connections,
+            keep_alive_timeout=keep_alive_timeout,
+            cache_bytes=cache_bytes,
+            rate_limit=rate_limit,
+            client_rate_limit=client_rate_limit,
+            read_ahead=read_ahead,
+            access_log=access_log,
+            mode=mode
+        )
 
-        server_address = (self.control_socket.getsockname()[0], q.get(True)[1])
+        # the address the device reaches us on
+        self._ensure_connected()
 
-        return 'http://{0}:{1}/{2}'.format(
-            server_address[0],
-            server_address[1],
-            pathname2url(os.path.basename(path))
+        return 'http://{0}:{1}{2}'.format(
+            self.control_socket.getsockname()[0],
+            server.server_address[1],
+            server.register(path, self.host)
         )
 
     @classmethod
@@ -446,6 +663,23 @@ class AirPlay(object):
             list:   A list of AirPlay() objects; one for each AirPlay server found
 
         """
+        found = cls._discover(timeout, fast)
+        if found is None:
+            return None
+
+        return [cls(host, port, name) for (name, host, port) in found]
+
+    @staticmethod
+    def _discover(timeout=10, fast=False):
+        """Use Zeroconf/Bonjour to locate AirPlay servers, see find()
+
+        This blocks, and doesn't connect to the servers it finds, so it's shared by
+        AirPlay.find() and AsyncAirPlay.find() (which runs it in an executor).
+
+        Returns:
+            list:   (name, host, port) for each AirPlay server found
+            None:   The zeroconf package isn't installed
+        """
 
         # this will be our list of devices
         devices = []
@@ -462,9 +696,7 @@ class AirPlay(object):
                 except ValueError:
                     pass
 
-                devices.append(
-                    cls(socket.inet_ntoa(info.address), info.port, name)
-                )
+                devices.append((name, socket.inet_ntoa(info.address), info.port))
 
         # search for AirPlay devices
         try:
@@ -474,7 +706,7 @@ class AirPlay(object):
             warnings.warn(
                 'AirPlay.find() requires the zeroconf package but it could not be imported. '
                 'Install it if you wish to use this method. https://pypi.python.org/pypi/zeroconf',
-                stacklevel=2
+                stacklevel=3
             )
             return None
 
@@ -491,4 +723,4 @@ class AirPlay(object):
         finally:
             zeroconf.close()
 
-        return devices
+        return list(devices)
@@ -0,0 +1,207 @@
+import os
+import stat
+import threading
+import time
+
+from collections import OrderedDict
+from email.utils import formatdate
+
+
+class BlockCache(object):
+    """A bounded, least recently used cache of file blocks held in memory
+
+    AirPlay devices read the start and end of a file (where the MP4 headers and
+    index live) over and over again, so only blocks within `window` bytes of
+    the start or end of a file are cached.  Everything else is left to the OS.
+
+    Blocks are keyed by (path, inode, mtime, block number) so a file that is
+    replaced or modified is never served from stale blocks.  One cache is shared
+    by all of the connections to a server, so access to it is serialized.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, block_size=64 * 1024, window=2 * 1024 * 1024):
+        """Create a cache
+
+        Args:
+            max_bytes(int):     The maximum number of bytes of file data to hold in memory
+            block_size(int):    The size of each cached block
+            window(int):        Blocks this close to the start or end of a file are cached
+        """
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.window = window
+
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.clear()
+
+    def clear(self):
+        """Drop all cached blocks and reset the counters"""
+        with self._lock:
+            self._blocks.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Returns:
+            dict: The hit/miss counters and how much memory is in use
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'blocks': len(self._blocks),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def split(self, first, last, size):
+        """Split bytes `first` through `last` - 1 of a file `size` bytes long into cacheable and uncacheable parts
+
+        Returns:
+            list:   (first, last, cacheable) tuples, in order
+        """
+        # round the edges of the window to whole blocks
+        head = -(-self.window // self.block_size) * self.block_size
+        tail = max(head, (size - self.window) // self.block_size * self.block_size)
+
+        parts = []
+        for (start, end, cacheable) in ((first, min(last, head), True),
+                                        (max(first, head), min(last, tail), False),
+                                        (max(first, tail), last, True)):
+            if start < end:
+                parts.append((start, end, cacheable))
+
+        return parts
+
+    def read(self, fh, stats, block):
+        """Return the contents of `block` from `fh`, reading it from disk if it's not cached
+
+        Args:
+            fh(file):           An open file object
+            stats(stat_result): The result of os.fstat() on `fh`
+            block(int):         The block number to read
+
+        Returns:
+            bytes:  The block.  It will be shorter than block_size at the end of the file.
+        """
+        key = (fh.name, stats.st_ino, stats.st_mtime, block)
+
+        with self._lock:
+            data = self._blocks.pop(key, None)
+            if data is not None:
+                self.hits += 1
+                self._blocks[key] = data
+                return data
+
+            self.misses += 1
+
+        fh.seek(block * self.block_size, 0)
+        data = fh.read(self.block_size)
+
+        if len(data) > self.max_bytes:
+            return data
+
+        with self._lock:
+            if key not in self._blocks:
+                self._blocks[key] = data
+                self.bytes += len(data)
+
+            while self.bytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+        return data
+
+
+class StatCache(object):
+    """Cache the result of os.stat() for files being served, and the validators derived from it
+
+    AirPlay devices send a steady stream of HEAD and Range requests for the same
+    file, so a file is only stat()ed again once its entry is `ttl` seconds old.
+    If the file has changed by then, its validators are regenerated.
+    """
+
+    def __init__(self, ttl=1.0):
+        """Create a cache
+
+        Args:
+            ttl(float):     Seconds to reuse the result of os.stat() for
+        """
+        self.ttl = ttl
+
+        # path => [expires, stats, (etag, last_modified)]
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def identity(stats):
+        """Returns:
+            tuple:  The parts of a stat result that change when a file is replaced or modified
+        """
+        return (stats.st_ino, stats.st_size, stats.st_mtime)
+
+    def stat(self, path):
+        """os.stat() `path`, reusing a recent result if we have one
+
+        When the file is stat()ed we also make sure it can be opened, so a file
+        we can't read is caught here rather than part way through a response.
+
+        Raises:
+            EnvironmentError:   The file could not be stat()ed or opened
+        """
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+
+        try:
+            stats = os.stat(path)
+            if not stat.S_ISDIR(stats.st_mode):
+                os.close(os.open(path, os.O_RDONLY))
+        except EnvironmentError:
+            self.invalidate(path)
+            raise
+
+        with self._lock:
+            if entry is not None and self.identity(entry[1]) == self.identity(stats):
+                validators = entry[2]
+            else:
+                validators = None
+
+            self._entries[path] = [now + self.ttl, stats, validators]
+
+        return stats
+
+    def validators(self, path, stats):
+        """Returns:
+            (str, str):     A strong ETag and a Last-Modified date for `path` as described by `stats`
+        """
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[2] is not None and self.identity(entry[1]) == self.identity(stats):
+                return entry[2]
+
+        validators = (
+            '"{0:x}-{1:x}-{2:x}"'.format(stats.st_ino, stats.st_size, int(stats.st_mtime * 1000000)),
+            formatdate(stats.st_mtime, usegmt=True)
+        )
+
+        with self._lock:
+            if entry is not None and self._entries.get(path) is entry and \
+                    self.identity(entry[1]) == self.identity(stats):
+                entry[2] = validators
+
+        return validators
+
+    def invalidate(self, path):
+        """Forget anything cached about `path`"""
+        with self._lock:
+            self._entries.pop(path, None)
@@ -2,7 +2,7 @@ import argparse
 import os
 import time
 
-from airplay import AirPlay
+from airplay import AirPlay, PlaybackState
 
 import click
 
@@ -41,6 +41,14 @@ def humanize_seconds(secs):
     return "%02d:%02d:%02d" % (h, m, s)
 
 
+def mbps_to_bytes(mbps):
+    """Convert Mbit/s to bytes/s"""
+    if mbps is None:
+        return None
+
+    return int(mbps * 1000 * 1000 / 8)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Playback a local or remote video file via AirPlay. "
@@ -70,6 +78,29 @@ def main():
         help='Playback video to a specific device [<host/ip>:(<port>)]'
     )
 
+    parser.add_argument(
+        '--rate-limit',
+        default=None,
+        type=float,
+        metavar='MBPS',
+        help='Limit the bandwidth used to serve a local file to all devices, in Mbit/s'
+    )
+
+    parser.add_argument(
+        '--client-rate-limit',
+        default=None,
+        type=float,
+        metavar='MBPS',
+        help='Limit the bandwidth used to serve a local file to each device, in Mbit/s'
+    )
+
+    parser.add_argument(
+        '--access-log',
+        default=None,
+        metavar='PATH',
+        help='Log the requests made for a local file to PATH, as JSON lines'
+    )
+
     args = parser.parse_args()
 
     # connect to the AirPlay device we want to control
@@ -78,44 +109,42 @@ def main():
     except (ValueError, RuntimeError) as exc:
         parser.error(exc)
 
-    duration = 0
-    position = 0
-    state = 'loading'
-
     path = args.path
 
     # if the url is on our local disk, then we need to spin up a server to start it
     if os.path.exists(path):
-        path = ap.serve(path)
+        path = ap.serve(
+            path,
+            rate_limit=mbps_to_bytes(args.rate_limit),
+            client_rate_limit=mbps_to_bytes(args.client_rate_limit),
+            access_log=args.access_log,
+            mode='thread'
+        )
 
     # play what they asked
     ap.play(path, args.position)
 
+    # predict the position between events, rather than asking the device for it each time
+    playback = PlaybackState(ap)
+
     # stay in this loop until we exit
     with click.progressbar(length=100, show_eta=False) as bar:
         try:
             while True:
                 for ev in ap.events(block=False):
-                    newstate = ev.get('state', None)
-
-                    if newstate is None:
-                        continue
-
-                    if newstate == 'playing':
-                        duration = ev.get('duration')
-                        position = ev.get('position')
-
-                    state = newstate
+                    playback.update(ev)
 
+                state = playback.state
                 if state == 'stopped':
                     raise KeyboardInterrupt
 
                 bar.label = state.capitalize()
 
                 if state == 'playing':
-                    info = ap.scrub()
-                    duration = info['duration']
-                    position = info['position']
+                    playback.refresh()
+
+                position = playback.position or 0
+                duration = playback.duration or 0
 
                 if state in ['playing', 'paused']:
                     bar.label += ': {0} / {1}'.format(
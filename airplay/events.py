@@ -0,0 +1,645 @@
+import collections
+import socket
+import threading
+
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    import selectors34 as selectors
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+from .protocol import EVENT_RESPONSE, EventParser, ProtocolError
+
+
+def matches(event, categories=('video',), states=None):
+    """Returns True if `event` is in one of `categories` and `states` (None matches any)"""
+    if categories is not None and event.get('category', None) not in categories:
+        return False
+
+    if states is not None and event.get('state', None) not in states:
+        return False
+
+    return True
+
+
+class Subscription(object):
+    """The events of a device that match a filter, queued for a consumer or passed to a callback
+
+    Events are queued to be read with get() or by iterating, unless there's a
+    `callback`.  The queue can be bounded with `maxsize`, and what happens to
+    events that arrive when it's full is chosen with `overflow`:
+
+        drop-oldest:    The oldest queued event is discarded
+        drop-newest:    The new event is discarded
+        coalesce:       Queued events of the same category are replaced by the new
+                        one, so a slow consumer still sees the latest state.  If there
+                        aren't any, the oldest queued event is discarded
+
+    Discarded events are counted in `dropped`.  The exception that ends the
+    events of a device is always queued.
+
+        >>> for event in hub.subscribe(ap, categories=('video', 'photo'), maxsize=10, overflow='coalesce'):
+        ...     print(event['state'])
+
+    """
+
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    COALESCE = 'coalesce'
+
+    OVERFLOW = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+    def __init__(self, categories=('video',), states=None, callback=None, maxsize=0, overflow=DROP_OLDEST):
+        """
+        Args:
+            categories(list):       Optional. The categories of events to receive, or None for all of them
+            states(list):           Optional. The states of events to receive, or None for all of them
+            callback(callable):     Optional. Called with the device and each event (or the exception that
+                                    ended them) instead of queueing them, on the thread receiving events
+            maxsize(int):           Optional. The most events to queue, 0 for no limit
+            overflow(str):          Optional. What to do with events that arrive when the queue is full
+
+        Raises:
+            ValueError:     `overflow` isn't one of OVERFLOW
+        """
+        if overflow not in self.OVERFLOW:
+            raise ValueError('overflow must be one of {0}, not {1!r}'.format(', '.join(self.OVERFLOW), overflow))
+
+        self.categories = frozenset(categories) if categories is not None else None
+        self.states = frozenset(states) if states is not None else None
+        self.callback = callback
+        self.maxsize = maxsize
+        self.overflow = overflow
+
+        self.dropped = 0
+
+        self._events = collections.deque()
+        self._ready = threading.Condition()
+
+    def __iter__(self):
+        """Yields events as they arrive, forever
+
+        Raises:
+            Exception:  The exception that ended the events
+        """
+        while True:
+            event = self.get()
+            if isinstance(event, Exception):
+                raise event
+
+            yield event
+
+    def matches(self, event):
+        """Returns True if this subscription wants `event`, see matches()"""
+        return isinstance(event, Exception) or matches(event, self.categories, self.states)
+
+    def deliver(self, airplay, event):
+        """Queue `event`, or pass it to the callback, if it matches
+
+        Returns:
+            bool:   The event matched
+        """
+        if not self.matches(event):
+            return False
+
+        if self.callback is not None:
+            self.callback(airplay, event)
+        else:
+            self.put(event)
+
+        return True
+
+    def put(self, event):
+        """Queue `event`, making room for it according to `overflow` if the queue is full"""
+        with self._ready:
+            events = self._events
+
+            if self.maxsize and len(events) >= self.maxsize and not isinstance(event, Exception):
+                if self.overflow == self.DROP_NEWEST:
+                    self.dropped += 1
+                    return
+
+                if self.overflow == self.COALESCE:
+                    category = event.get('category', None)
+                    kept = [e for e in events if isinstance(e, Exception) or e.get('category', None) != category]
+                    self.dropped += len(events) - len(kept)
+                    events.clear()
+                    events.extend(kept)
+
+                while len(events) >= self.maxsize:
+                    events.popleft()
+                    self.dropped += 1
+
+            events.append(event)
+            self._ready.notify()
+
+    def get(self, block=True, timeout=None):
+        """Returns the next queued event, or the exception that ended them
+
+        Raises:
+            queue.Empty:    There isn't one and `block` is False, or `timeout` expired
+        """
+        with self._ready:
+            if block and timeout is not None:
+                deadline = monotonic() + timeout
+
+            while not self._events:
+                if not block:
+                    raise queue.Empty
+
+                if timeout is None:
+                    self._ready.wait()
+                    continue
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                self._ready.wait(remaining)
+
+            return self._events.popleft()
+
+    def qsize(self):
+        """Returns how many events are queued"""
+        return len(self._events)
+
+
+class EventMonitor(object):
+    """Receive the events an AirPlay device sends over Reverse HTTP on a background thread
+
+    The thread waits on the event socket and a wakeup socket with a selector,
+    so events are queued the moment they arrive, and close() stops it straight
+    away rather than when a poll next times out.  If the connection is lost
+    it's made again, see AirPlay._open_event_socket().  close() stops that
+    between attempts, so it may wait for one attempt to connect to time out.
+
+    Events are given to `subscription`.  If something goes wrong, the exception
+    is given to it and the thread exits.
+    """
+
+    def __init__(self, airplay, subscription=None):
+        """Start receiving events from `airplay`
+
+        Args:
+            airplay(AirPlay):               The device
+            subscription(Subscription):     Optional. Which events to keep and how to queue them.
+                                            Defaults to queueing every video event
+        """
+        self.airplay = airplay
+        self.subscription = subscription if subscription is not None else Subscription()
+
+        # written to by close() to wake up the thread, and set to stop it reconnecting
+        self._wakeup, self._wakeup_write = socket.socketpair()
+        self._closed = threading.Event()
+
+        self.thread = threading.Thread(
+            target=self._run,
+            name='airplay-events-{0}:{1}'.format(airplay.host, airplay.port)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        """Stop receiving events and close the connection"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+
+        try:
+            self._wakeup_write.send(b'\0')
+        except socket.error:
+            pass
+
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+        self._wakeup.close()
+        self._wakeup_write.close()
+
+    def get(self, block=True, timeout=None):
+        """Returns the next event, or the exception that stopped the thread
+
+        Raises:
+            queue.Empty:    There isn't one and `block` is False, or `timeout` expired
+        """
+        return self.subscription.get(block, timeout)
+
+    def _connect(self, selector):
+        """Open the event socket and watch it with `selector`
+
+        Returns:
+            (socket, EventParser, bytes):   The socket, a parser for what it receives,
+                                            and anything that arrived with the upgrade.
+                                            The socket is None if close() was called.
+        """
+        event_socket, unparsed = self.airplay._open_event_socket(self._closed)
+        if event_socket is None:
+            return None, None, b''
+
+        selector.register(event_socket, selectors.EVENT_READ)
+
+        return event_socket, EventParser(), unparsed
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup, selectors.EVENT_READ)
+
+        event_socket = None
+        try:
+            event_socket, parser, data = self._connect(selector)
+
+            while event_socket is not None:
+                try:
+                    events = parser.feed(data)
+                except ProtocolError as exc:
+                    raise RuntimeError(
+                        "Unexpected request from AirPlay while processing events\n"
+                        "Error: {0}\nReceived:\n{1!r}".format(exc, data)
+                    )
+
+                # acknowledge them, all at once if several arrived together
+                data = b''
+                lost = False
+                if events:
+                    try:
+                        event_socket.sendall(EVENT_RESPONSE * len(events))
+                    except socket.error:
+                        lost = True
+
+                for event in events:
+                    self.subscription.deliver(self.airplay, event)
+
+                if not lost:
+                    for (key, _) in selector.select():
+                        if key.fileobj is self._wakeup:
+                            return
+
+                        try:
+                            data = event_socket.recv(self.airplay.RECV_SIZE)
+                        except socket.error:
+                            data = b''
+
+                    lost = not data
+
+                # the connection was lost, make a new one
+                if lost:
+                    selector.unregister(event_socket)
+                    event_socket.close()
+                    event_socket = None
+
+                    event_socket, parser, data = self._connect(selector)
+        except Exception as exc:
+            self.subscription.deliver(self.airplay, exc)
+        finally:
+            if event_socket is not None:
+                event_socket.close()
+            selector.close()
+
+
+class _Connection(object):
+    """The event connection to one device in an EventHub, and who it's for"""
+
+    def __init__(self, airplay):
+        self.airplay = airplay
+        self.subscribers = []
+
+        self.socket = None
+        self.parser = None
+
+        self.events = 0
+        self.reconnects = 0
+
+    @property
+    def name(self):
+        return '{0}:{1}'.format(self.airplay.host, self.airplay.port)
+
+
+class EventHub(object):
+    """Receive the events of many AirPlay devices on a single thread
+
+    Where AirPlay.events() needs a thread for each device, the hub waits on the
+    event sockets of every device it's given with one selector, and passes the
+    events of each device to its subscriptions (see Subscription) as they arrive.
+
+        >>> hub = EventHub()
+        >>> for ap in AirPlay.find():
+        ...     hub.subscribe(ap, lambda ap, event: print(ap.name, event['state']))
+
+    Connections that are lost are made again on a short lived thread, so a device
+    that's gone away doesn't hold up the rest.  If that fails, the exception is
+    given to the device's subscribers in place of an event and it's removed from
+    the hub.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+        # written to by _call_soon() to wake up the thread
+        self._wakeup, self._wakeup_write = socket.socketpair()
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+
+        # functions for the thread to run, so only it touches the selector and the sockets in it
+        self._calls = collections.deque()
+
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._closed = False
+
+        # the time from reading events to handing them to every subscriber
+        self._dispatched = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._callback_errors = 0
+
+        self.thread = threading.Thread(target=self._run, name='airplay-event-hub')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def subscribe(self, airplay, callback=None, categories=('video',), states=None, maxsize=0,
+                  overflow=Subscription.DROP_OLDEST):
+        """Start receiving the events of `airplay`
+
+        The first subscription for a device opens its event connection, on the
+        calling thread, see AirPlay._open_event_socket().
+
+        Args:
+            airplay(AirPlay):       The device
+            callback(callable):     Optional. Called on the hub's thread with the device and each event
+                                    (or the exception that ended them) instead of queueing them.
+                                    It shouldn't block, that holds up every other device.
+            categories(list):       Optional. The categories of events to receive, or None for all of them
+            states(list):           Optional. The states of events to receive, or None for all of them
+            maxsize(int):           Optional. The most events to queue, 0 for no limit
+            overflow(str):          Optional. What to do with events that arrive when the queue is full,
+                                    see Subscription
+
+        Returns:
+            Subscription:   The events.  Pass it to unsubscribe() to stop them
+
+        Raises:
+            RuntimeError:   The hub has been closed, or the device refused the event connection
+            ValueError:     `overflow` isn't valid
+        """
+        subscriber = Subscription(categories, states, callback, maxsize, overflow)
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('The event hub has been closed')
+
+            connection = self._connections.get(airplay)
+            opening = connection is None
+            if opening:
+                connection = self._connections[airplay] = _Connection(airplay)
+
+            connection.subscribers.append(subscriber)
+
+        if opening:
+            try:
+                self._open(connection)
+            except Exception:
+                with self._lock:
+                    self._connections.pop(airplay, None)
+                raise
+
+        return subscriber
+
+    def unsubscribe(self, airplay, subscriber):
+        """Stop giving `subscriber` the events of `airplay`, closing its connection if it was the last subscription"""
+        with self._lock:
+            connection = self._connections.get(airplay)
+            if connection is None or subscriber not in connection.subscribers:
+                return
+
+            connection.subscribers.remove(subscriber)
+            if connection.subscribers:
+                return
+
+            del self._connections[airplay]
+
+        self._call_soon(self._detach, connection)
+
+    def stats(self):
+        """Returns how much the hub is doing
+
+        Returns:
+            dict:   Keys are:
+                        events:             Events handed to subscriptions
+                        dispatch_latency:   The mean and max seconds from reading events to handing them over
+                        callback_errors:    Exceptions raised by callbacks, which are otherwise ignored
+                        devices:            For each device (as host:port) whether it's connected, its
+                                            subscribers, events, reconnects, the most events waiting in any
+                                            of its queues (queue_depth) and the events its queues dropped
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+
+        devices = {}
+        for connection in connections:
+            subscribers = list(connection.subscribers)
+            devices[connection.name] = {
+                'connected': connection.socket is not None,
+                'subscribers': len(subscribers),
+                'events': connection.events,
+                'reconnects': connection.reconnects,
+                'queue_depth': max([s.qsize() for s in subscribers] or [0]),
+                'dropped': sum(s.dropped for s in subscribers),
+            }
+
+        dispatched = self._dispatched
+        return {
+            'events': dispatched,
+            'dispatch_latency': {
+                'mean': self._latency_total / dispatched if dispatched else 0.0,
+                'max': self._latency_max,
+            },
+            'callback_errors': self._callback_errors,
+            'devices': devices,
+        }
+
+    def close(self):
+        """Stop receiving events and close every connection"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        self._call_soon(None)
+
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+        self._wakeup.close()
+        self._wakeup_write.close()
+
+    def _call_soon(self, func, *args):
+        """Have the hub's thread run func(*args), or stop if `func` is None"""
+        self._calls.append((func, args))
+
+        try:
+            self._wakeup_write.send(b'\0')
+        except socket.error:
+            pass
+
+    def _open(self, connection):
+        """Open the event connection to a device, and hand it to the hub's thread"""
+        event_socket, unparsed = connection.airplay._open_event_socket()
+        self._call_soon(self._attach, connection, event_socket, unparsed)
+
+    def _reopen(self, connection):
+        """Make a lost connection again, see _open()"""
+        try:
+            self._open(connection)
+        except Exception as exc:
+            self._call_soon(self._fail, connection, exc)
+
+    def _attach(self, connection, event_socket, unparsed):
+        with self._lock:
+            wanted = self._connections.get(connection.airplay) is connection
+
+        if not wanted:
+            event_socket.close()
+            return
+
+        connection.socket = event_socket
+        connection.parser = EventParser()
+        self._selector.register(event_socket, selectors.EVENT_READ, connection)
+
+        if unparsed:
+            self._receive(connection, unparsed, monotonic())
+
+    def _detach(self, connection):
+        if connection.socket is not None:
+            self._selector.unregister(connection.socket)
+            connection.socket.close()
+            connection.socket = None
+
+    def _fail(self, connection, exc):
+        """Give `exc` to the subscribers of a device, and remove it"""
+        self._detach(connection)
+
+        with self._lock:
+            if self._connections.get(connection.airplay) is connection:
+                del self._connections[connection.airplay]
+
+        self._dispatch(connection, exc)
+
+    def _lost(self, connection):
+        self._detach(connection)
+
+        with self._lock:
+            if self._closed or self._connections.get(connection.airplay) is not connection:
+                return
+
+        connection.reconnects += 1
+
+        thread = threading.Thread(
+            target=self._reopen,
+            args=(connection,),
+            name='airplay-event-hub-{0}'.format(connection.name)
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _dispatch(self, connection, event):
+        """Give `event` to the subscriptions that want it
+
+        Returns:
+            bool:   Any of them did
+        """
+        delivered = False
+        for subscriber in list(connection.subscribers):
+            try:
+                delivered = subscriber.deliver(connection.airplay, event) or delivered
+            except Exception:
+                self._callback_errors += 1
+                delivered = True
+
+        return delivered
+
+    def _receive(self, connection, data, received):
+        try:
+            events = connection.parser.feed(data)
+        except ProtocolError as exc:
+            self._fail(connection, RuntimeError(
+                "Unexpected request from AirPlay while processing events\n"
+                "Error: {0}\nReceived:\n{1!r}".format(exc, data)
+            ))
+            return
+
+        if not events:
+            return
+
+        try:
+            connection.socket.sendall(EVENT_RESPONSE * len(events))
+        except socket.error:
+            self._lost(connection)
+            return
+
+        for event in events:
+            if self._dispatch(connection, event):
+                connection.events += 1
+
+                latency = monotonic() - received
+                self._dispatched += 1
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+
+    def _run(self):
+        try:
+            while True:
+                for (key, _) in self._selector.select():
+                    if key.fileobj is self._wakeup:
+                        self._wakeup.recv(4096)
+
+                        while self._calls:
+                            func, args = self._calls.popleft()
+                            if func is None:
+                                return
+                            func(*args)
+                        continue
+
+                    connection = key.data
+
+                    # it may have been closed by a call run earlier in this pass
+                    if connection.socket is not key.fileobj:
+                        continue
+
+                    received = monotonic()
+                    try:
+                        data = connection.socket.recv(connection.airplay.RECV_SIZE)
+                    except socket.error:
+                        data = b''
+
+                    if data:
+                        self._receive(connection, data, received)
+                    else:
+                        self._lost(connection)
+        finally:
+            # connections that were opened too late to be attached
+            for (func, args) in self._calls:
+                if func == self._attach:
+                    args[1].close()
+
+            with self._lock:
+                connections, self._connections = list(self._connections.values()), {}
+
+            for connection in connections:
+                if connection.socket is not None:
+                    connection.socket.close()
+                    connection.socket = None
+
+            self._selector.close()
@@ -0,0 +1,214 @@
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+
+class GroupResult(object):
+    """The outcome of a command sent to one device in a DeviceGroup"""
+
+    __slots__ = ('device', 'value', 'error', 'started', 'latency')
+
+    def __init__(self, device, value=None, error=None, started=None, latency=None):
+        self.device = device
+        self.value = value
+        self.error = error
+
+        # when the command was started (monotonic clock) and how long it took
+        self.started = started
+        self.latency = latency
+
+    @property
+    def ok(self):
+        """bool: The command didn't raise an exception"""
+        return self.error is None
+
+    def __repr__(self):
+        return '<GroupResult {0}:{1} {2} in {3:.3f}s>'.format(
+            self.device.host,
+            self.device.port,
+            repr(self.error) if self.error is not None else repr(self.value),
+            self.latency or 0
+        )
+
+
+class _Worker(object):
+    """A thread that runs commands against a single device, in the order they are queued"""
+
+    def __init__(self, device):
+        self.device = device
+        self.queue = queue.Queue()
+
+        self.thread = threading.Thread(
+            target=self.run,
+            name='airplay-group-{0}:{1}'.format(device.host, device.port)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, method, args, kwargs, at=None):
+        """Queue a call to `method` on the device
+
+        Args:
+            method(str|callable):   The name of an AirPlay method, or a function that's passed the device
+            args(tuple):            Positional arguments for `method`
+            kwargs(dict):           Keyword arguments for `method`
+            at(float):              Optional. Don't start before this time on the monotonic clock
+
+        Returns:
+            (GroupResult, threading.Event): The result, which is filled in when the event is set
+        """
+        result = GroupResult(self.device)
+        done = threading.Event()
+        self.queue.put((method, args, kwargs, at, result, done))
+
+        return result, done
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            method, args, kwargs, at, result, done = job
+
+            if at is not None:
+                wait = at - monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+            result.started = monotonic()
+            try:
+                if callable(method):
+                    result.value = method(self.device, *args, **kwargs)
+                else:
+                    result.value = getattr(self.device, method)(*args, **kwargs)
+            except Exception as exc:
+                result.error = exc
+            result.latency = monotonic() - result.started
+
+            done.set()
+
+
+class DeviceGroup(object):
+    """Control several AirPlay devices at once
+
+    Each device gets its own worker thread and keeps its control connection, so a
+    command sent to the group reaches every device at about the same time and the
+    whole group answers in roughly one round trip, rather than one per device.
+
+        >>> group = DeviceGroup(AirPlay.find())
+        >>> for result in group.play('http://192.0.2.114/wall.mp4'):
+        ...     print(result.device.name, result.ok, result.latency)
+
+    Don't use the devices directly while they are in a group.
+    """
+
+    def __init__(self, devices):
+        """Create a group
+
+        Args:
+            devices(list):  AirPlay objects to control
+        """
+        self.devices = list(devices)
+        self._workers = [_Worker(device) for device in self.devices]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def close(self):
+        """Stop the worker threads.  The devices' connections are left open"""
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.stop()
+
+    def call(self, method, *args, **kwargs):
+        """Call `method` with the given arguments on every device concurrently
+
+        Exceptions raised for a device don't stop the others, they are returned in its result.
+
+        Args:
+            method(str|callable):   The name of an AirPlay method, or a function that's passed each device
+            *args:                  Positional arguments for `method`
+            **kwargs:               Keyword arguments for `method`
+
+        Returns:
+            list:   A GroupResult for each device, in the same order as `devices`
+
+        Raises:
+            RuntimeError:   The group has been closed
+        """
+        return self.call_at([None] * len(self.devices), method, *args, **kwargs)
+
+    def call_at(self, times, method, *args, **kwargs):
+        """Call `method` on each device at its own time, see call()
+
+        Args:
+            times(list):    When to start the call on each device, in the same order as `devices`,
+                            as times on the monotonic clock (time.monotonic() where available).
+                            None starts it right away.
+
+        Returns:
+            list:   A GroupResult for each device, in the same order as `devices`
+
+        Raises:
+            RuntimeError:   The group has been closed
+            ValueError:     There isn't a time for each device
+        """
+        if not self._workers and self.devices:
+            raise RuntimeError('The device group has been closed')
+
+        if len(times) != len(self.devices):
+            raise ValueError('Expected {0} times, got {1}'.format(len(self.devices), len(times)))
+
+        pending = [worker.submit(method, args, kwargs, at) for (worker, at) in zip(self._workers, times)]
+
+        for (_, done) in pending:
+            done.wait()
+
+        return [result for (result, _) in pending]
+
+    def play(self, url, position=0.0):
+        """Start playing `url` on every device, see AirPlay.play()"""
+        return self.call('play', url, position)
+
+    def rate(self, rate):
+        """Change the playback rate on every device, see AirPlay.rate()"""
+        return self.call('rate', rate)
+
+    def scrub(self, position=None):
+        """Get or seek the position on every device, see AirPlay.scrub()"""
+        return self.call('scrub', position)
+
+    def stop(self):
+        """Stop playback on every device, see AirPlay.stop()"""
+        return self.call('stop')
+
+    def playback_info(self):
+        """Get the playback state of every device, see AirPlay.playback_info()"""
+        return self.call('playback_info')
+
+    def server_info(self):
+        """Get information about every device, see AirPlay.server_info()"""
+        return self.call('server_info')
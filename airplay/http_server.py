@@ -1,7 +1,14 @@
+import binascii
+import collections
+import errno
+import mimetypes
 import os
-import posixpath
+import re
+import select
 import socket
-import sys
+import stat
+import threading
+import time
 
 try:
     from BaseHTTPServer import BaseHTTPRequestHandler
@@ -14,13 +21,118 @@ except ImportError:
     import socketserver as SocketServer
 
 try:
-    from urllib import unquote
+    from urllib import quote, unquote
 except ImportError:
-    from urllib.parse import unquote
+    from urllib.parse import quote, unquote
 
+try:
+    from email.utils import parsedate_tz, mktime_tz
+except ImportError:
+    from email.Utils import parsedate_tz, mktime_tz
+
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+from .access_log import AccessLog
+from .cache import BlockCache, StatCache
+from .pacing import Pacer
+from .readahead import ReadAhead, SEQUENTIAL, WILLNEED, advise
 from .vendor import httpheader
 
 
+def parse_http_date(value):
+    """Returns:
+        int:    The HTTP date in `value` as seconds since the epoch, or None if it can't be parsed
+    """
+    if value is None:
+        return None
+
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+
+    return mktime_tz(parsed)
+
+
+# The Range headers AirPlay devices actually send: bytes=a-b, bytes=a- and bytes=-n
+SIMPLE_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+def parse_byte_ranges(value, size):
+    """Parse the value of a Range header for a file `size` bytes long
+
+    Single byte ranges are parsed with a precompiled regular expression,
+    anything else falls back to the (much slower) vendored httpheader parser.
+
+    Args:
+        value(str):     The value of the Range header, may be empty
+        size(int):      The size of the file
+
+    Returns:
+        list:   (first, last) tuples, where last is the offset after the last byte of the range
+        None:   There was no Range header, or it could not be parsed.  Send the whole file.
+
+    Raises:
+        httpheader.RangeUnsatisfiableError: None of the ranges are within the file (416)
+        ValueError:                         The header is malformed, like bytes=2-1 (400)
+    """
+    match = SIMPLE_RANGE.match(value)
+
+    if match is None:
+        return _parse_byte_ranges(value, size)
+
+    first, last = match.groups()
+
+    if not first:
+        # bytes=- is a parse error, which means we ignore the header
+        if not last:
+            return None
+
+        # bytes=-n is the last n bytes of the file
+        if size == 0 or int(last) == 0:
+            raise httpheader.RangeUnsatisfiableError()
+
+        return [(max(size - int(last), 0), size)]
+
+    first = int(first)
+    if last:
+        last = int(last)
+        if first > last:
+            raise ValueError("Byte range does not satisfy first <= last.")
+        last = min(last, size - 1)
+    else:
+        last = size - 1
+
+    if first >= size:
+        raise httpheader.RangeUnsatisfiableError('Range begins beyond the file size.')
+
+    return [(first, last + 1)]
+
+
+def _parse_byte_ranges(value, size):
+    """Parse a Range header with httpheader, see parse_byte_ranges()"""
+    try:
+        ranges = httpheader.parse_range_header(value)
+    except httpheader.ParseError:
+        return None
+
+    ranges.fix_to_size(size)
+    ranges.coalesce()
+
+    # clamp ranges that extend past the end of the file, and drop empty ones (like bytes=-0)
+    result = []
+    for spec in ranges.range_specs:
+        if spec.first is not None and spec.first <= min(spec.last, size - 1):
+            result.append((spec.first, min(spec.last, size - 1) + 1))
+
+    if not result:
+        raise httpheader.RangeUnsatisfiableError('No ranges can be satisfied')
+
+    return result
+
+
 # Work around a bug in some versions of Python's SocketServer :(
 # http://bugs.python.org/issue14574
 def finish_fix(self, *args, **kwargs):  # pragma: no cover
@@ -35,61 +147,399 @@ def finish_fix(self, *args, **kwargs):  # pragma: no cover
 SocketServer.StreamRequestHandler.finish = finish_fix
 
 
-class RangeHTTPServer(BaseHTTPRequestHandler):
-    """This is a simple HTTP server that can be used to serve content to AirPlay devices.
+class MediaCatalog(object):
+    """The files a server is allowed to serve, indexed by the token used in their URL
 
-    It supports *single* Range requests which is all (it seems) is required.
+    Each file is served at /<token>/<filename>.  Tokens are random, so only
+    files that have been added can be requested.
     """
-    @classmethod
-    def start(cls, filename, allowed_host=None, queue=None):
-        """Start a SocketServer.TCPServer using this class to handle requests
+
+    def __init__(self):
+        # token => (path, set of allowed hosts)
+        self._files = {}
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._files)
+
+    def add(self, path, allowed_host=None):
+        """Add a file to the catalog
+
+        Adding a file that's already in the catalog returns its existing token.
 
         Args:
-            filename(str):  An absolute path to a single file to server
-                            Access will only be granted to this file
+            path(str):          An absolute path to the file
+            allowed_host(str):  Optional. Only this host (and the hosts of any other
+                                add() calls for this file) may request it.
+                                If None, any host may request it.
+
+        Returns:
+            str:    The URL path the file is served at
+        """
+        path = os.path.realpath(path)
+
+        with self._lock:
+            token = self._tokens.get(path)
+            if token is None:
+                token = binascii.hexlify(os.urandom(16)).decode('ascii')
+                self._tokens[path] = token
+                self._files[token] = (path, set())
 
-            allowed_host(str, optional):    If provided, only this host will
-                                            be allowed to access the server
+            hosts = self._files[token][1]
+            if allowed_host is None:
+                hosts.add(None)
+            else:
+                hosts.add(allowed_host)
 
-            queue(Queue.Queue, optional):   If provided, the host/port the server
-                                            binds to will be put() into this queue
+        return '/{0}/{1}'.format(token, quote(os.path.basename(path)))
 
+    def remove(self, path):
+        """Remove a file from the catalog
+
+        Returns:
+            bool:   False if the file was not in the catalog
+        """
+        with self._lock:
+            token = self._tokens.pop(os.path.realpath(path), None)
+            if token is None:
+                return False
+
+            del self._files[token]
+            return True
+
+    def lookup(self, url_path):
+        """Find the file for `url_path`
+
+        Args:
+            url_path(str):  The path from an HTTP request
+
+        Returns:
+            (str, set):     The path to the file on disk, and the hosts allowed to request it.
+                            If the set contains None, any host may request it.
+
+        Raises:
+            KeyError:       `url_path` is not in the catalog
         """
-        os.chdir(os.path.dirname(filename))
+        try:
+            token, name = unquote(url_path.split('?', 1)[0]).lstrip('/').split('/', 1)
+        except ValueError:
+            raise KeyError(url_path)
+
+        path, hosts = self._files[token]
+        if name != os.path.basename(path):
+            raise KeyError(url_path)
 
-        httpd = SocketServer.TCPServer(('', 0), cls)
-        httpd.allowed_filename = os.path.realpath(filename)
-        httpd.allowed_host = allowed_host
+        return path, hosts
 
-        if queue:
-            queue.put(httpd.server_address)
 
-        # BaseHTTPServer likes to log requests to stderr/out
-        # drop all that nose
-        with open('/dev/null', 'w') as fh:
-            sys.stdout = sys.stderr = fh
+class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A TCPServer that handles each connection in its own thread
+
+    At most `max_connections` connections are open at once.  When another one
+    arrives, the connection that has been waiting longest for its next request is
+    closed to make room, or if they are all busy handling requests, the new one
+    is answered with 503 Service Unavailable.  New connections are never kept
+    waiting, so idle persistent connections don't stop new clients being served.
+    """
+    daemon_threads = True
+
+    BUSY_RESPONSE = b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+    def __init__(self, server_address, handler_class, max_connections=16):
+        self.max_connections = max_connections
+
+        self._lock = threading.Lock()
+        self._connections = set()
+
+        # the connections waiting for their next request, longest waiting first
+        self._idle = collections.OrderedDict()
+
+        SocketServer.TCPServer.__init__(self, server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        """Start a thread to handle the connection, if there's room for it"""
+        with self._lock:
+            if len(self._connections) >= self.max_connections and not self._make_room():
+                refused = True
+            else:
+                refused = False
+                self._connections.add(request)
+
+        if refused:
             try:
-                httpd.serve_forever()
-            except:  # NOQA
+                request.sendall(self.BUSY_RESPONSE)
+            except socket.error:
                 pass
+            self.shutdown_request(request)
+            return
+
+        try:
+            SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+        except:  # NOQA
+            with self._lock:
+                self._connections.discard(request)
+            raise
+
+    def process_request_thread(self, request, client_address):
+        """Handle the connection, then stop counting it"""
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self._lock:
+                self._connections.discard(request)
+                self._idle.pop(request, None)
+
+    def _make_room(self):
+        """Close the connection that has been idle longest.  Call with the lock held
+
+        Returns:
+            bool:   False if no connection is idle
+        """
+        if not self._idle:
+            return False
+
+        request, _ = self._idle.popitem(last=False)
+        self._connections.discard(request)
+
+        # wakes its handler, which sees the connection has closed
+        try:
+            request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+        return True
+
+    def connection_idle(self, request):
+        """Note that `request` is waiting for its next request, so it may be closed to make room for another"""
+        with self._lock:
+            if request in self._connections:
+                self._idle[request] = None
+
+    def connection_busy(self, request):
+        """Note that `request` has started sending a request
+
+        Returns:
+            bool:   False if it was closed to make room for another connection
+        """
+        with self._lock:
+            self._idle.pop(request, None)
+            return request in self._connections
+
+
+class RangeHTTPServer(BaseHTTPRequestHandler):
+    """This is a simple HTTP server that can be used to serve content to AirPlay devices.
+
+    It supports single and multiple (multipart/byteranges) Range requests.
+    """
+
+    # Use os.sendfile() to move file data from the page cache straight to the
+    # socket when the platform has it.  read()/write() is used otherwise.
+    use_sendfile = hasattr(os, 'sendfile')
+
+    # The number of bytes to send per read()/write() or sendfile() at the start of a range.
+    # It doubles after every chunk, so short probes are answered quickly and long
+    # transfers make few system calls.
+    buffer_size = 8192
+
+    # The maximum number of bytes to copy per read()/write() when not using sendfile()
+    copy_size = 1024 * 1024
+
+    # The maximum number of bytes to hand to a single sendfile() call
+    sendfile_size = 4 * 1024 * 1024
+
+    # How much of a range to ask the kernel to start reading when we begin sending it,
+    # if the server isn't reading ahead of its clients
+    willneed_size = 2 * 1024 * 1024
+
+    # The pacing.Stream for the response being sent, if the server has a pacer
+    stream = None
+
+    # The readahead.Window following the response being sent, if the server reads ahead
+    window = None
+
+    # For the access log: when the request being handled was received, the status sent,
+    # when the first byte of the file was sent, and how much of it was sent
+    request_started = None
+    received = None
+    status = None
+    first_byte = None
+    bytes_sent = 0
+
+    @classmethod
+    def create(cls, address=('', 0), max_connections=16, keep_alive_timeout=15, cache_bytes=64 * 1024 * 1024,
+               rate_limit=None, client_rate_limit=None, read_ahead=None, access_log=None):
+        """Create a SocketServer.TCPServer using this class to handle requests
+
+        Files are only served once they have been added to the server's `catalog`.
+
+        Args:
+            address(tuple, optional):       The host/port to bind to.  By default any free port is used.
+
+            max_connections(int, optional): The number of connections to keep open.  When there are
+                                            more, the longest idle is closed.  If None, connections
+                                            are handled one at a time.
+
+            keep_alive_timeout(int, optional):  How long an idle HTTP/1.1 persistent connection is
+                                                kept open.  If None, the connection is closed
+                                                after each request.  Ignored if max_connections is None.
+
+            cache_bytes(int, optional): The most memory to use for caching the start and end of files.
+                                        If 0 or None, nothing is cached.
+
+            rate_limit(int, optional):          The most bytes per second to send to all clients,
+                                                shared fairly between them.  If None, there is no limit.
+
+            client_rate_limit(int, optional):   The most bytes per second to send to any one client.
+                                                If None, there is no limit.
+
+            read_ahead(int, optional):  How many bytes to read ahead of each client on a background thread.
+                                        If 0 or None, nothing is read ahead.
+
+            access_log(str, optional):  A file to append a JSON line to for every request.
+                                        If None, requests aren't logged.
+
+        Returns:
+            SocketServer.TCPServer: The server, ready for serve_forever() to be called
+        """
+        if max_connections is None:
+            httpd = SocketServer.TCPServer(address, cls)
+            httpd.keep_alive_timeout = None
+        else:
+            httpd = ThreadedTCPServer(address, cls, max_connections)
+            httpd.keep_alive_timeout = keep_alive_timeout
+
+        httpd.catalog = MediaCatalog()
+        httpd.block_cache = BlockCache(cache_bytes) if cache_bytes else None
+        httpd.stat_cache = StatCache()
+        httpd.pacer = Pacer(rate_limit, client_rate_limit) if (rate_limit or client_rate_limit) else None
+        httpd.readahead = ReadAhead(read_ahead) if read_ahead else None
+        httpd.access_log = AccessLog(access_log) if access_log else None
+
+        return httpd
+
+    def setup(self):
+        """Time out connections idle for the server's `keep_alive_timeout`, including before their first request"""
+        keep_alive_timeout = getattr(self.server, 'keep_alive_timeout', None)
+        if keep_alive_timeout:
+            self.timeout = keep_alive_timeout
+
+        BaseHTTPRequestHandler.setup(self)
 
     def handle(self):   # pragma: no cover
         """Handle requests.
 
-        We override this because we need to work around a bug in some
-        versions of Python's SocketServer :(
+        If the server has a `keep_alive_timeout` we speak HTTP/1.1 and keep
+        handling requests on this connection until the client closes it, or
+        it's idle for that many seconds.  Otherwise one request is handled and
+        the connection is closed.
+
+        We also need to work around a bug in some versions of Python's SocketServer :(
 
         See http://bugs.python.org/issue14574
         """
+        keep_alive_timeout = getattr(self.server, 'keep_alive_timeout', None)
+        if keep_alive_timeout:
+            self.protocol_version = 'HTTP/1.1'
+
+        # idle connections may be closed to make room for new ones
+        tracked = isinstance(self.server, ThreadedTCPServer)
 
         self.close_connection = 1
 
         try:
-            self.handle_one_request()
+            while True:
+                if tracked:
+                    self.server.connection_idle(self.request)
+
+                if not self.wait_for_request():
+                    break
+
+                if tracked and not self.server.connection_busy(self.request):
+                    break
+
+                self.handle_one_request()
+
+                if self.close_connection:
+                    break
         except socket.error as exc:
             if exc.errno == 32:
                 pass
 
+    def wait_for_request(self):
+        """Wait until the client starts sending a request
+
+        Returns:
+            bool:   False if the client closed the connection, or was idle for the keep alive timeout
+        """
+        peek = getattr(self.rfile, 'peek', None)
+        if peek is None:  # pragma: no cover
+            return self._wait_for_request_py2()
+
+        try:
+            return bool(peek(1))
+        except socket.timeout:
+            return False
+
+    def _wait_for_request_py2(self):  # pragma: no cover
+        """wait_for_request() for python 2, whose socket files can't peek"""
+        # a request that was sent along with the last one is already buffered
+        buffered = getattr(self.rfile, '_rbuf', None)
+        if buffered is None or buffered.tell():
+            return True
+
+        readable, _, _ = select.select([self.connection], [], [], self.connection.gettimeout())
+        return bool(readable)
+
+    def handle_one_request(self):
+        """Handle a single request, and add it to the server's access log"""
+        self.request_started = None
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        finally:
+            if self.request_started is not None:
+                self.log_access()
+
+    def parse_request(self):
+        """Start timing a request, once its request line has been read"""
+        self.request_started = monotonic()
+        self.received = time.time()
+        self.status = None
+        self.first_byte = None
+        self.bytes_sent = 0
+
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    def send_response(self, code, message=None):
+        """Send the response status line, remembering the status for the access log"""
+        self.status = code
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def log_access(self):
+        """Add the request that was just handled to the server's access log, if it has one"""
+        access_log = getattr(self.server, 'access_log', None)
+        if access_log is None:
+            return
+
+        now = monotonic()
+        headers = getattr(self, 'headers', None)
+
+        access_log.log({
+            'time': self.received,
+            'client': self.client_address[0],
+            'method': getattr(self, 'command', None),
+            'path': getattr(self, 'path', None),
+            'range': headers.get('range') if headers is not None else None,
+            'status': self.status,
+            'bytes': self.bytes_sent,
+            'ttfb': None if self.first_byte is None else self.first_byte - self.request_started,
+            'duration': now - self.request_started,
+        })
+
+    def log_message(self, format, *args):
+        """BaseHTTPServer likes to log requests to stderr, drop all that noise"""
+        pass
+
     def do_HEAD(self):
         """Handle a HEAD request"""
         try:
@@ -97,37 +547,42 @@ class RangeHTTPServer(BaseHTTPRequestHandler):
         except ValueError:
             return
 
+        etag, last_modified = self.server.stat_cache.validators(path, stats)
+        if self.not_modified(etag, last_modified, stats):
+            return
+
         self.send_response(200)
         self.send_header("Accept-Ranges", "bytes")
         self.send_header("Content-Length", stats.st_size)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
         self.end_headers()
 
     def do_GET(self):
-        """Handle a GET request with some support for the Range header"""
+        """Handle a GET request with support for the Range header
+
+        A single range is returned as a 206 response.  Multiple ranges are returned
+        as a multipart/byteranges 206 response, streamed directly from the file.
+
+        If-None-Match and If-Modified-Since are answered with 304 when the file hasn't
+        changed, and the Range header is ignored when If-Range doesn't match.
+        """
         try:
             path, stats = self.check_path(self.path)
         except ValueError:
             return
 
+        etag, last_modified = self.server.stat_cache.validators(path, stats)
+        if self.not_modified(etag, last_modified, stats):
+            return
+
         # assume we are sending the whole file first
         ranges = None
-        first = 0
-        last = stats.st_size
 
         # but see if a Range: header tell us differently
         try:
-            ranges = httpheader.parse_range_header(self.headers.get('range', ''))
-            ranges.fix_to_size(stats.st_size)
-            ranges.coalesce()
-
-            if not ranges.is_single_range():
-                self.send_error(400, "Multiple ranges not supported :(")
-                return
-
-            first = ranges.range_specs[0].first
-            last = ranges.range_specs[0].last + 1
-        except httpheader.ParseError:
-            pass
+            if self.if_range(etag, stats):
+                ranges = parse_byte_ranges(self.headers.get('range', ''), stats.st_size)
         except httpheader.RangeUnsatisfiableError:
             self.send_error(416, "Requested range not possible")
             return
@@ -137,45 +592,306 @@ class RangeHTTPServer(BaseHTTPRequestHandler):
             self.send_error(400, "Bad Request")
             return
 
+        # each part of the body is (part headers, first, last)
+        if ranges is None:
+            parts = [(b'', 0, stats.st_size)]
+            trailer = b''
+        elif len(ranges) == 1:
+            parts = [(b'', ranges[0][0], ranges[0][1])]
+            trailer = b''
+        else:
+            boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+            parts = [
+                (self.multipart_header(boundary, content_type, first, last, stats.st_size), first, last)
+                for (first, last) in ranges
+            ]
+            trailer = '\r\n--{0}--\r\n'.format(boundary).encode('ascii')
+
+        content_length = len(trailer) + sum(len(head) + last - first for (head, first, last) in parts)
+
         try:
             with open(path, 'rb') as fh:
                 if ranges is None:
                     self.send_response(200)
+                elif len(ranges) == 1:
+                    self.send_response(206)
+                    self.send_header("Content-Range", self.content_range(ranges[0][0], ranges[0][1], stats.st_size))
                 else:
                     self.send_response(206)
-                    self.send_header(
-                        "Content-Range",
-                        'bytes ' + str(first) + '-' + str(last - 1) + '/' + str(stats.st_size)
-                    )
+                    self.send_header("Content-Type", 'multipart/byteranges; boundary=' + boundary)
 
                 self.send_header("Accept-Ranges", "bytes")
-                self.send_header("Content-Length", last - first)
+                self.send_header("Content-Length", content_length)
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
                 self.end_headers()
 
-                # send the chunk they asked for
+                # send the chunks they asked for
                 # possibly the whole thing!
-                buffer_size = 8192
-
-                fh.seek(first, 0)
-                while buffer_size > 0:
-
-                    if first + buffer_size > last:
-                        buffer_size = last - first
-                    try:
-                        self.wfile.write(fh.read(buffer_size))
-                    except socket.error:
-                        break
-
-                    first = first + buffer_size
+                try:
+                    for head, first, last in parts:
+                        if head:
+                            self.wfile.write(head)
+
+                        # if we didn't send everything we promised, the connection can't be reused
+                        if self.send_range(fh, first, last) != last - first:
+                            self.close_connection = 1
+                            return
+
+                    if trailer:
+                        self.wfile.write(trailer)
+                except socket.error:
+                    self.close_connection = 1
         except EnvironmentError:
             self.send_error(500, "Internal Server Error")
             return
 
+    def not_modified(self, etag, last_modified, stats):
+        """Send a 304 response if If-None-Match or If-Modified-Since say the client's copy is current
+
+        Returns:
+            bool:   True if a 304 was sent and there is nothing else to do
+        """
+        if_none_match = self.headers.get('if-none-match')
+        if if_none_match is not None:
+            # weak comparison, so W/ prefixes are ignored
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            modified = '*' not in tags and etag not in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        else:
+            since = parse_http_date(self.headers.get('if-modified-since'))
+            modified = since is None or int(stats.st_mtime) > since
+
+        if modified:
+            return False
+
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+
+        return True
+
+    def if_range(self, etag, stats):
+        """Returns:
+            bool:   True if the Range header should be honoured, based on If-Range
+        """
+        if_range = self.headers.get('if-range')
+        if if_range is None:
+            return True
+
+        if_range = if_range.strip()
+
+        # an entity tag, which must match strongly
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return if_range == etag
+
+        return parse_http_date(if_range) == int(stats.st_mtime)
+
+    @staticmethod
+    def content_range(first, last, size):
+        """Returns the value of a Content-Range header for bytes `first` through `last` - 1"""
+        return 'bytes ' + str(first) + '-' + str(last - 1) + '/' + str(size)
+
+    @classmethod
+    def multipart_header(cls, boundary, content_type, first, last, size):
+        """Returns the delimiter and headers that precede a part of a multipart/byteranges body"""
+        return '\r\n--{0}\r\nContent-Type: {1}\r\nContent-Range: {2}\r\n\r\n'.format(
+            boundary,
+            content_type,
+            cls.content_range(first, last, size)
+        ).encode('ascii')
+
+    def send_range(self, fh, first, last):
+        """Send bytes `first` through `last` - 1 of `fh` to the client
+
+        If the server has a `block_cache`, the hot parts of the file are sent from it.
+        The rest is sent with os.sendfile() if it's enabled, falling back to copying
+        the data through python if the socket or file does not support it.
+
+        Args:
+            fh(file):       An open file object to send data from
+            first(int):     The offset of the first byte to send
+            last(int):      The offset after the last byte to send
+
+        Returns:
+            int:    The number of bytes sent.  This will be less than requested if the file was truncated.
+
+        Raises:
+            socket.error:   The client went away
+        """
+        pacer = getattr(self.server, 'pacer', None)
+        if pacer is None:
+            return self._send_range(fh, first, last)
+
+        with pacer.stream(self.client_address[0]) as self.stream:
+            try:
+                return self._send_range(fh, first, last)
+            finally:
+                self.stream = None
+
+    def _send_range(self, fh, first, last):
+        """Send `fh` from the cache and the file, see send_range()"""
+        stats = os.fstat(fh.fileno())
+
+        # the range will be read front to back, let the kernel know so it reads ahead aggressively
+        advise(fh.fileno(), first, last - first, SEQUENTIAL)
+
+        readahead = getattr(self.server, 'readahead', None)
+        if readahead is None:
+            advise(fh.fileno(), first, min(last - first, self.willneed_size), WILLNEED)
+            return self._send_cached_range(fh, stats, first, last)
+
+        self.window = readahead.window(self.client_address[0], fh.name, stats, first, last)
+        try:
+            return self._send_cached_range(fh, stats, first, last)
+        finally:
+            self.window = None
+
+    def _send_cached_range(self, fh, stats, first, last):
+        """Send `fh` from the block cache if the server has one, and the file"""
+        cache = getattr(self.server, 'block_cache', None)
+        if cache is None:
+            return self._send_uncached(fh, first, last) - first
+
+        offset = first
+        for (start, end, cacheable) in cache.split(first, last, stats.st_size):
+            if cacheable:
+                offset = self._send_cached(cache, fh, stats, start, end)
+            else:
+                offset = self._send_uncached(fh, start, end)
+
+            if offset != end:
+                break
+
+        return offset - first
+
+    def _send_uncached(self, fh, first, last):
+        """Send `fh` directly from the file
+
+        Returns:
+            int:    The offset we reached
+        """
+        if self.use_sendfile:
+            first = self._sendfile_range(fh, first, last)
+
+        return self._copy_range(fh, first, last)
+
+    def _send_cached(self, cache, fh, stats, first, last):
+        """Send `fh` block by block from `cache`
+
+        Returns:
+            int:    The offset we reached
+        """
+        block_size = cache.block_size
+
+        while first < last:
+            block, skip = divmod(first, block_size)
+            data = cache.read(fh, stats, block)[skip:last - block * block_size]
+            if not data:
+                break
+
+            self.wfile.write(data)
+            self.sent(len(data))
+            first += len(data)
+
+        return first
+
+    def _sendfile_range(self, fh, first, last):
+        """Send as much of `fh` as we can with os.sendfile()
+
+        Returns:
+            int:    The offset we reached.  If it's less than `last` sendfile() isn't
+                    supported for this socket/file, and the caller should copy the rest.
+        """
+        # headers may still be sitting in a buffer, they must go out first
+        self.wfile.flush()
+
+        out_fd = self.connection.fileno()
+        in_fd = fh.fileno()
+        timeout = self.connection.gettimeout()
+
+        size = self.buffer_size
+        while first < last:
+            count = min(size, last - first)
+            if self.stream is not None:
+                count = min(self.stream.chunk_size, count)
+
+            try:
+                sent = os.sendfile(out_fd, in_fd, first, count)
+            except (OSError, IOError) as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # the socket has a timeout so it's non-blocking under the hood
+                    # wait until it's writable again before trying again
+                    _, writable, _ = select.select([], [self.connection], [], timeout)
+                    if not writable:
+                        raise socket.timeout('timed out')
+                    continue
+                if exc.errno in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                    return first
+                raise
+
+            # the file was truncated out from under us
+            if sent == 0:
+                break
+
+            self.sent(sent)
+            first += sent
+            self.read_ahead(first)
+
+            size = min(size * 2, self.sendfile_size)
+
+        return first
+
+    def _copy_range(self, fh, first, last):
+        """Send `fh` by reading chunks into memory and writing them to the socket
+
+        Returns:
+            int:    The offset we reached
+        """
+        fh.seek(first, 0)
+        size = self.buffer_size
+        while first < last:
+            count = min(size, last - first)
+            if self.stream is not None:
+                count = min(self.stream.chunk_size, count)
+
+            chunk = fh.read(count)
+            if not chunk:
+                break
+
+            self.wfile.write(chunk)
+            self.sent(len(chunk))
+            first += len(chunk)
+            self.read_ahead(first)
+
+            size = min(size * 2, self.copy_size)
+
+        return first
+
+    def sent(self, count):
+        """Called after `count` bytes of the file are written
+
+        Counts them for the access log, and waits if the server's pacer says we're sending too fast
+        """
+        if self.first_byte is None:
+            self.first_byte = monotonic()
+        self.bytes_sent += count
+
+        if self.stream is not None:
+            self.stream.throttle(count)
+
+    def read_ahead(self, offset):
+        """Called as data is read from the file, keeps the server's read ahead in front of the client"""
+        if self.window is not None:
+            self.window.advance(offset)
+
     def check_path(self, path):
         """Verify that the client and server are allowed to access `path`
 
         Args:
-            path(str): The path from an HTTP rqeuest, it will be joined to os.getcwd()
+            path(str): The path from an HTTP rqeuest, it will be looked up in the server's catalog
 
         Returns:
             (str, stats):    An abosolute path to the file on disk, and the result of os.stat()
@@ -184,36 +900,29 @@ class RangeHTTPServer(BaseHTTPRequestHandler):
             ValueError:     The path could not be accessed (exception will say why)
         """
 
-        # get full path to file requested
-        path = posixpath.normpath(unquote(path))
-        path = os.path.join(os.getcwd(), path.lstrip('/'))
-
-        # if we have an allowed host, then only allow access from it
-        if self.server.allowed_host and self.client_address[0] != self.server.allowed_host:
-            self.send_error(400, "Bad Request")
-            raise ValueError('Client is not allowed')
-
-        # don't do directory indexing
-        if os.path.isdir(path):
+        # if they try to request something else, don't serve it
+        try:
+            path, allowed_hosts = self.server.catalog.lookup(path)
+        except KeyError:
             self.send_error(400, "Bad Request")
-            raise ValueError("Requested path is a directory")
+            raise ValueError("Requested path was not in the catalog")
 
-        # if they try to request something else, don't serve it
-        if path != self.server.allowed_filename:
+        # only allow access from the hosts the file was added for
+        if None not in allowed_hosts and self.client_address[0] not in allowed_hosts:
             self.send_error(400, "Bad Request")
-            raise ValueError("Requested path was not in the allowed list")
+            raise ValueError('Client is not allowed')
 
         # make sure we can stat and open the file
+        # this is cached, so repeated requests for the same file are cheap
         try:
-            stats = os.stat(path)
-            fh = open(path, 'rb')
+            stats = self.server.stat_cache.stat(path)
         except (EnvironmentError) as exc:
             self.send_error(500, "Internal Server Error")
             raise ValueError("Unable to access the path: {0}".format(exc))
-        finally:
-            try:
-                fh.close()
-            except NameError:
-                pass
+
+        # don't do directory indexing
+        if stat.S_ISDIR(stats.st_mode):
+            self.send_error(400, "Bad Request")
+            raise ValueError("Requested path is a directory")
 
         return path, stats
@@ -0,0 +1,361 @@
+import atexit
+import os
+import sys
+import threading
+
+from multiprocessing import Pipe, Process
+
+from .http_server import RangeHTTPServer
+
+
+def execute(httpd, command, *args):
+    """Run `command` against a server created by RangeHTTPServer.create()
+
+    Args:
+        httpd(SocketServer.TCPServer):  The server
+        command(str):                   One of 'register', 'unregister' or 'stats'
+        *args:                          The arguments for `command`
+
+    Returns:
+        Mixed:  The result of the command
+    """
+    if command == 'register':
+        return httpd.catalog.add(*args)
+
+    if command == 'unregister':
+        for path in args:
+            httpd.stat_cache.invalidate(os.path.realpath(path))
+        return httpd.catalog.remove(*args)
+
+    if command == 'stats':
+        return {
+            'files': len(httpd.catalog),
+            'block_cache': httpd.block_cache.stats() if httpd.block_cache else None,
+            'pacer': httpd.pacer.stats() if httpd.pacer else None,
+            'readahead': httpd.readahead.stats() if httpd.readahead else None,
+            'access_log': httpd.access_log.stats() if httpd.access_log else None,
+        }
+
+    raise ValueError('Unknown command: {0}'.format(command))
+
+
+def close(httpd):
+    """Stop a server created by RangeHTTPServer.create() listening, and stop its background threads
+
+    Args:
+        httpd(SocketServer.TCPServer):  The server
+    """
+    httpd.server_close()
+
+    if httpd.readahead:
+        httpd.readahead.close()
+
+    if httpd.access_log:
+        httpd.access_log.close()
+
+
+def run_process(conn, options):  # pragma: no cover
+    """Run a media server, taking commands from the parent process over `conn`
+
+    Args:
+        conn(Connection):   One end of a multiprocessing.Pipe
+        options(dict):      Keyword arguments for RangeHTTPServer.create()
+    """
+    try:
+        httpd = RangeHTTPServer.create(**options)
+    except Exception as exc:
+        conn.send((False, exc))
+        return
+
+    server = threading.Thread(target=httpd.serve_forever)
+    server.daemon = True
+    server.start()
+
+    conn.send((True, httpd.server_address))
+
+    # BaseHTTPServer likes to log requests to stderr/out
+    # drop all that nose
+    stdout, stderr = sys.stdout, sys.stderr
+    with open(os.devnull, 'w') as fh:
+        sys.stdout = sys.stderr = fh
+
+        try:
+            while True:
+                try:
+                    command = conn.recv()
+                except (EOFError, KeyboardInterrupt):
+                    break
+
+                if command[0] == 'stop':
+                    break
+
+                try:
+                    conn.send((True, execute(httpd, *command)))
+                except Exception as exc:
+                    conn.send((False, exc))
+        finally:
+            # multiprocessing flushes them as the process exits, they can't be left closed
+            sys.stdout, sys.stderr = stdout, stderr
+
+    # the serving thread dies with the process, we just need to stop listening
+    close(httpd)
+
+
+class MediaServer(object):
+    """A long lived HTTP server that serves a catalog of local files to AirPlay devices
+
+    The server is started once; files are registered with it as they are
+    needed, each getting its own URL.  It can run in its own process, or on a
+    background thread in this process, which starts much faster.
+
+    A single server is shared by all AirPlay instances, see MediaServer.shared()
+    """
+    MODES = ('process', 'thread')
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_connections=16, keep_alive_timeout=15, cache_bytes=64 * 1024 * 1024,
+                 rate_limit=None, client_rate_limit=None, read_ahead=None, access_log=None, mode='process'):
+        """Create a media server.  It won't be running until start() is called
+
+        Args:
+            max_connections(int):       Optional. The number of connections kept open, the longest idle is
+                                        closed to make room for more.
+                                        If None, connections are handled one at a time.
+            keep_alive_timeout(int):    Optional. Seconds an idle persistent connection is kept open.
+                                        If None, connections are closed after each request.
+            cache_bytes(int):           Optional. The most memory to use to cache frequently read parts of files.
+                                        If 0 or None, nothing is cached.
+            rate_limit(int):            Optional. The most bytes per second to send to all clients,
+                                        shared fairly between them.  If None, there is no limit.
+            client_rate_limit(int):     Optional. The most bytes per second to send to any one client.
+                                        If None, there is no limit.
+            read_ahead(int):            Optional. How many bytes to read ahead of each client on a background thread.
+                                        If 0 or None, nothing is read ahead.
+            access_log(str):            Optional. A file to append a JSON line to for every request.
+                                        If None, requests aren't logged.
+            mode(str):                  Optional. 'process' to run the server in a child process,
+                                        or 'thread' to run it on a background thread in this process.
+
+        Raises:
+            ValueError: `mode` is not valid
+        """
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of: {0}'.format(', '.join(self.MODES)))
+
+        self.mode = mode
+        self.options = {
+            'max_connections': max_connections,
+            'keep_alive_timeout': keep_alive_timeout,
+            'cache_bytes': cache_bytes,
+            'rate_limit': rate_limit,
+            'client_rate_limit': client_rate_limit,
+            'read_ahead': read_ahead,
+            'access_log': access_log,
+        }
+
+        self.server_address = None
+
+        # set once the server is accepting connections
+        self.ready = threading.Event()
+
+        self._process = None
+        self._conn = None
+        self._thread = None
+        self._httpd = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @classmethod
+    def shared(cls, **options):
+        """Return the media server shared by all AirPlay instances, starting it if needed
+
+        Args:
+            **options:  Passed to MediaServer() if the server has to be started.
+                        They are ignored if it's already running.
+
+        Returns:
+            MediaServer:    The running server
+        """
+        with cls._shared_lock:
+            if cls._shared is None or not cls._shared.running:
+                cls._shared = cls(**options)
+                cls._shared.start()
+
+            return cls._shared
+
+    @classmethod
+    def stop_shared(cls):
+        """Stop the shared media server if it's running"""
+        with cls._shared_lock:
+            if cls._shared is not None:
+                cls._shared.stop()
+                cls._shared = None
+
+    @property
+    def running(self):
+        """bool: The server is running"""
+        if self._thread is not None:
+            return self._thread.is_alive()
+
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        """Start the server and wait until it is accepting connections
+
+        Raises:
+            RuntimeError:       The server has already been started
+            EnvironmentError:   The server could not be started
+        """
+        with self._lock:
+            if self._process is not None or self._thread is not None:
+                raise RuntimeError('The media server has already been started')
+
+            if self.mode == 'thread':
+                self._start_thread()
+            else:
+                self._start_process()
+
+    def _start_process(self):
+        """Start the server in a child process"""
+        self._conn, child_conn = Pipe()
+        self._process = Process(target=run_process, args=(child_conn, self.options))
+        self._process.daemon = True
+        self._process.start()
+
+        # only the child should hold its end open, so we see EOF if it dies
+        child_conn.close()
+
+        try:
+            ok, result = self._conn.recv()
+        except EOFError:
+            ok, result = False, EnvironmentError('The media server exited before it started')
+
+        if not ok:
+            self._process.join(5)
+            self._conn.close()
+            self._process = self._conn = None
+            raise result
+
+        self.server_address = result
+        self.ready.set()
+
+        # make sure the child process doesn't outlive us
+        atexit.register(self.stop)
+
+    def _start_thread(self):
+        """Start the server on a background thread"""
+        errors = []
+
+        def run():
+            try:
+                self._httpd = RangeHTTPServer.create(**self.options)
+            except Exception as exc:
+                errors.append(exc)
+                self.ready.set()
+                return
+
+            self.server_address = self._httpd.server_address
+            self.ready.set()
+
+            self._httpd.serve_forever(poll_interval=.1)
+
+        self._thread = threading.Thread(target=run, name='airplay-media-server')
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.ready.wait()
+
+        if errors:
+            self._thread = None
+            self.ready.clear()
+            raise errors[0]
+
+    def stop(self):
+        """Stop the server"""
+        with self._lock:
+            if self._thread is not None:
+                self._httpd.shutdown()
+                close(self._httpd)
+                self._thread.join()
+                self._thread = self._httpd = None
+
+            if self._process is not None:
+                try:
+                    self._conn.send(('stop',))
+                except (EnvironmentError, ValueError):
+                    pass
+
+                self._process.join(5)
+                if self._process.is_alive():
+                    self._process.terminate()
+
+                self._conn.close()
+                self._process = self._conn = None
+
+            self.ready.clear()
+
+    def _call(self, *command):
+        """Run `command` on the server and return its result"""
+        with self._lock:
+            if self._thread is not None:
+                return execute(self._httpd, *command)
+
+            if self._process is None:
+                raise RuntimeError('The media server is not running')
+
+            try:
+                self._conn.send(command)
+                ok, result = self._conn.recv()
+            except (EOFError, EnvironmentError):
+                # the child process died, there's nothing left to stop
+                self._conn.close()
+                self._process = self._conn = None
+                self.ready.clear()
+                raise RuntimeError('The media server is not running')
+
+        if not ok:
+            raise result
+
+        return result
+
+    def register(self, path, allowed_host=None):
+        """Add a file to the catalog of files this server will serve
+
+        Args:
+            path(str):          An absolute path to a local file
+            allowed_host(str):  Optional. If provided, only this host (and those of any other
+                                calls to register() for this file) may request the file
+
+        Returns:
+            str:    The path of the URL the file is served at
+
+        Raises:
+            ValueError: `path` is not a file
+        """
+        if not os.path.isfile(path):
+            raise ValueError('Not a file: {0}'.format(path))
+
+        return self._call('register', path, allowed_host)
+
+    def unregister(self, path):
+        """Stop serving a file
+
+        Returns:
+            bool:   False if the file was not being served
+        """
+        return self._call('unregister', path)
+
+    def stats(self):
+        """Returns:
+            dict:   The number of files being served, the paced streams, and the
+                    block cache, read ahead and access log counters
+        """
+        return self._call('stats')
@@ -0,0 +1,167 @@
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+try:
+    from sys import intern
+except ImportError:  # pragma: no cover
+    pass
+
+
+def _compact(value):
+    """Share the keys of the dicts in `value` between every plist, instead of each having its own copies"""
+    if isinstance(value, dict):
+        return {intern(str(kk)): _compact(vv) for (kk, vv) in value.items()}
+
+    if isinstance(value, list):
+        return [_compact(vv) for vv in value]
+
+    return value
+
+
+class _Record(Mapping):
+    """A plist from an AirPlay device, with the fields that are used most kept in slots
+
+    The fields in FIELDS (and PARAMS, from the params dict of the plist) are
+    attributes.  The rest are kept as they were, and the whole plist is only
+    put back together when it's asked for, by `raw` or by using the record
+    like the dict it was made from.
+
+    The slots only save memory on python 3.  On python 2, Mapping doesn't
+    define __slots__, so every record has a __dict__ as well.
+    """
+
+    __slots__ = ('_extra', '_params')
+
+    # (attribute, key) for the fields at the top level of the plist, and in its params
+    FIELDS = ()
+    PARAMS = ()
+
+    def __init__(self, **fields):
+        """
+        Args:
+            **fields:   The value of each attribute, the rest are None
+
+        Raises:
+            TypeError:  One of `fields` isn't an attribute
+        """
+        for (attribute, _) in self.FIELDS + self.PARAMS:
+            setattr(self, attribute, fields.pop(attribute, None))
+
+        if fields:
+            raise TypeError('Unexpected fields: {0}'.format(', '.join(sorted(fields))))
+
+        # whatever else was in the plist, or None if there wasn't anything
+        self._extra = None
+        self._params = None
+
+    @classmethod
+    def from_plist(cls, plist):
+        """Make a record from a decoded plist"""
+        record = cls.__new__(cls)
+
+        extra = dict(plist)
+        for (attribute, key) in cls.FIELDS:
+            value = extra.pop(key, None)
+
+            # the same few categories and states are sent over and over
+            if isinstance(value, str):
+                value = intern(value)
+            setattr(record, attribute, value)
+
+        params = extra.pop('params', None) if cls.PARAMS else None
+        if params is not None:
+            params = dict(params)
+        for (attribute, key) in cls.PARAMS:
+            setattr(record, attribute, params.pop(key, None) if params else None)
+
+        record._extra = _compact(extra) if extra else None
+        record._params = _compact(params) if params else None
+
+        return record
+
+    @property
+    def raw(self):
+        """dict: The plist this was made from"""
+        plist = {}
+        for (attribute, key) in self.FIELDS:
+            value = getattr(self, attribute)
+            if value is not None:
+                plist[key] = value
+
+        if self._extra:
+            plist.update(self._extra)
+
+        params = dict(self._params or {})
+        for (attribute, key) in self.PARAMS:
+            value = getattr(self, attribute)
+            if value is not None:
+                params[key] = value
+
+        if params:
+            plist['params'] = params
+
+        return plist
+
+    def __getitem__(self, key):
+        for (attribute, name) in self.FIELDS:
+            if name == key:
+                value = getattr(self, attribute)
+                if value is None:
+                    raise KeyError(key)
+                return value
+
+        return self.raw[key]
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __repr__(self):
+        return '<{0} {1!r}>'.format(type(self).__name__, self.raw)
+
+
+class PlaybackEvent(_Record):
+    """An event sent by an AirPlay device, see AirPlay.events()
+
+    It can be used like the dict the device sent, or through its attributes:
+
+        >>> event.state, event['state']
+        ('playing', 'playing')
+        >>> event.position, event['params']['position']
+        (14.4, 14.4)
+
+    The position, duration and rate are only sent in playing events, they're
+    None otherwise.
+    """
+
+    __slots__ = ('category', 'state', 'session_id', 'reason', 'position', 'duration', 'rate')
+
+    FIELDS = (('category', 'category'), ('state', 'state'), ('session_id', 'sessionID'), ('reason', 'reason'))
+    PARAMS = (('position', 'position'), ('duration', 'duration'), ('rate', 'rate'))
+
+
+class PlaybackInfo(_Record):
+    """The result of AirPlay.playback_info()
+
+    It can be used like the dict the device sent, or through its attributes,
+    which are None if the device didn't send them:
+
+        >>> info.position, info['position']
+        (14.4, 14.4)
+        >>> info['loadedTimeRanges']
+        [{'start': 0.0, 'duration': 60.0}]
+    """
+
+    __slots__ = ('duration', 'position', 'rate', 'ready_to_play', 'likely_to_keep_up')
+
+    FIELDS = (
+        ('duration', 'duration'),
+        ('position', 'position'),
+        ('rate', 'rate'),
+        ('ready_to_play', 'readyToPlay'),
+        ('likely_to_keep_up', 'playbackLikelyToKeepUp'),
+    )
@@ -0,0 +1,177 @@
+import threading
+import time
+
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+
+class TokenBucket(object):
+    """Limit a flow of bytes to `rate` bytes per second, allowing bursts of up to `burst` bytes"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def consume(self, amount):
+        """Take `amount` tokens from the bucket
+
+        Returns:
+            float:  The number of seconds to wait before sending more data
+        """
+        now = monotonic()
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+
+        if self.tokens >= 0:
+            return 0
+
+        return -self.tokens / self.rate
+
+
+class Stream(object):
+    """A single paced transfer to a client, see Pacer.stream()"""
+
+    # how much of a stream's rate may be sent at once, in seconds
+    BURST = .25
+
+    # the smallest and largest amount of data sent between pauses
+    MIN_CHUNK = 16 * 1024
+    MAX_CHUNK = 4 * 1024 * 1024
+
+    def __init__(self, pacer, client):
+        self.pacer = pacer
+        self.client = client
+
+        # the most this stream's client may use, before sharing with other streams
+        self.limit = float('inf')
+
+        self.bucket = None
+
+    @property
+    def rate(self):
+        """float: The number of bytes per second this stream may send"""
+        return self.bucket.rate if self.bucket else float('inf')
+
+    @rate.setter
+    def rate(self, rate):
+        if rate == float('inf'):
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rate, max(rate * self.BURST, self.MIN_CHUNK))
+        else:
+            self.bucket.rate = rate
+            self.bucket.burst = max(rate * self.BURST, self.MIN_CHUNK)
+
+    @property
+    def chunk_size(self):
+        """int: How much data to send before calling throttle() again"""
+        bucket = self.bucket
+        if bucket is None:
+            return self.MAX_CHUNK
+
+        return int(min(max(bucket.burst, self.MIN_CHUNK), self.MAX_CHUNK))
+
+    def throttle(self, amount):
+        """Call after sending `amount` bytes, sleeps to keep the stream within its rate"""
+        bucket = self.bucket
+        if bucket is None:
+            return
+
+        delay = bucket.consume(amount)
+        if delay:
+            time.sleep(delay)
+
+    def __enter__(self):
+        self.pacer.add(self)
+        return self
+
+    def __exit__(self, *args):
+        self.pacer.remove(self)
+
+
+class Pacer(object):
+    """Pace the data sent by a server so clients share the available bandwidth fairly
+
+    The total rate is shared equally between active streams (max-min fair share),
+    and the streams from a single client never add up to more than `client_rate`.
+    """
+
+    def __init__(self, rate=None, client_rate=None):
+        """Create a pacer
+
+        Args:
+            rate(float):        Optional. The most bytes per second to send to all clients.
+            client_rate(float): Optional. The most bytes per second to send to any one client.
+        """
+        self.total_rate = float(rate) if rate else float('inf')
+        self.client_rate = float(client_rate) if client_rate else float('inf')
+
+        self._streams = []
+        self._lock = threading.Lock()
+
+    def stream(self, client):
+        """Create a stream of data to be sent to `client`
+
+        Use it as a context manager around the transfer, calling throttle() after each write:
+
+            with pacer.stream(client) as stream:
+                stream.throttle(len(data))
+
+        Args:
+            client(str):    The host the data is being sent to
+
+        Returns:
+            Stream
+        """
+        return Stream(self, client)
+
+    def add(self, stream):
+        """Start pacing `stream`"""
+        with self._lock:
+            self._streams.append(stream)
+            self._rebalance()
+
+    def remove(self, stream):
+        """Stop pacing `stream`"""
+        with self._lock:
+            self._streams.remove(stream)
+            self._rebalance()
+
+    def stats(self):
+        """Returns:
+            dict:   The active streams and the rate each is allowed
+        """
+        with self._lock:
+            return {
+                'rate': self.total_rate,
+                'client_rate': self.client_rate,
+                'streams': [(stream.client, stream.rate) for stream in self._streams],
+            }
+
+    def _rebalance(self):
+        """Recalculate the rate of every stream, must be called with the lock held"""
+        # streams from the same client share that client's limit
+        clients = {}
+        for stream in self._streams:
+            clients[stream.client] = clients.get(stream.client, 0) + 1
+
+        for stream in self._streams:
+            stream.limit = self.client_rate / clients[stream.client]
+
+        # hand out the total rate, streams that are limited to less than an
+        # equal share leave the rest for the others to split
+        remaining = self.total_rate
+        streams = sorted(self._streams, key=lambda stream: stream.limit)
+        for ii, stream in enumerate(streams):
+            rate = min(stream.limit, remaining / (len(streams) - ii))
+            stream.rate = rate
+
+            if rate != float('inf'):
+                remaining -= rate
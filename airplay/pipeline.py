@@ -0,0 +1,197 @@
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+from .protocol import (
+    BINARY_PLIST, accept_headers, build_request, decode_response, play_body, playback_info_result, property_body,
+    property_result, property_uri, require_binary_plists, scrub_result
+)
+
+
+class PipelineResult(object):
+    """The result of a command queued on a Pipeline, available once the pipeline has been executed"""
+
+    _unset = object()
+
+    def __init__(self, transform=None):
+        self._transform = transform
+        self._value = self._unset
+        self._error = None
+
+    @property
+    def done(self):
+        """bool: The response to the command has been received"""
+        return self._value is not self._unset or self._error is not None
+
+    @property
+    def value(self):
+        """Mixed: What the equivalent AirPlay method would have returned
+
+        Raises:
+            RuntimeError:   The pipeline hasn't been executed yet
+            Exception:      Whatever the equivalent AirPlay method would have raised
+        """
+        if self._error is not None:
+            raise self._error
+
+        if self._value is self._unset:
+            raise RuntimeError('The pipeline has not been executed yet')
+
+        return self._value
+
+    def _set(self, value):
+        """Store the decoded response"""
+        try:
+            self._value = self._transform(value) if self._transform else value
+        except Exception as exc:
+            self._error = exc
+
+    def _fail(self, exc):
+        """Store the error raised decoding the response"""
+        self._error = exc
+
+
+class Pipeline(object):
+    """Send several commands to an AirPlay device in one write, see AirPlay.pipeline()
+
+    The methods mirror those on AirPlay, but return a PipelineResult instead of
+    waiting for the device to respond.  The responses are read in order when the
+    pipeline is executed.
+    """
+
+    def __init__(self, airplay):
+        self.airplay = airplay
+
+        # (request bytes, PipelineResult, endpoint) for each queued command
+        self._queued = []
+
+    def __len__(self):
+        return len(self._queued)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # don't send anything if the block failed
+        if exc_type is None:
+            self.execute()
+        else:
+            self._queued = []
+
+    def command(self, uri, method='GET', body='', _transform=None, **kwargs):
+        """Queue a request, see AirPlay._command() for the arguments
+
+        Returns:
+            PipelineResult: Holds what AirPlay._command() would have returned once the pipeline is executed
+        """
+        kwargs['headers'] = accept_headers(method, kwargs.get('headers'), self.airplay.ACCEPT_BINARY_PLISTS)
+
+        result = PipelineResult(_transform)
+        self._queued.append((build_request(uri, method, body, **kwargs), result, method + ' ' + uri.split('?', 1)[0]))
+
+        return result
+
+    def execute(self):
+        """Send the queued commands and read their responses
+
+        All of the responses are read, even if some of them can't be decoded,
+        so the control connection stays in step with the device.  Pipelines
+        aren't retried if the connection fails, it's reconnected for the next
+        command.
+
+        Returns:
+            list:   The PipelineResult for each command, in the order they were queued
+
+        Raises:
+            socket.error:           The connection failed
+            protocol.ProtocolError: The device sent something we can't parse
+            Exception:              The first error raised decoding a response, once they have all been read
+        """
+        queued, self._queued = self._queued, []
+        if not queued:
+            return []
+
+        stats = self.airplay._stats
+        responses = []
+        start = monotonic()
+        try:
+            self.airplay._ensure_connected()
+
+            data = b''.join(request for (request, _, _) in queued)
+            self.airplay.control_socket.sendall(data)
+            stats.sent(len(data))
+
+            # each command's latency is until its response has arrived
+            for (_, _, endpoint) in queued:
+                responses.append(self.airplay._read_response())
+                stats.command(endpoint, monotonic() - start, error=responses[-1].status >= 400)
+        except Exception:
+            # the rest of the responses can't be matched to their commands, so start again on a new connection
+            self.airplay._disconnect()
+            for (_, _, endpoint) in queued[len(responses):]:
+                stats.command(endpoint, monotonic() - start, error=True)
+            raise
+
+        self.airplay._last_used = monotonic()
+
+        results = []
+        error = None
+        for ((_, result, _), resp) in zip(queued, responses):
+            try:
+                result._set(decode_response(resp))
+            except Exception as exc:
+                result._fail(exc)
+
+            if error is None and result._error is not None:
+                error = result._error
+
+            results.append(result)
+
+        if error is not None:
+            raise error
+
+        return results
+
+    def get_property(self, name):
+        """Queue AirPlay.get_property()"""
+        require_binary_plists()
+
+        return self.command(property_uri('getProperty', name), _transform=property_result)
+
+    def set_property(self, name, value):
+        """Queue AirPlay.set_property()"""
+        return self.command(
+            property_uri('setProperty', name), 'PUT', property_body(value),
+            headers={'Content-Type': BINARY_PLIST}, _transform=property_result
+        )
+
+    def server_info(self):
+        """Queue AirPlay.server_info()"""
+        return self.command('/server-info')
+
+    def play(self, url, position=0.0):
+        """Queue AirPlay.play()"""
+        return self.command('/play', 'POST', play_body(url, position))
+
+    def rate(self, rate):
+        """Queue AirPlay.rate()"""
+        return self.command('/rate', 'POST', value=float(rate))
+
+    def stop(self):
+        """Queue AirPlay.stop()"""
+        return self.command('/stop', 'POST')
+
+    def playback_info(self):
+        """Queue AirPlay.playback_info()"""
+        return self.command('/playback-info', _transform=playback_info_result)
+
+    def scrub(self, position=None):
+        """Queue AirPlay.scrub()
+
+        Seeking queues the POST that changes the position, followed by the GET that reads it back
+        """
+        if position:
+            self.command('/scrub', 'POST', position=position)
+
+        return self.command('/scrub', _transform=scrub_result)
@@ -0,0 +1,155 @@
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+from .models import PlaybackEvent
+
+
+class PlaybackState(object):
+    """A local model of what an AirPlay device is playing, that predicts the position instead of asking for it
+
+    The position is extrapolated from the last known position, the playback
+    rate and the time since, so reading it costs nothing.  Events from the
+    device keep the state and rate up to date, and refresh() checks the
+    prediction against scrub() every `interval` seconds, only moving it when
+    it's out by more than `tolerance`.
+
+        >>> state = PlaybackState(ap)
+        >>> ap.play(url)
+        >>> while True:
+        ...     for event in ap.events(block=False):
+        ...         state.update(event)
+        ...     state.refresh()
+        ...     print(state.state, state.position, state.duration)
+
+    """
+
+    # the playback rate in each state
+    RATES = {
+        'playing': 1.0,
+        'paused': 0.0,
+        'loading': 0.0,
+        'stopped': 0.0,
+    }
+
+    def __init__(self, airplay=None, interval=5.0, tolerance=0.5):
+        """
+        Args:
+            airplay(AirPlay):   Optional. The device to check the position with, see refresh()
+            interval(float):    Optional. The most seconds refresh() waits between checks
+            tolerance(float):   Optional. How many seconds out the prediction can be before it's corrected
+        """
+        self.airplay = airplay
+        self.interval = interval
+        self.tolerance = tolerance
+
+        self.state = 'loading'
+        self.rate = 0.0
+        self.duration = None
+
+        # how far out the prediction was when it was last checked
+        self.drift = None
+
+        # the position was `_position` at `_when` on the monotonic clock
+        self._position = None
+        self._when = None
+
+        # when the device was last asked for the position
+        self._checked = None
+
+    @property
+    def position(self):
+        """float: The predicted position in seconds, or None if it isn't known yet"""
+        return self.predict(monotonic())
+
+    def predict(self, when):
+        """Returns the predicted position at `when` on the monotonic clock, or None if it isn't known yet"""
+        if self._position is None:
+            return None
+
+        position = max(self._position + self.rate * (when - self._when), 0.0)
+        if self.duration:
+            position = min(position, self.duration)
+
+        return position
+
+    def sample(self, position, duration=None, when=None):
+        """Set the position, which was `position` seconds at `when` on the monotonic clock (default now)"""
+        self._position = float(position)
+        self._when = monotonic() if when is None else when
+
+        if duration is not None:
+            self.duration = float(duration)
+
+    def update(self, event):
+        """Update the state from an event sent by the device, see AirPlay.events()"""
+        if isinstance(event, PlaybackEvent):
+            state, rate, position, duration = event.state, event.rate, event.position, event.duration
+        else:
+            # playing events have the details in params
+            params = dict(event, **event.get('params', {}))
+            state, rate, position, duration = [params.get(key) for key in ('state', 'rate', 'position', 'duration')]
+
+        if state is None:
+            return
+
+        # move the prediction up to now before the rate changes
+        now = monotonic()
+        if self._position is not None:
+            self.sample(self.predict(now), when=now)
+
+        self.state = state
+        self.rate = float(rate if rate is not None else self.RATES.get(state, self.rate))
+
+        if position is not None:
+            self.sample(position, duration, now)
+
+    def refresh(self, force=False):
+        """Check the predicted position with the device, if it hasn't been for `interval` seconds
+
+        The position is only moved if the prediction was out by more than `tolerance`,
+        so it doesn't jitter with the latency of each check.
+
+        Args:
+            force(bool):    Check even if `interval` hasn't passed
+
+        Returns:
+            bool:   True if the device was asked for the position
+        """
+        now = monotonic()
+        if not force and self._checked is not None and now - self._checked < self.interval:
+            return False
+
+        info = self.airplay.scrub()
+
+        # the device read the position about half way through the request
+        when = (now + monotonic()) / 2.0
+        self._checked = when
+
+        predicted = self.predict(when)
+        if predicted is None:
+            self.drift = None
+        else:
+            self.drift = info['position'] - predicted
+
+        if self.drift is None or abs(self.drift) > self.tolerance:
+            self.sample(info['position'], info['duration'], when)
+        else:
+            self.duration = info['duration']
+
+        return True
+
+    def seek(self, position):
+        """Seek the device to `position` seconds
+
+        Unlike AirPlay.scrub(position), the position isn't read back from the
+        device afterwards, it's predicted from where the seek was to.
+
+        Returns:
+            bool:   The device accepted the seek
+        """
+        result = self.airplay._command('/scrub', 'POST', position=position)
+        self.sample(position)
+
+        return result
@@ -0,0 +1,461 @@
+import email
+
+# loads() reads binary plists as well as XML ones
+try:
+    from plistlib import loads as plist_loads
+except ImportError:  # pragma: no cover
+    from plistlib import readPlistFromString as plist_loads
+
+try:
+    from plistlib import FMT_BINARY, dumps as plist_dumps
+    BINARY_PLISTS = True
+except ImportError:  # pragma: no cover
+    BINARY_PLISTS = False
+
+try:
+    from urllib import quote, urlencode
+except ImportError:
+    from urllib.parse import quote, urlencode
+
+from .models import PlaybackEvent, PlaybackInfo
+
+
+# "upgrade" a connection to Reverse HTTP, so the device can send us events
+UPGRADE_REQUEST = b"POST /reverse HTTP/1.1\r\nUpgrade: PTTH/1.0\r\nConnection: Upgrade\r\n\r\n"
+
+# what we send back for each event
+EVENT_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+
+# the content types of plists
+XML_PLIST = 'text/x-apple-plist+xml'
+BINARY_PLIST = 'application/x-apple-binary-plist'
+
+# sent with requests to ask for binary plists, which are smaller and quicker to parse, where the device has them
+ACCEPT_PLISTS = BINARY_PLIST + ', ' + XML_PLIST
+
+
+class ProtocolError(RuntimeError):
+    """The AirPlay device sent something that isn't valid HTTP"""
+
+
+class Response(object):
+    """A response received from an AirPlay device"""
+
+    __slots__ = ('version', 'status', 'reason', 'headers', 'body')
+
+    def __init__(self, version, status, reason, headers, body):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        """Returns the value of the header `name` (case insensitive) or `default` if it wasn't sent"""
+        return self.headers.get(name.lower(), default)
+
+    def __repr__(self):
+        return '<Response {0} {1} ({2} bytes)>'.format(self.status, self.reason, len(self.body))
+
+
+class Request(object):
+    """A request received from an AirPlay device over Reverse HTTP"""
+
+    __slots__ = ('method', 'path', 'version', 'headers', 'body')
+
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        """Returns the value of the header `name` (case insensitive) or `default` if it wasn't sent"""
+        return self.headers.get(name.lower(), default)
+
+    def __repr__(self):
+        return '<Request {0} {1} ({2} bytes)>'.format(self.method, self.path, len(self.body))
+
+
+def parse_headers(lines):
+    """Parse header lines into a dict with lower case names
+
+    Raises:
+        ProtocolError:  A header is malformed
+    """
+    headers = {}
+    for line in lines:
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise ProtocolError('Malformed header: {0!r}'.format(line))
+        headers[name.strip().lower()] = value.strip()
+
+    return headers
+
+
+def parse_head(head):
+    """Parse the status line and headers of a response
+
+    Args:
+        head(bytes):    Everything before the blank line that ends the headers
+
+    Returns:
+        (str, int, str, dict):  The HTTP version, status code, reason and headers.
+                                Header names are lower case.
+
+    Raises:
+        ProtocolError:  The status line or a header is malformed
+    """
+    lines = head.decode('iso-8859-1').split('\r\n')
+
+    try:
+        version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+        status = int(status)
+    except ValueError:
+        raise ProtocolError('Malformed status line: {0!r}'.format(lines[0]))
+
+    if not version.startswith('HTTP/'):
+        raise ProtocolError('Malformed status line: {0!r}'.format(lines[0]))
+
+    return version, status, reason, parse_headers(lines[1:])
+
+
+def parse_request_head(head):
+    """Parse the request line and headers of a request
+
+    Args:
+        head(bytes):    Everything before the blank line that ends the headers
+
+    Returns:
+        (str, str, str, dict):  The method, path, HTTP version and headers.
+                                Header names are lower case.
+
+    Raises:
+        ProtocolError:  The request line or a header is malformed
+    """
+    lines = head.decode('iso-8859-1').split('\r\n')
+
+    try:
+        method, path, version = lines[0].split(' ')
+    except ValueError:
+        raise ProtocolError('Malformed request line: {0!r}'.format(lines[0]))
+
+    if not version.startswith('HTTP/'):
+        raise ProtocolError('Malformed request line: {0!r}'.format(lines[0]))
+
+    return method, path, version, parse_headers(lines[1:])
+
+
+class ResponseParser(object):
+    """Turn the bytes received on a control connection into Response objects
+
+    The parser doesn't do any I/O: bytes are fed to it as they arrive from the
+    socket, in whatever pieces the network delivers them.  Responses are framed
+    by their Content-Length header, so bodies split over several reads or larger
+    than a single read are reassembled, and the start of a following response
+    received in the same read is kept for the next one.  A response without a
+    Content-Length has no body.  Parsing stops after 101 Switching Protocols,
+    what follows can be taken with unparsed().
+
+        parser = ResponseParser()
+        for response in parser.feed(sock.recv(65536)):
+            ...
+    """
+
+    # parses the start line and headers, and builds a message from them and the body
+    parse_head = staticmethod(parse_head)
+    message = Response
+
+    # the most we'll buffer waiting for the end of the headers
+    max_head = 64 * 1024
+
+    # the largest body we'll accept
+    max_body = 16 * 1024 * 1024
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._head = None
+        self._length = 0
+        self._switched = False
+
+    @property
+    def pending(self):
+        """int: The number of bytes received that aren't part of a complete response yet"""
+        return len(self._buffer)
+
+    def feed(self, data):
+        """Add bytes received from the device
+
+        Args:
+            data(bytes):    The bytes, in any sized piece
+
+        Returns:
+            list:   Messages for every one completed by `data`, in order
+
+        Raises:
+            ProtocolError:  The device sent something we can't parse
+        """
+        buf = self._buffer
+        buf += data
+
+        responses = []
+        while not self._switched:
+            if self._head is None:
+                end = buf.find(b'\r\n\r\n')
+                if end == -1:
+                    if len(buf) > self.max_head:
+                        raise ProtocolError('Headers are larger than {0} bytes'.format(self.max_head))
+                    break
+
+                self._head = self.parse_head(bytes(buf[:end]))
+                del buf[:end + 4]
+
+                try:
+                    self._length = int(self._head[-1].get('content-length', 0))
+                except ValueError:
+                    raise ProtocolError('Invalid Content-Length: {0!r}'.format(self._head[-1]['content-length']))
+
+                if not 0 <= self._length <= self.max_body:
+                    raise ProtocolError('Invalid Content-Length: {0}'.format(self._length))
+
+            if len(buf) < self._length:
+                break
+
+            body = bytes(buf[:self._length])
+            del buf[:self._length]
+
+            message = self.message(*(self._head + (body,)))
+            responses.append(message)
+            self._head = None
+
+            # whatever follows 101 Switching Protocols isn't HTTP, leave it for unparsed()
+            if getattr(message, 'status', None) == 101:
+                self._switched = True
+                break
+
+        return responses
+
+    def unparsed(self):
+        """Return and forget the bytes received after the last complete message
+
+        For when the connection switches protocols, and what follows needs a different parser.
+        """
+        data = bytes(self._buffer)
+        self.reset()
+
+        return data
+
+    def reset(self):
+        """Drop anything buffered, for when the connection is replaced"""
+        del self._buffer[:]
+        self._head = None
+        self._length = 0
+        self._switched = False
+
+
+class RequestParser(ResponseParser):
+    """Turn the bytes received on a Reverse HTTP connection into Request objects, see ResponseParser"""
+
+    parse_head = staticmethod(parse_request_head)
+    message = Request
+
+
+class EventParser(object):
+    """Turn the bytes received on a Reverse HTTP connection into events
+
+    Requests are framed incrementally by a RequestParser, so events that
+    arrive back to back in one read, or a large plist split over several,
+    are all decoded.  The device expects an EVENT_RESPONSE for each one.
+
+        parser = EventParser()
+        events = parser.feed(sock.recv(65536))
+        sock.sendall(EVENT_RESPONSE * len(events))
+    """
+
+    def __init__(self):
+        self._requests = RequestParser()
+
+    @property
+    def pending(self):
+        """int: The number of bytes received that aren't part of a complete event yet"""
+        return self._requests.pending
+
+    def feed(self, data):
+        """Add bytes received from the device
+
+        Args:
+            data(bytes):    The bytes, in any sized piece
+
+        Returns:
+            list:   A PlaybackEvent for every event completed by `data`, in order
+
+        Raises:
+            ProtocolError:  The device sent something that isn't a valid event
+        """
+        return [
+            decode_event(request.path, request.getheader('content-type'), request.body)
+            for request in self._requests.feed(data)
+        ]
+
+
+def build_request(uri, method='GET', body='', headers=None, **kwargs):
+    """Generate the bytes of a request to send to an AirPlay device
+
+    Args:
+        uri(string):    The URI to request
+        method(string): The HTTP verb to use when requesting `uri`, defaults to GET
+        body(string):   If provided, will be sent witout alteration as the request body.
+                        Content-Length header will be set to len(`body`)
+        headers(dict):  Optional. More headers to send
+        **kwargs:       If provided, Will be converted to a query string and appended to `uri`
+
+    Returns:
+        bytes:  The request
+    """
+    if len(kwargs):
+        uri = uri + '?' + urlencode(kwargs)
+
+    if not isinstance(body, bytes):
+        body = body.encode('UTF-8')
+
+    head = method + " " + uri + " HTTP/1.1\r\n"
+    for (name, value) in sorted((headers or {}).items()):
+        head += name + ": " + value + "\r\n"
+
+    head += "Content-Length: " + str(len(body)) + "\r\n\r\n"
+
+    return head.encode('UTF-8') + body
+
+
+def accept_headers(method, headers=None, binary=BINARY_PLISTS):
+    """Returns `headers` with an Accept header asking for binary plists, if `method` is GET and `binary` is set"""
+    if method != 'GET' or not binary:
+        return headers
+
+    return dict(headers or {}, Accept=ACCEPT_PLISTS)
+
+
+def decode_response(resp):
+    """Turn a response from an AirPlay device into a python value
+
+    Args:
+        resp(Response): The response
+
+    Returns:
+        True: Request returned 200 OK, with no response body
+        False: Request returned something other than 200 OK, with no response body
+
+        Mixed: The body of the HTTP response
+
+    Raises:
+        RuntimeError:   The body can't be decoded
+    """
+    # if our content length is zero, then return bool based on result code
+    if not resp.body:
+        if resp.status == 200:
+            return True
+        else:
+            return False
+
+    # else, parse based on provided content-type
+    # and return the response body
+    content_type = resp.getheader('content-type')
+
+    if content_type is None:
+        raise RuntimeError('Response returned without a content type!')
+
+    if content_type == 'text/parameters':
+        body = resp.body
+        try:
+            body = str(body, 'UTF-8')
+        except TypeError:
+            pass
+
+        return email.message_from_string(body)
+
+    if content_type == XML_PLIST or (content_type == BINARY_PLIST and BINARY_PLISTS):
+        return plist_loads(resp.body)
+
+    raise RuntimeError('Response received with unknown content-type: {0}'.format(content_type))
+
+
+def decode_event(path, content_type, body):
+    """Turn an event POSTed by an AirPlay device into a PlaybackEvent
+
+    Args:
+        path(str):          The path the event was sent to
+        content_type(str):  The Content-Type of the event
+        body(bytes):        The body of the request
+
+    Returns:
+        PlaybackEvent:  The event
+
+    Raises:
+        ProtocolError:  The request isn't a valid event
+    """
+    # make sure this is what we expect
+    if path != '/event':
+        raise ProtocolError('Unexpected path when parsing event: {0}'.format(path))
+
+    # validate our content type
+    if content_type != XML_PLIST:
+        raise ProtocolError('Unexpected Content-Type when parsing event: {0}'.format(content_type))
+
+    # and the body length
+    if not body:
+        raise ProtocolError('Received an event with a zero length body.')
+
+    # parse XML plist
+    return PlaybackEvent.from_plist(plist_loads(body))
+
+
+def play_body(url, position):
+    """Returns the body of a /play request for `url`, starting at `position` (0.0 - 1.0)"""
+    return "Content-Location: {0}\nStart-Position: {1}\n\n".format(url, float(position))
+
+
+def playback_info_result(response):
+    """Convert the plist we get back from /playback-info to a PlaybackInfo"""
+    if isinstance(response, dict):
+        return PlaybackInfo.from_plist(response)
+
+    return response
+
+
+def require_binary_plists():
+    """Raises NotImplementedError if plistlib can't read and write binary plists"""
+    if not BINARY_PLISTS:
+        raise NotImplementedError('Methods that require binary plists need Python 3.4 or later.')
+
+
+def property_uri(endpoint, name):
+    """Returns the URI to get or set (`endpoint` is getProperty or setProperty) the property `name`"""
+    return '/{0}?{1}'.format(endpoint, quote(name))
+
+
+def property_body(value):
+    """Returns the body of a /setProperty request, a binary plist holding `value`"""
+    require_binary_plists()
+
+    return plist_dumps({'value': value}, fmt=FMT_BINARY)
+
+
+def property_result(response):
+    """Check the plist we get back from /getProperty and /setProperty, and return the value in it
+
+    Raises:
+        RuntimeError:   The device returned an error code
+    """
+    if not isinstance(response, dict):
+        return response
+
+    if response.get('errorCode', 0):
+        raise RuntimeError('The AirPlay device returned error code {0}'.format(response['errorCode']))
+
+    return response.get('value', True)
+
+
+def scrub_result(response):
+    """Convert the strings we get back from /scrub to floats (which they should be)"""
+    return {kk: float(vv) for (kk, vv) in response.items()}
@@ -0,0 +1,218 @@
+import os
+import threading
+
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+
+SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+
+
+def advise(fd, offset, length, advice):
+    """Tell the kernel how a file is going to be read, see posix_fadvise(2)
+
+    This is only a hint, so platforms without posix_fadvise() and filesystems
+    that don't support it are silently ignored.
+
+    Args:
+        fd(int):        An open file descriptor
+        offset(int):    The start of the region the advice applies to
+        length(int):    The length of the region
+        advice(int):    SEQUENTIAL or WILLNEED
+
+    Returns:
+        bool:   True if the kernel accepted the advice
+    """
+    if advice is None or length <= 0:
+        return False
+
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except (AttributeError, EnvironmentError):
+        return False
+
+    return True
+
+
+class Window(object):
+    """Read ahead of a single response as it is sent, see ReadAhead.window()"""
+
+    def __init__(self, readahead, key, path, first, last):
+        self.readahead = readahead
+        self.key = key
+        self.path = path
+        self.last = last
+
+        # the end of the data we've asked to be read ahead
+        self.end = first
+
+    def advance(self, offset):
+        """Call as the response is sent, `offset` is the position reached in the file
+
+        Once the client has used up half the window, the next part of the file is read ahead
+        """
+        size = self.readahead.size
+        if self.end - offset > size // 2 or self.end >= self.last:
+            return
+
+        start = max(offset, self.end)
+        self.end = min(offset + size, self.last)
+        self.readahead.schedule(self.key, self.path, start, self.end)
+
+
+class ReadAhead(object):
+    """Read files ahead of the clients streaming them, so the data is in the page cache when it's needed
+
+    Each response gets a Window that follows the client through the file; the
+    next `size` bytes are read on a background thread, using posix_fadvise() if
+    the platform has it.  When a client's next request starts in data we already
+    read ahead for it (the device resumed playback, or reconnected) it's a hit.
+
+    One ReadAhead is shared by all of the connections to a server.
+    """
+
+    # the number of (client, file) read ahead positions remembered
+    max_clients = 256
+
+    def __init__(self, size=8 * 1024 * 1024):
+        """Create a read ahead
+
+        Args:
+            size(int):  How far ahead of each client to read, in bytes
+        """
+        self.size = size
+
+        # (client, path, inode, mtime) => (first, last) of the last data read ahead
+        self._extents = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._queue = queue.Queue(64)
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.scheduled = 0
+        self.dropped = 0
+        self.bytes = 0
+
+    def stats(self):
+        """Returns:
+            dict: The hit/miss counters and how much data has been read ahead
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'scheduled': self.scheduled,
+                'dropped': self.dropped,
+                'bytes': self.bytes,
+                'clients': len(self._extents),
+                'size': self.size,
+            }
+
+    def window(self, client, path, stats, first, last):
+        """Start reading ahead of a response
+
+        Args:
+            client(str):            The host the data is being sent to
+            path(str):              The file being sent
+            stats(stat_result):     The result of os.fstat() on the file
+            first(int):             The offset of the first byte being sent
+            last(int):              The offset after the last byte being sent
+
+        Returns:
+            Window: Call its advance() method as the data is sent
+        """
+        key = (client, path, stats.st_ino, stats.st_mtime)
+
+        with self._lock:
+            extent = self._extents.pop(key, None)
+            if extent is not None and extent[0] <= first < extent[1]:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            self._extents[key] = extent or (first, first)
+            while len(self._extents) > self.max_clients:
+                self._extents.popitem(last=False)
+
+        window = Window(self, key, path, first, last)
+        window.advance(first)
+
+        return window
+
+    def schedule(self, key, path, first, last):
+        """Read bytes `first` through `last` - 1 of `path` on the background thread"""
+        with self._lock:
+            # extend what we've already read ahead for this client if it's contiguous
+            extent = self._extents.get(key)
+            if extent is not None and extent[1] == first:
+                self._extents[key] = (extent[0], last)
+            else:
+                self._extents[key] = (first, last)
+            self.scheduled += 1
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='airplay-read-ahead')
+                self._thread.daemon = True
+                self._thread.start()
+
+        try:
+            self._queue.put_nowait((path, first, last))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def close(self):
+        """Stop the background thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        """Read the files put in the queue by schedule() until close() is called"""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            path, first, last = job
+            try:
+                read = self.read(path, first, last)
+            except EnvironmentError:
+                continue
+
+            with self._lock:
+                self.bytes += read
+
+    def read(self, path, first, last):
+        """Get bytes `first` through `last` - 1 of `path` into the page cache
+
+        Returns:
+            int:    The number of bytes read ahead
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if advise(fd, first, last - first, WILLNEED):
+                return last - first
+
+            # no fadvise, so read the data ourselves and throw it away
+            os.lseek(fd, first, os.SEEK_SET)
+            offset = first
+            while offset < last:
+                data = os.read(fd, min(1024 * 1024, last - offset))
+                if not data:
+                    break
+                offset += len(data)
+
+            return offset - first
+        finally:
+            os.close(fd)
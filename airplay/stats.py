@@ -0,0 +1,129 @@
+import bisect
+import threading
+
+
+class Histogram(object):
+    """Counts of command latencies in fixed buckets, so recording one is cheap and the memory used is constant"""
+
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    # the upper bound in seconds of each bucket, the last one holds anything slower
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """Record a latency of `seconds`"""
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket that holds the `percent`th percentile, or None if it's empty
+
+        Latencies in the last bucket have no upper bound, the slowest one is returned for them.
+        """
+        if not self.count:
+            return None
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for (ii, count) in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.BOUNDS[ii] if ii < len(self.BOUNDS) else self.max
+
+        return self.max  # pragma: no cover
+
+    def snapshot(self):
+        """Returns the histogram as a dict, see AirPlay.stats()"""
+        buckets = {}
+        for (ii, count) in enumerate(self.counts):
+            if count:
+                buckets['<={0:g}'.format(self.BOUNDS[ii]) if ii < len(self.BOUNDS) else 'inf'] = count
+
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': buckets,
+        }
+
+
+class CommandStats(object):
+    """What an AirPlay object has sent and received on its control connection, see AirPlay.stats()"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._lock:
+            self._endpoints = {}
+            self._bytes_sent = 0
+            self._bytes_received = 0
+            self._connects = 0
+            self._reconnects = 0
+            self._retries = 0
+
+    def command(self, endpoint, latency, error=False):
+        """Record a command to `endpoint` (like 'GET /scrub') that took `latency` seconds, and whether it failed"""
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = [Histogram(), 0]
+
+            stats[0].add(latency)
+            if error:
+                stats[1] += 1
+
+    def sent(self, count):
+        with self._lock:
+            self._bytes_sent += count
+
+    def received(self, count):
+        with self._lock:
+            self._bytes_received += count
+
+    def connected(self, reconnect=False):
+        with self._lock:
+            self._connects += 1
+            if reconnect:
+                self._reconnects += 1
+
+    def retried(self):
+        with self._lock:
+            self._retries += 1
+
+    def snapshot(self):
+        """Returns everything recorded as a dict, see AirPlay.stats()"""
+        with self._lock:
+            endpoints = {}
+            for (endpoint, (histogram, errors)) in self._endpoints.items():
+                endpoints[endpoint] = dict(histogram.snapshot(), errors=errors)
+
+            return {
+                'commands': sum(histogram.count for (histogram, _) in self._endpoints.values()),
+                'errors': sum(errors for (_, errors) in self._endpoints.values()),
+                'bytes_sent': self._bytes_sent,
+                'bytes_received': self._bytes_received,
+                'connects': self._connects,
+                'reconnects': self._reconnects,
+                'retries': self._retries,
+                'endpoints': endpoints,
+            }
@@ -0,0 +1,220 @@
+import time
+
+try:
+    from time import monotonic
+except ImportError:  # pragma: no cover
+    from time import time as monotonic
+
+from .models import PlaybackInfo
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+
+    if len(values) % 2:
+        return values[middle]
+
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _seek(device, position):
+    """Seek `device` to `position` seconds, AirPlay.scrub() won't seek to 0"""
+    return device._command('/scrub', 'POST', position=position)
+
+
+def _load(device, url, position):
+    """Start loading `url` on `device`, paused at `position` seconds"""
+    device.play(url, 0.0)
+    device.rate(0.0)
+
+    return _seek(device, position)
+
+
+class SyncedPlayback(object):
+    """Start playback on a DeviceGroup at the same moment, and keep it in step
+
+    Each device is sent play() paused at the start position, and once they are
+    ready rate(1.0) is sent to each of them early by its one way latency (half
+    the round trip measured with measure()) so they all start playing at the
+    target time.  Devices that drift apart afterwards are put back in step by
+    correct() or monitor(), which seek them to where the rest of the group is.
+
+        >>> sync = SyncedPlayback(DeviceGroup(AirPlay.find()))
+        >>> sync.start('http://192.0.2.114/wall.mp4', at=time.time() + 2)
+        >>> for drift in sync.monitor():
+        ...     print(drift)
+
+    Positions are compared assuming the devices play at rate 1.0.
+    """
+
+    def __init__(self, group):
+        """
+        Args:
+            group(DeviceGroup): The devices to play on
+        """
+        self.group = group
+
+        # the one way latency to each device in seconds, see measure()
+        self.latency = None
+
+    def measure(self, samples=5):
+        """Measure the latency to each device by timing /scrub requests
+
+        The one way latency is half the median round trip.  A device that doesn't
+        answer any of the requests is given a latency of 0.
+
+        Args:
+            samples(int):   How many requests to send to each device
+
+        Returns:
+            list:   The one way latency to each device in seconds, in the same order as the group
+        """
+        rtts = [[] for _ in self.group.devices]
+
+        for _ in range(samples):
+            for (ii, result) in enumerate(self.group.call('_command', '/scrub')):
+                if result.ok:
+                    rtts[ii].append(result.latency)
+
+        self.latency = [_median(rtt) / 2.0 if rtt else 0.0 for rtt in rtts]
+
+        return self.latency
+
+    def wait_ready(self, timeout=10.0, interval=0.1):
+        """Wait until every device has loaded enough to start playing
+
+        Args:
+            timeout(float):     The most seconds to wait
+            interval(float):    Seconds between checks
+
+        Returns:
+            bool:   True if they are all ready, False if `timeout` expired first
+        """
+        deadline = monotonic() + timeout
+
+        while True:
+            ready = [
+                result.ok and isinstance(result.value, PlaybackInfo) and result.value.ready_to_play in (None, True, 1)
+                for result in self.group.playback_info()
+            ]
+            if all(ready):
+                return True
+
+            if monotonic() + interval > deadline:
+                return False
+
+            time.sleep(interval)
+
+    def start(self, url, position=0.0, at=None, lead=1.0, ready_timeout=10.0):
+        """Play `url` on every device, starting together at `at`
+
+        Args:
+            url(str):               The URL to play, see AirPlay.play()
+            position(float):        Optional. Where to start, in seconds
+            at(float):              Optional. When to start, as a unix timestamp (time.time()).
+                                    Defaults to `lead` seconds after the devices are ready.
+                                    If it has passed by the time they are, they start right away.
+            lead(float):            Optional. Seconds to allow for sending rate(1.0) if `at` isn't given
+            ready_timeout(float):   Optional. The most seconds to wait for the devices to load `url`.
+                                    Devices that aren't ready in time are started anyway, and can be
+                                    brought into step with correct()
+
+        Returns:
+            list:   The GroupResult of rate(1.0) for each device
+
+        Raises:
+            RuntimeError:   A device couldn't load `url`
+        """
+        failed = [result for result in self.group.call(_load, url, position) if not result.ok]
+        if failed:
+            raise RuntimeError('Unable to load {0} on {1}'.format(
+                url,
+                ', '.join('{0}:{1} ({2})'.format(r.device.host, r.device.port, r.error) for r in failed)
+            ))
+
+        self.wait_ready(ready_timeout)
+
+        if self.latency is None:
+            self.measure()
+
+        if at is None:
+            at = time.time() + lead
+
+        # the target on the monotonic clock, so changes to the system clock don't matter
+        start = monotonic() + (at - time.time())
+
+        return self.group.call_at([start - latency for latency in self.latency], 'rate', 1.0)
+
+    def _sample(self):
+        """Read every device's position
+
+        Returns:
+            (list, float, float):   The positions normalized to `when` (None for devices that didn't answer),
+                                    the median of them, and `when` on the monotonic clock
+        """
+        results = self.group.scrub()
+        when = min(result.started for result in results)
+
+        # estimate each position at the same moment: the device read it about half way through the request
+        positions = []
+        for result in results:
+            if result.ok and 'position' in result.value:
+                positions.append(result.value['position'] - (result.started + result.latency / 2.0 - when))
+            else:
+                positions.append(None)
+
+        known = [position for position in positions if position is not None]
+
+        return positions, (_median(known) if known else None), when
+
+    def drift(self):
+        """How far ahead of the rest of the group each device is
+
+        Returns:
+            list:   Seconds each device is ahead (or behind if negative) of the median position of the group,
+                    None for devices that didn't answer
+        """
+        positions, reference, _ = self._sample()
+
+        return [position - reference if position is not None else None for position in positions]
+
+    def correct(self, tolerance=0.1):
+        """Seek devices that have drifted more than `tolerance` seconds to where the rest of the group is
+
+        Args:
+            tolerance(float):   The drift in seconds allowed before a device is sent a seek
+
+        Returns:
+            list:   The drift of each device before the correction, see drift()
+        """
+        positions, reference, when = self._sample()
+        drifts = [position - reference if position is not None else None for position in positions]
+
+        latency = self.latency or [0.0] * len(drifts)
+        targets = {}
+        for (device, drift, one_way) in zip(self.group.devices, drifts, latency):
+            if drift is not None and abs(drift) > tolerance:
+                targets[id(device)] = one_way
+
+        def seek(device):
+            if id(device) not in targets:
+                return None
+
+            # where the group will be when the seek reaches the device
+            return _seek(device, reference + (monotonic() - when) + targets[id(device)])
+
+        if targets:
+            self.group.call(seek)
+
+        return drifts
+
+    def monitor(self, interval=1.0, tolerance=0.1):
+        """Check the group every `interval` seconds, correcting devices that drift, see correct()
+
+        Yields:
+            list:   The drift of each device before each correction
+        """
+        while True:
+            yield self.correct(tolerance)
+            time.sleep(interval)
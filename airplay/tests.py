@@ -1,11 +1,22 @@
 import email
+import errno
+import json
 import os
 import socket
+import sys
 import tempfile
+import threading
 import time
 import unittest
 import warnings
 
+from multiprocessing import Pipe
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
 try:
     from urllib2 import Request
     from urllib2 import urlopen
@@ -16,13 +27,70 @@ except ImportError:
     from urllib.error import URLError
 
 try:
-    from mock import call, patch, Mock
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    from plistlib import writePlistToString as plist_dumps
+    from plistlib import readPlistFromString as plist_loads
 except ImportError:
-    from unittest.mock import call, patch, Mock
+    from plistlib import dumps as plist_dumps
+    from plistlib import loads as plist_loads
+
+try:
+    from plistlib import FMT_BINARY
+except ImportError:  # pragma: no cover
+    FMT_BINARY = None
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+try:
+    from mock import ANY, call, patch, Mock
+except ImportError:
+    from unittest.mock import ANY, call, patch, Mock
 
 from zeroconf import ServiceStateChange
 
-from .airplay import FakeSocket, AirPlayEvent, AirPlay, RangeHTTPServer
+from .airplay import FakeSocket, AirPlayEvent, AirPlay
+from .http_server import MediaCatalog, RangeHTTPServer, parse_byte_ranges, _parse_byte_ranges
+from .vendor import httpheader
+from .media_server import MediaServer, run_process
+from .access_log import AccessLog
+from .events import EventHub, Subscription
+from .group import DeviceGroup
+from .sync import SyncedPlayback
+from .playback import PlaybackState
+
+if sys.version_info >= (3, 6):
+    from .aio import AsyncAirPlay
+from .pacing import Pacer, TokenBucket
+from .models import PlaybackEvent, PlaybackInfo
+from .protocol import (
+    BINARY_PLISTS, EventParser, ProtocolError, RequestParser, ResponseParser, accept_headers, build_request,
+    decode_event, playback_info_result
+)
+from .readahead import ReadAhead
+from .cache import BlockCache, StatCache
+from .stats import Histogram
 
 
 class TestFakeSocket(unittest.TestCase):
@@ -34,6 +102,142 @@ class TestFakeSocket(unittest.TestCase):
         assert f.makefile().read() == b"foo"
 
 
+def wait_until(predicate, timeout=1.0):
+    """Wait for `predicate` to return True, for things that happen on another thread"""
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(.01)
+
+    return predicate()
+
+
+class FakeDevice(object):
+    """An AirPlay device listening on localhost, that answers each request with the next of `responses`"""
+    OK = b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+    NOT_FOUND = b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n'
+    SCRUB = b'HTTP/1.1 200 OK\r\nContent-Type: text/parameters\r\nContent-Length: 40\r\n\r\n' \
+            b'duration: 83.124794\r\nposition: 14.467000'
+    SWITCHING = b'HTTP/1.1 101 Switching Protocols\r\nContent-Length: 0\r\n\r\n'
+
+    @staticmethod
+    def plist(value):
+        body = plist_dumps(value)
+        return 'HTTP/1.1 200 OK\r\nContent-Type: text/x-apple-plist+xml\r\nContent-Length: {0}\r\n\r\n'.format(
+            len(body)
+        ).encode('ascii') + body
+
+    @staticmethod
+    def event(category, state):
+        body = plist_dumps({'category': category, 'state': state, 'sessionID': 13})
+        return 'POST /event HTTP/1.1\r\nContent-Type: text/x-apple-plist+xml\r\nContent-Length: {0}\r\n\r\n'.format(
+            len(body)
+        ).encode('ascii') + body
+
+    @classmethod
+    def scrub(cls, position):
+        body = 'duration: 83.124794\r\nposition: {0:f}'.format(position).encode('ascii')
+        return 'HTTP/1.1 200 OK\r\nContent-Type: text/parameters\r\nContent-Length: {0}\r\n\r\n'.format(
+            len(body)
+        ).encode('ascii') + body
+
+    def __init__(self, delay=0):
+        # bytes, a function returning bytes, or None to close the connection
+        self.responses = []
+
+        # the request line of each request, and when it arrived
+        self.requests = []
+        self.times = []
+
+        # the network round trip: half before a request arrives, half before the response does
+        self.delay = delay
+
+        self.upgrade = self.SWITCHING
+        self.events = []
+        self.acks = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+
+        self.connections = []
+
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        # wake up accept()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.thread.join()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+
+            self.connections.append(conn)
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        buf = b''
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            buf += data
+
+            while b'\r\n\r\n' in buf:
+                head, rest = buf.split(b'\r\n\r\n', 1)
+                lines = head.split(b'\r\n')
+                line = lines[0]
+
+                # skip the body
+                length = 0
+                for header in lines[1:]:
+                    if header.lower().startswith(b'content-length:'):
+                        length = int(header.split(b':')[1])
+                if len(rest) < length:
+                    break
+                buf = rest[length:]
+
+                if line.startswith(b'HTTP/1.1 200'):
+                    self.acks += 1
+                    continue
+
+                if line.startswith(b'POST /reverse'):
+                    conn.sendall(self.upgrade + b''.join(self.events))
+                    continue
+
+                if self.delay:
+                    time.sleep(self.delay / 2.0)
+
+                self.requests.append(line)
+                self.times.append(monotonic())
+
+                response = self.responses.pop(0)
+                if callable(response):
+                    response = response()
+
+                if self.delay:
+                    time.sleep(self.delay / 2.0)
+
+                if response is None:
+                    conn.close()
+                    return
+                conn.sendall(response)
+
+        conn.close()
+
+
 class TestAirPlayEvent(unittest.TestCase):
 
     # TODO: Move these fixtures to external files
@@ -86,96 +290,68 @@ class TestAirPlayEvent(unittest.TestCase):
 
 
 class TestAirPlayEventMonitor(unittest.TestCase):
-    # mock socket to return our test object
-    # send => drop
-    # recv => return fixture response 101, then whatever
-
-    # insepect queues for results
-
-    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
-    def setUp(self, mock):
+    PHOTO_EVENT = FakeDevice.event('photo', 'paused')
+    VIDEO_EVENT = FakeDevice.event('video', 'paused')
 
-        mock.sock = MockSocket()
-        mock.sock.recv_data = """HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\n\r\n"""
+    def setUp(self):
+        self.device = FakeDevice()
+        self.ap = AirPlay('127.0.0.1', self.device.port, 'test', backoff=0)
 
-        self.ap = AirPlay('192.0.2.23', 916, 'test')
+    def tearDown(self):
+        self.ap.close()
+        self.device.close()
 
-    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
-    def test_event_bad_upgrade(self, mock):
+    def test_event_bad_upgrade(self):
         """When 101 response is not returned on the event socket, RuntimerError is raised"""
+        self.device.upgrade = FakeDevice.NOT_FOUND
 
         def go():
             list(self.ap.events(block=True))
 
         self.assertRaises(RuntimeError, go)
 
-    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
-    def test_event_socket_closed_control(self, mock):
-        """When a message is received on the control queue, the socket is closed"""
+    def test_event_monitor_closed(self):
+        """close() stops the monitor straight away"""
 
         # start the event listener
         list(self.ap.events(block=False))
 
         # ensure it's running
-        assert self.ap.event_monitor.is_alive()
+        monitor = self.ap._event_monitor
+        assert monitor.thread.is_alive()
 
         # tell it to die
-        self.ap.event_control.put(True)
-
-        # wait for timeout to occur
-        time.sleep(1)
+        start = time.time()
+        self.ap.close()
 
-        # it should be dead
-        assert self.ap.event_monitor.is_alive() is False
+        # it should be dead, without waiting for a timeout
+        assert monitor.thread.is_alive() is False
+        assert time.time() - start < .1
 
-    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
-    def test_bad_event(self, mock):
+    def test_bad_event(self):
         """When an unparseable event is received, RuntimeError is raised"""
-
-        mock.sock.recv_data = [
-            """HTTP/1.1 101 Switching Protocols\r\nContent-Length: 0\r\n\r\n""",
-            """POST /event HTTP/1.1\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nhi"""
-        ]
+        self.device.events = [b'POST /event HTTP/1.1\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nhi']
 
         def go():
             list(self.ap.events(block=True))
 
         self.assertRaises(RuntimeError, go)
 
-    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
-    def test_non_video_event(self, mock):
-        """Events that are not video related are not forwarded to the queue"""
-
-        mock.sock.recv_data = [
-            """HTTP/1.1 101 Switching Protocols\r\nContent-Length: 0\r\n\r\n""",
-            """POST /event HTTP/1.1\r\nContent-Type: text/x-apple-plist+xml\r\nContent-Length: 303\r\n\r\n<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd"><plist version="1.0"><dict><key>category</key><string>photo</string><key>sessionID</key><integer>13</integer><key>state</key><string>paused</string></dict></plist>"""  # NOQA
-        ]
+        # the next call starts a new monitor
+        assert self.ap._event_monitor is None
 
-        gen = self.ap.events(block=True)
+    def test_non_video_event(self):
+        """Events that are not video related are not forwarded to the queue"""
+        self.device.events = [self.PHOTO_EVENT, self.VIDEO_EVENT]
 
-        def go():
-            try:
-                next(gen)
-            except TypeError:
-                raise socket.timeout
+        ev = next(self.ap.events(block=True))
 
-        # TODO: Fix this whole fucking test, it's gross
-        # note: this is not the real behaivor of the code, but a by product
-        # of their being no more events in our MockSocket mock
-        # so this error is raised
-        # the TypeError above, I _think_ is called by this:
-        # http://stackoverflow.com/questions/18163697/exception-typeerror-warning-sometimes-shown-sometimes-not-when-using-throw-meth
-        # but haven't debugged fully
-        self.assertRaises(socket.timeout, go)
+        assert ev['category'] == 'video'
+        assert wait_until(lambda: self.device.acks == 2)
 
-    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
-    def test_good_event(self, mock):
+    def test_good_event(self):
         """When we receive a properly formatted video event, we forward it to the queue"""
-
-        mock.sock.recv_data = [
-            """HTTP/1.1 101 Switching Protocols\r\nContent-Length: 0\r\n\r\n""",
-            """POST /event HTTP/1.1\r\nContent-Type: text/x-apple-plist+xml\r\nContent-Length: 303\r\n\r\n<?xml version="1.0" encoding="UTF-8"?><!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd"><plist version="1.0"><dict><key>category</key><string>video</string><key>sessionID</key><integer>13</integer><key>state</key><string>paused</string></dict></plist>"""  # NOQA
-        ]
+        self.device.events = [self.VIDEO_EVENT]
 
         gen = self.ap.events(block=True)
 
@@ -184,14 +360,99 @@ class TestAirPlayEventMonitor(unittest.TestCase):
         assert ev['category'] == 'video'
         assert ev['state'] == 'paused'
 
-    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
-    def test_event_queue_empty(self, mock):
-        """The generator stops when there are no more events"""
+    def test_event_split(self):
+        """Events that arrive together, or in pieces, are all received"""
+        self.device.events = [self.VIDEO_EVENT * 3 + self.VIDEO_EVENT[:20]]
 
-        # no events in this list
-        mock.sock.recv_data = [
-            """HTTP/1.1 101 Switching Protocols\r\nContent-Length: 0\r\n\r\n"""
-        ]
+        gen = self.ap.events(block=True)
+        for _ in range(3):
+            assert next(gen)['state'] == 'paused'
+
+        self.device.connections[-1].sendall(self.VIDEO_EVENT[20:])
+        assert next(gen)['state'] == 'paused'
+
+    def test_event_reconnect(self):
+        """When the event connection is lost, it's made again"""
+        self.device.events = [self.VIDEO_EVENT]
+
+        gen = self.ap.events(block=True)
+        next(gen)
+
+        # the device drops the connection, and sends the events again on the new one
+        self.device.connections[-1].shutdown(socket.SHUT_RDWR)
+        assert next(gen)['category'] == 'video'
+
+        # the control connection, and two event connections
+        assert len(self.device.connections) == 3
+
+    def test_event_ack_failed(self):
+        """When acknowledging events fails, they're still received and the connection is made again"""
+        self.device.events = [self.VIDEO_EVENT]
+
+        class BrokenAcks(object):
+            def __init__(self, sock):
+                self.sock = sock
+
+            def fileno(self):
+                return self.sock.fileno()
+
+            def recv(self, size):
+                return self.sock.recv(size)
+
+            def sendall(self, data):
+                raise socket.error(errno.EPIPE, 'Broken pipe')
+
+            def close(self):
+                self.sock.close()
+
+        open_event_socket = self.ap._open_event_socket
+        opened = []
+
+        def open_broken_first(stop=None):
+            event_socket, unparsed = open_event_socket(stop)
+            opened.append(event_socket)
+            return (BrokenAcks(event_socket) if len(opened) == 1 else event_socket), unparsed
+
+        self.ap._open_event_socket = open_broken_first
+
+        gen = self.ap.events(block=True)
+        assert next(gen)['state'] == 'paused'
+        assert next(gen)['state'] == 'paused'
+
+        assert len(opened) == 2
+        assert self.ap._event_monitor.thread.is_alive()
+
+    def test_event_monitor_closed_reconnecting(self):
+        """close() doesn't wait for the monitor to finish trying to reconnect"""
+        self.device.events = [self.VIDEO_EVENT]
+        self.ap.backoff = 10
+
+        gen = self.ap.events(block=True)
+        next(gen)
+
+        # nothing is listening for the monitor to reconnect to
+        monitor = self.ap._event_monitor
+        self.device.close()
+        self.device.connections[-1].shutdown(socket.SHUT_RDWR)
+        time.sleep(.2)
+
+        start = time.time()
+        self.ap.close()
+
+        assert monitor.thread.is_alive() is False
+        assert time.time() - start < 1
+
+    def test_event_filters(self):
+        """Other categories and states can be asked for"""
+        self.device.events = [self.PHOTO_EVENT, FakeDevice.event('video', 'playing'), self.VIDEO_EVENT]
+
+        gen = self.ap.events(block=True, categories=None, states=['paused'])
+
+        assert next(gen)['category'] == 'photo'
+        assert next(gen)['category'] == 'video'
+
+    def test_event_queue_empty(self):
+        """The generator stops when there are no more events"""
 
         gen = self.ap.events(block=False)
 
@@ -201,7 +462,173 @@ class TestAirPlayEventMonitor(unittest.TestCase):
         self.assertRaises(StopIteration, go)
 
 
+class TestEventHub(unittest.TestCase):
+    VIDEO_EVENT = FakeDevice.event('video', 'paused')
+
+    def setUp(self):
+        self.devices = [FakeDevice(), FakeDevice()]
+        self.aps = [AirPlay('127.0.0.1', device.port, 'test', backoff=0) for device in self.devices]
+        self.hub = EventHub()
+
+    def tearDown(self):
+        self.hub.close()
+        for ap in self.aps:
+            ap.close()
+        for device in self.devices:
+            device.close()
+
+    def test_subscribe(self):
+        """Each device's events go to its own subscribers"""
+        self.devices[0].events = [FakeDevice.event('video', 'playing')]
+        self.devices[1].events = [FakeDevice.event('photo', 'paused'), self.VIDEO_EVENT]
+
+        first = self.hub.subscribe(self.aps[0])
+        second = self.hub.subscribe(self.aps[1])
+
+        assert first.get(timeout=1)['state'] == 'playing'
+        assert second.get(timeout=1)['state'] == 'paused'
+        assert wait_until(lambda: self.devices[1].acks == 2)
+
+        stats = self.hub.stats()
+        assert stats['events'] == 2
+        assert stats['dispatch_latency']['max'] >= stats['dispatch_latency']['mean'] > 0
+
+        device = stats['devices']['127.0.0.1:{0}'.format(self.devices[1].port)]
+        assert device == {
+            'connected': True, 'subscribers': 1, 'events': 1, 'reconnects': 0, 'queue_depth': 0, 'dropped': 0
+        }
+
+    def test_filters(self):
+        """Subscriptions only receive the events they ask for"""
+        everything = self.hub.subscribe(self.aps[0], categories=None)
+        paused = self.hub.subscribe(self.aps[0], states=['paused'], maxsize=1, overflow='drop-newest')
+
+        self.devices[0].connections[-1].sendall(
+            FakeDevice.event('photo', 'paused') + self.VIDEO_EVENT + FakeDevice.event('video', 'playing')
+        )
+
+        assert [everything.get(timeout=1)['category'] for _ in range(3)] == ['photo', 'video', 'video']
+        assert paused.get(timeout=1)['category'] == 'video'
+        assert paused.qsize() == 0
+
+        # the second doesn't fit
+        self.devices[0].connections[-1].sendall(self.VIDEO_EVENT * 2)
+        assert wait_until(lambda: paused.dropped == 1)
+        assert self.hub.stats()['devices']['127.0.0.1:{0}'.format(self.devices[0].port)]['dropped'] == 1
+
+    def test_one_connection(self):
+        """Subscribers to the same device share its connection"""
+        received = []
+        self.hub.subscribe(self.aps[0], lambda ap, event: received.append((ap, event)))
+        queued = self.hub.subscribe(self.aps[0])
+
+        self.devices[0].connections[-1].sendall(self.VIDEO_EVENT)
+
+        assert queued.get(timeout=1)['state'] == 'paused'
+        assert wait_until(lambda: len(received) == 1)
+        assert received[0][0] is self.aps[0]
+
+        # the control connection, and one event connection
+        assert len(self.devices[0].connections) == 2
+        assert self.hub.stats()['devices']['127.0.0.1:{0}'.format(self.devices[0].port)]['queue_depth'] == 0
+
+    def test_callback_error(self):
+        """Exceptions raised by callbacks are counted, and don't stop the hub"""
+        self.devices[0].events = [self.VIDEO_EVENT, self.VIDEO_EVENT]
+
+        def callback(ap, event):
+            raise ValueError
+
+        self.hub.subscribe(self.aps[0], callback)
+        assert wait_until(lambda: self.hub.stats()['callback_errors'] == 2)
+
+        self.devices[1].events = [self.VIDEO_EVENT]
+        assert self.hub.subscribe(self.aps[1]).get(timeout=1)['category'] == 'video'
+
+    def test_unsubscribe(self):
+        """The connection is closed when the last subscriber goes"""
+        queued = self.hub.subscribe(self.aps[0])
+        callback = self.hub.subscribe(self.aps[0], Mock())
+
+        self.hub.unsubscribe(self.aps[0], queued)
+        assert self.hub.stats()['devices']['127.0.0.1:{0}'.format(self.devices[0].port)]['subscribers'] == 1
+
+        self.hub.unsubscribe(self.aps[0], callback)
+        assert self.hub.stats()['devices'] == {}
+
+        # only the wakeup socket is left
+        assert wait_until(lambda: len(self.hub._selector.get_map()) == 1)
+
+        # unknown subscribers are ignored
+        self.hub.unsubscribe(self.aps[0], callback)
+
+    def test_reconnect(self):
+        """Lost connections are made again"""
+        self.devices[0].events = [self.VIDEO_EVENT]
+
+        queued = self.hub.subscribe(self.aps[0])
+        queued.get(timeout=1)
+
+        self.devices[0].connections[-1].shutdown(socket.SHUT_RDWR)
+        assert queued.get(timeout=1)['category'] == 'video'
+
+        assert len(self.devices[0].connections) == 3
+        assert self.hub.stats()['devices']['127.0.0.1:{0}'.format(self.devices[0].port)]['reconnects'] == 1
+
+    def test_reconnect_failed(self):
+        """When a connection can't be made again, the subscribers are given the exception"""
+        queued = self.hub.subscribe(self.aps[0])
+        assert wait_until(lambda: len(self.devices[0].connections) == 2)
+
+        self.devices[0].upgrade = FakeDevice.NOT_FOUND
+        self.devices[0].connections[-1].shutdown(socket.SHUT_RDWR)
+
+        assert isinstance(queued.get(timeout=1), RuntimeError)
+        assert self.hub.stats()['devices'] == {}
+
+    def test_bad_event(self):
+        """Unparseable events end the device's subscription with RuntimeError, others carry on"""
+        self.devices[0].events = [b'POST /event HTTP/1.1\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nhi']
+        self.devices[1].events = [self.VIDEO_EVENT]
+
+        first = self.hub.subscribe(self.aps[0])
+        second = self.hub.subscribe(self.aps[1])
+
+        assert isinstance(first.get(timeout=1), RuntimeError)
+        assert second.get(timeout=1)['category'] == 'video'
+        assert list(self.hub.stats()['devices']) == ['127.0.0.1:{0}'.format(self.devices[1].port)]
+
+    def test_bad_upgrade(self):
+        """subscribe() raises RuntimeError when the device won't send events"""
+        self.devices[0].upgrade = FakeDevice.NOT_FOUND
+
+        self.assertRaises(RuntimeError, self.hub.subscribe, self.aps[0])
+        assert self.hub.stats()['devices'] == {}
+
+    def test_close(self):
+        """close() stops the thread straight away, and the hub can't be used afterwards"""
+        self.hub.subscribe(self.aps[0])
+
+        start = time.time()
+        self.hub.close()
+
+        assert self.hub.thread.is_alive() is False
+        assert time.time() - start < .1
+
+        self.assertRaises(RuntimeError, self.hub.subscribe, self.aps[1])
+
+        # closing again does nothing
+        self.hub.close()
+
+
 class TestAirPlayControls(unittest.TestCase):
+    @staticmethod
+    def binary_plist(value):
+        body = plist_dumps(value, fmt=FMT_BINARY)
+        head = 'HTTP/1.1 200 OK\r\nContent-Type: application/x-apple-binary-plist\r\nContent-Length: {0}\r\n\r\n'
+
+        return head.format(len(body)).encode('ascii') + body
+
     @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
     def setUp(self, mock):
 
@@ -317,21 +744,103 @@ class TestAirPlayControls(unittest.TestCase):
 
         self.assertRaises(RuntimeError, go)
 
+    def test_response_split(self):
+        """A response split over several reads is reassembled"""
+        self.ap.control_socket.recv_data = [
+            'HTTP/1.1 200 OK\r\nContent-Type: text/param',
+            'eters\r\nContent-Length: 40\r\n\r\nduration: 83.124794',
+            '\r\nposition: 14.467000',
+        ]
+
+        res = self.ap._command('/foo')
+
+        assert res['duration'] == '83.124794'
+        assert res['position'] == '14.467000'
+
+    def test_response_large(self):
+        """Responses larger than a single read are not truncated"""
+        body = plist_dumps({'items': ['item {0}'.format(ii) for ii in range(10000)]})
+        head = 'HTTP/1.1 200 OK\r\nContent-Type: text/x-apple-plist+xml\r\nContent-Length: {0}\r\n\r\n'.format(
+            len(body)
+        ).encode('ascii')
+
+        data = head + body
+        self.ap.control_socket.recv_data = [data[ii:ii + 8192] for ii in range(0, len(data), 8192)]
+
+        assert len(self.ap._command('/foo')['items']) == 10000
+
+    def test_response_pipelined(self):
+        """When two responses arrive in one read, the second is kept for the next command"""
+        self.ap.control_socket.recv_data = [
+            'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\nHTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n'
+        ]
+
+        assert self.ap._command('/foo') is True
+        assert self.ap._command('/foo') is False
+
+    def test_response_closed(self):
+        """socket.error is raised if the device closes the connection mid response"""
+        self.ap.control_socket.recv_data = ['HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc', '']
+        self.ap.retries = 0
+
+        self.assertRaises(socket.error, self.ap._command, '/foo')
+        assert self.ap.control_socket is None
+
+    def test_keepalive(self):
+        """TCP keepalive is turned on for the control socket"""
+        assert self.ap.control_socket.options[(socket.SOL_SOCKET, socket.SO_KEEPALIVE)] == 1
+
     # these just all stubout _command and ensure it was called with the correct
     # parameters
+    @unittest.skipIf(FMT_BINARY is None, 'binary plists need Python 3.4 or later')
     def test_get_property(self):
-        """Get Property isn't implemented"""
-        def go():
-            self.ap.get_property()
+        """get_property() reads the value from the binary plist the device returns"""
+        self.ap.control_socket.recv_data = [
+            self.binary_plist({'errorCode': 0, 'value': [{'uri': 'http://192.0.2.114/a.mp4'}]})
+        ]
+
+        assert self.ap.get_property('playbackAccessLog') == [{'uri': 'http://192.0.2.114/a.mp4'}]
+        assert self.ap.control_socket.send_data == (
+            b'GET /getProperty?playbackAccessLog HTTP/1.1\r\n'
+            b'Accept: application/x-apple-binary-plist, text/x-apple-plist+xml\r\nContent-Length: 0\r\n\r\n'
+        )
 
-        self.assertRaises(NotImplementedError, go)
+    @unittest.skipIf(FMT_BINARY is None, 'binary plists need Python 3.4 or later')
+    def test_get_property_error(self):
+        """RuntimeError is raised when the device returns an error code"""
+        self.ap.control_socket.recv_data = [self.binary_plist({'errorCode': -6705})]
 
+        self.assertRaises(RuntimeError, self.ap.get_property, 'playbackErrorLog')
+
+    @unittest.skipIf(FMT_BINARY is None, 'binary plists need Python 3.4 or later')
     def test_set_property(self):
-        """Set Property isn't implemented"""
-        def go():
-            self.ap.set_property()
+        """set_property() sends the value as a binary plist"""
+        self.ap.control_socket.recv_data = [self.binary_plist({'errorCode': 0})]
+
+        assert self.ap.set_property('forwardEndTime', {'value': 0, 'epoch': 0}) is True
+
+        head, body = self.ap.control_socket.send_data.split(b'\r\n\r\n', 1)
+        assert head.split(b'\r\n') == [
+            b'PUT /setProperty?forwardEndTime HTTP/1.1',
+            b'Content-Type: application/x-apple-binary-plist',
+            'Content-Length: {0}'.format(len(body)).encode('ascii')
+        ]
+        assert body.startswith(b'bplist00')
+        assert plist_loads(body) == {'value': {'value': 0, 'epoch': 0}}
+
+    @patch('airplay.airplay.require_binary_plists', side_effect=NotImplementedError)
+    def test_property_unsupported(self, mock):
+        """NotImplementedError is raised when plistlib can't handle binary plists"""
+        self.assertRaises(NotImplementedError, self.ap.get_property, 'playbackAccessLog')
 
-        self.assertRaises(NotImplementedError, go)
+    @unittest.skipIf(FMT_BINARY is None, 'binary plists need Python 3.4 or later')
+    def test_no_accept(self):
+        """Binary plists aren't asked for when ACCEPT_BINARY_PLISTS is off"""
+        self.ap.ACCEPT_BINARY_PLISTS = False
+        self.ap.control_socket.recv_data = [self.binary_plist({'duration': 1.0})]
+
+        assert self.ap.playback_info() == {'duration': 1.0}
+        assert self.ap.control_socket.send_data == b'GET /playback-info HTTP/1.1\r\nContent-Length: 0\r\n\r\n'
 
     def test_server_info(self):
         """When server_info is called we pass the appropriate params"""
@@ -474,11 +983,7 @@ class TestRangeHTTPServerACL(unittest.TestCase):
         os.close(fd)
         self.testfile = path
 
-        os.chdir(os.path.dirname(self.testfile))
-
-        self.path = '/' + os.path.basename(self.testfile)
-
-        self.server = Mock()
+        self.server = Mock(catalog=MediaCatalog(), stat_cache=StatCache(), keep_alive_timeout=None)
 
         self.client = ('127.0.0.1', 9160)
 
@@ -498,32 +1003,40 @@ class TestRangeHTTPServerACL(unittest.TestCase):
     def test_allowed_host(self):
         """ValueError is raised if an unallowed host attempts access"""
 
-        self.server = Mock(allowed_host='192.0.2.99')
+        path = self.server.catalog.add(self.testfile, '192.0.2.99')
 
-        self.assertRaises(ValueError, self.fake_request, self.path)
+        self.assertRaises(ValueError, self.fake_request, path)
 
         self.http.send_error.assert_called_with(400, 'Bad Request')
 
+        # once the file is added for our host as well, we can access it
+        self.server.catalog.add(self.testfile, '127.0.0.1')
+        assert self.fake_request(path)[0] == os.path.realpath(self.testfile)
+
+    def test_any_host(self):
+        """Files added without an allowed host can be accessed by anyone"""
+
+        path = self.server.catalog.add(self.testfile)
+
+        assert self.fake_request(path)[0] == os.path.realpath(self.testfile)
+
     def test_no_directories(self):
         """ValueError is raised if directory access is attempted"""
 
-        self.server = Mock(allowed_host='127.0.0.1')
+        path = self.server.catalog.add(os.path.dirname(self.testfile), '127.0.0.1')
 
-        self.assertRaises(ValueError, self.fake_request, '/')
+        self.assertRaises(ValueError, self.fake_request, path)
 
         self.http.send_error.assert_called_with(400, 'Bad Request')
 
     def test_allowed_filename(self):
         """ValueError is raised if any other files are requested"""
 
-        self.server = Mock(
-            allowed_filename=os.path.realpath(self.testfile),
-            allowed_host='127.0.0.1'
-        )
+        path = self.server.catalog.add(self.testfile, '127.0.0.1')
 
-        result = self.fake_request(self.path)
+        result = self.fake_request(path)
 
-        assert result[0] == self.server.allowed_filename
+        assert result[0] == os.path.realpath(self.testfile)
 
         self.assertRaises(ValueError, self.fake_request, '/../../../../../.././etc/passwd')
         self.http.send_error.assert_called_with(400, 'Bad Request')
@@ -531,22 +1044,28 @@ class TestRangeHTTPServerACL(unittest.TestCase):
         self.assertRaises(ValueError, self.fake_request, '/foo')
         self.http.send_error.assert_called_with(400, 'Bad Request')
 
+        # the right token, but the wrong name
+        self.assertRaises(ValueError, self.fake_request, os.path.dirname(path) + '/foo')
+        self.http.send_error.assert_called_with(400, 'Bad Request')
+
+        # removed files can't be accessed
+        assert self.server.catalog.remove(self.testfile) is True
+        self.assertRaises(ValueError, self.fake_request, path)
+        self.http.send_error.assert_called_with(400, 'Bad Request')
+
     def test_file_open(self):
         """ValueError is raised if we cannot open or stat the file"""
 
-        self.server = Mock(
-            allowed_filename=os.path.realpath(self.testfile),
-            allowed_host='127.0.0.1'
-        )
+        path = self.server.catalog.add(self.testfile, '127.0.0.1')
 
         # can't open file
         os.chmod(self.testfile, 0000)
-        self.assertRaises(ValueError, self.fake_request, self.path)
+        self.assertRaises(ValueError, self.fake_request, path)
         self.http.send_error.assert_called_with(500, 'Internal Server Error')
 
         # file doesn't exist
         os.remove(self.testfile)
-        self.assertRaises(ValueError, self.fake_request, self.path)
+        self.assertRaises(ValueError, self.fake_request, path)
         self.http.send_error.assert_called_with(500, 'Internal Server Error')
 
 
@@ -572,13 +1091,15 @@ class TestRangeHTTPServerOSError(unittest.TestCase):
 
             return path, stats
 
-        with patch('airplay.airplay.RangeHTTPServer.check_path', side_effect=no_check_path):
+        with patch('airplay.http_server.RangeHTTPServer.check_path', side_effect=no_check_path):
             self.ap = AirPlay('127.0.0.1', 916, 'test')
             self.test_url = self.ap.serve(path)
 
         assert self.test_url.startswith('http://127.0.0.1')
 
     def tearDown(self):
+        MediaServer.stop_shared()
+
         try:
             os.remove(self.testfile)
         except OSError:
@@ -675,21 +1196,55 @@ class TestRangeHTTPServer(unittest.TestCase):
         self.testfile = path
 
     def tearDown(self):
+        MediaServer.stop_shared()
         os.remove(self.testfile)
 
-    def test_no_multiple_ranges(self):
-        """Multiple Ranges are not supported"""
+    def test_multiple_ranges(self):
+        """Multiple Ranges are returned as a multipart/byteranges response"""
 
         request = Request(self.test_url)
-        request.add_header('range', 'bytes=1-4,9-90')
+        request.add_header('range', 'bytes=1-4,9-90,-10')
 
-        error = None
+        response = urlopen(request)
+        msg = response.info()
+        body = response.read()
+
+        assert int(msg['content-length']) == len(body)
+        assert msg['content-type'].startswith('multipart/byteranges; boundary=')
+
+        # hand the body to the email package to parse the multipart message
+        raw = b'Content-Type: ' + msg['content-type'].encode('ascii') + b'\r\n\r\n' + body
         try:
-            urlopen(request)
-        except URLError as exc:
-            error = exc
+            parsed = email.message_from_bytes(raw)
+        except AttributeError:
+            parsed = email.message_from_string(raw)
 
-        assert error.code == 400
+        parts = parsed.get_payload()
+        size = len(self.data)
+
+        assert [part['content-range'] for part in parts] == [
+            'bytes 1-4/{0}'.format(size),
+            'bytes 9-90/{0}'.format(size),
+            'bytes {0}-{1}/{2}'.format(size - 10, size - 1, size)
+        ]
+
+        assert [part.get_payload(decode=True) for part in parts] == [
+            self.data[1:5],
+            self.data[9:91],
+            self.data[-10:]
+        ]
+
+    def test_coalesced_ranges(self):
+        """Multiple contiguous ranges are returned as a single range"""
+
+        request = Request(self.test_url)
+        request.add_header('range', 'bytes=1-4,5-9')
+
+        response = urlopen(request)
+        msg = response.info()
+
+        assert msg['content-range'] == "bytes 1-9/{0}".format(len(self.data))
+        assert self.data[1:10] == response.read()
 
     def test_unsatisfiable_range(self):
         """Range requests out of bounds return HTTP 416"""
@@ -756,60 +1311,1972 @@ class TestRangeHTTPServer(unittest.TestCase):
         # we should get the proper content-header back
         assert int(msg['content-length']) == len(self.data)
 
+    def test_validators(self):
+        """Responses include ETag and Last-Modified headers"""
+        request = Request(self.test_url)
+        request.get_method = lambda: 'HEAD'
+        head = urlopen(request).info()
 
-class FakeZeroconf(object):
-    def __init__(self, info=None):
-        self.info = info
+        msg = urlopen(Request(self.test_url)).info()
 
-    def get_service_info(self, *args, **kwargs):
-        return self.info
+        assert msg['etag'].startswith('"')
+        assert msg['etag'] == head['etag']
+        assert msg['last-modified'] == head['last-modified']
 
-    def close(self):
-        pass
+    def conditional_get(self, **headers):
+        request = Request(self.test_url)
+        for kk, vv in headers.items():
+            request.add_header(kk.replace('_', '-'), vv)
 
+        try:
+            response = urlopen(request)
+        except URLError as exc:
+            return exc.code, exc.info(), b''
 
-class FakeServiceBrowser(object):
-    name = 'fake-service.local'
-    info = None
+        return response.getcode(), response.info(), response.read()
 
-    def __init__(self, *args, **kwargs):
-        self.handler = kwargs.get('handlers')[0]
-        self.handler(FakeZeroconf(self.info), args[1], self.name, ServiceStateChange.Added)
+    def test_if_none_match(self):
+        """If-None-Match returns 304 when the ETag matches and the file otherwise"""
+        etag = urlopen(Request(self.test_url)).info()['etag']
 
+        code, msg, body = self.conditional_get(if_none_match=etag)
+        assert code == 304
+        assert msg['etag'] == etag
+        assert body == b''
 
-class MockSocket(object):
-    sock = None
-    timeout = None
-    error = socket.error
-    AF_INET = socket.AF_INET
-    SOCK_STREAM = socket.SOCK_STREAM
+        assert self.conditional_get(if_none_match='W/' + etag)[0] == 304
+        assert self.conditional_get(if_none_match='"nope", *')[0] == 304
+        assert self.conditional_get(if_none_match='"nope"')[2] == self.data
 
-    def __init__(self, *args, **kwargs):
-        self.send_data = ''
-        self.recv_data = ''
+    def test_if_modified_since(self):
+        """If-Modified-Since returns 304 unless the file is newer"""
+        last_modified = urlopen(Request(self.test_url)).info()['last-modified']
 
-    def recv(self, *args, **kwargs):
-        try:
-            basestring
-        except NameError:
-            basestring = str
+        assert self.conditional_get(if_modified_since=last_modified)[0] == 304
+        assert self.conditional_get(if_modified_since='Thu, 01 Jan 1970 00:00:00 GMT')[2] == self.data
+        assert self.conditional_get(if_modified_since='not a date')[2] == self.data
 
-        if isinstance(self.recv_data, basestring):
-            data = self.recv_data
-        else:
-            try:
-                data = self.recv_data.pop(0)
-            except IndexError:
-                raise socket.timeout
+    def test_if_range(self):
+        """The Range header is only honoured when If-Range matches the file"""
+        msg = urlopen(Request(self.test_url)).info()
 
-        try:
-            return bytes(data, 'UTF-8')
+        for validator in (msg['etag'], msg['last-modified']):
+            code, _, body = self.conditional_get(range='bytes=1-4', if_range=validator)
+            assert code == 206
+            assert body == self.data[1:5]
+
+        for validator in ('"nope"', 'W/' + msg['etag'], 'Thu, 01 Jan 1970 00:00:00 GMT'):
+            code, _, body = self.conditional_get(range='bytes=1-4', if_range=validator)
+            assert code == 200
+            assert body == self.data
+
+    def test_keep_alive(self):
+        """Multiple requests can be made on a single HTTP/1.1 connection"""
+        url = urlparse(self.test_url)
+        conn = HTTPConnection(url.hostname, url.port, timeout=5)
+
+        conn.request('GET', url.path, headers={'Range': 'bytes=0-9'})
+        response = conn.getresponse()
+        assert response.read() == self.data[0:10]
+
+        sock = conn.sock
+        assert sock is not None
+
+        conn.request('GET', url.path, headers={'Range': 'bytes=10-19'})
+        response = conn.getresponse()
+        assert response.read() == self.data[10:20]
+
+        # the second request went over the same connection
+        assert conn.sock is sock
+
+        conn.close()
+
+    def test_concurrent_connections(self):
+        """An idle connection does not stop other connections from being served"""
+        url = urlparse(self.test_url)
+
+        idle = socket.create_connection((url.hostname, url.port))
+        try:
+            assert self.data == urlopen(Request(self.test_url), timeout=5).read()
+        finally:
+            idle.close()
+
+    def serve(self, **kwargs):
+        """Start a server for this test on a background thread, and return it and the URL path of the test file"""
+        httpd = RangeHTTPServer.create(('127.0.0.1', 0), cache_bytes=None, **kwargs)
+        path = httpd.catalog.add(self.testfile)
+
+        thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': .1})
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            httpd.shutdown()
+            httpd.server_close()
+        self.addCleanup(stop)
+
+        return httpd, path
+
+    def test_silent_connection_timeout(self):
+        """A connection that never sends a request is closed after the keep alive timeout"""
+        httpd, _ = self.serve(keep_alive_timeout=.2)
+
+        sock = socket.create_connection(httpd.server_address, timeout=5)
+        try:
+            start = monotonic()
+            assert sock.recv(1) == b''
+            assert monotonic() - start < 2
+        finally:
+            sock.close()
+
+    def test_idle_keep_alive_connections(self):
+        """The longest idle connection is closed to make room, so new connections are served straight away"""
+        httpd, path = self.serve(max_connections=2, keep_alive_timeout=5)
+
+        conns = []
+        try:
+            # the third connection arrives when both the others are idle
+            for _ in range(3):
+                assert wait_until(lambda: len(httpd._idle) == len(conns))
+
+                conn = HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+                conns.append(conn)
+
+                start = monotonic()
+                conn.request('GET', path, headers={'Range': 'bytes=0-9'})
+                assert conn.getresponse().read() == self.data[0:10]
+                assert monotonic() - start < 1
+
+            # the first was closed for it, the second is still open
+            assert conns[0].sock.recv(1) == b''
+
+            conns[1].request('GET', path, headers={'Range': 'bytes=10-19'})
+            assert conns[1].getresponse().read() == self.data[10:20]
+        finally:
+            for conn in conns:
+                conn.close()
+
+    def test_busy_connections(self):
+        """When every connection is handling a request, new connections are refused with 503"""
+        httpd, path = self.serve(max_connections=2, keep_alive_timeout=5)
+
+        # requests that haven't finished arriving
+        busy = []
+        try:
+            for _ in range(2):
+                sock = socket.create_connection(httpd.server_address, timeout=5)
+                busy.append(sock)
+                sock.sendall(b'GET ' + path.encode('ascii') + b' HTTP/1.1\r\n')
+
+            time.sleep(.2)
+
+            conn = HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+            conn.request('GET', path)
+            assert conn.getresponse().status == 503
+            conn.close()
+
+            # once one finishes, there's room again
+            busy[0].sendall(b'Connection: close\r\n\r\n')
+            assert busy[0].recv(65536).startswith(b'HTTP/1.1 200')
+            busy[0].close()
+            time.sleep(.2)
+
+            conn = HTTPConnection('127.0.0.1', httpd.server_address[1], timeout=5)
+            conn.request('GET', path, headers={'Range': 'bytes=0-9'})
+            assert conn.getresponse().read() == self.data[0:10]
+            conn.close()
+        finally:
+            for sock in busy:
+                sock.close()
+
+
+class TestMediaServer(unittest.TestCase):
+    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
+    def setUp(self, mock):
+
+        mock.sock = MockSocket()
+        mock.sock.recv_data = """HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\n\r\n"""
+
+        self.ap = AirPlay('127.0.0.1', 916, 'test')
+        self.other = AirPlay('127.0.0.1', 917, 'other')
+
+        self.testfiles = []
+        for data in (b'first', b'second'):
+            fd, path = tempfile.mkstemp(suffix='.mp4')
+            os.write(fd, data)
+            os.close(fd)
+            self.testfiles.append(path)
+
+    def tearDown(self):
+        MediaServer.stop_shared()
+
+        for path in self.testfiles:
+            os.remove(path)
+
+    def test_shared(self):
+        """Files served by different AirPlay instances share one server"""
+        first = self.ap.serve(self.testfiles[0])
+        second = self.other.serve(self.testfiles[1])
+
+        assert urlparse(first).port == urlparse(second).port
+        assert first != second
+
+        assert urlopen(Request(first)).read() == b'first'
+        assert urlopen(Request(second)).read() == b'second'
+
+        assert MediaServer.shared().stats()['files'] == 2
+
+    def test_same_file(self):
+        """Serving the same file again returns the same URL"""
+        assert self.ap.serve(self.testfiles[0]) == self.other.serve(self.testfiles[0])
+
+    def test_unregister(self):
+        """Files that are unregistered are no longer served"""
+        url = self.ap.serve(self.testfiles[0])
+
+        assert MediaServer.shared().unregister(self.testfiles[0]) is True
+        assert MediaServer.shared().unregister(self.testfiles[0]) is False
+
+        error = None
+        try:
+            urlopen(Request(url))
+        except URLError as exc:
+            error = exc
+
+        assert error.code == 400
+
+    def test_not_a_file(self):
+        """Only files can be served"""
+        self.assertRaises(ValueError, self.ap.serve, os.path.dirname(self.testfiles[0]))
+
+    def test_stop(self):
+        """Once stopped, a new shared server is started when needed"""
+        server = MediaServer.shared()
+        MediaServer.stop_shared()
+
+        assert server.running is False
+        self.assertRaises(RuntimeError, server.register, self.testfiles[0])
+
+        assert MediaServer.shared() is not server
+
+    def test_thread_mode(self):
+        """In thread mode the server runs in this process and stops when asked"""
+        url = self.ap.serve(self.testfiles[0], mode='thread')
+
+        server = MediaServer.shared()
+        assert server.mode == 'thread'
+        assert server.ready.is_set()
+        assert server._process is None
+
+        assert urlopen(Request(url)).read() == b'first'
+        assert server.stats()['files'] == 1
+
+        MediaServer.stop_shared()
+
+        assert server.running is False
+        assert server.ready.is_set() is False
+        self.assertRaises(URLError, urlopen, Request(url), timeout=1)
+
+    def test_context_manager(self):
+        """The server can be used as a context manager"""
+        with MediaServer(mode='thread') as server:
+            assert server.running
+            self.assertRaises(RuntimeError, server.start)
+
+        assert server.running is False
+
+    def test_bad_mode(self):
+        """Only process and thread modes are supported"""
+        self.assertRaises(ValueError, MediaServer, mode='fork')
+
+    def test_process_start_failure(self):
+        """Errors starting the server in the child process are raised by start()"""
+        log_path = os.path.join(tempfile.gettempdir(), 'airplay-nonexistent', 'access.log')
+
+        server = MediaServer(mode='process', access_log=log_path)
+        self.assertRaises(EnvironmentError, server.start)
+
+        assert server.running is False
+        assert server._process is None
+        assert server.ready.is_set() is False
+
+        # the shared server isn't wedged by a failed start
+        self.assertRaises(EnvironmentError, MediaServer.shared, access_log=log_path)
+        assert MediaServer.shared().running
+
+    def test_process_streams_restored(self):
+        """The child's stdout and stderr are put back when it stops, so they can be flushed as it exits"""
+        stdout, stderr = sys.stdout, sys.stderr
+
+        conn, child_conn = Pipe()
+        thread = threading.Thread(target=run_process, args=(child_conn, {'address': ('127.0.0.1', 0)}))
+        thread.start()
+
+        ok, _ = conn.recv()
+        assert ok
+        conn.send(('stop',))
+        thread.join(5)
+
+        assert sys.stdout is stdout and sys.stderr is stderr
+        sys.stdout.flush()
+
+    def test_process_died(self):
+        """Commands to a child process that has died raise RuntimeError"""
+        server = MediaServer.shared()
+        server._process.terminate()
+        server._process.join(5)
+
+        self.assertRaises(RuntimeError, server.stats)
+        assert server._process is None
+        assert server.running is False
+
+
+class TestRangeHTTPServerSingleConnection(unittest.TestCase):
+    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
+    def setUp(self, mock):
+
+        mock.sock = MockSocket()
+        mock.sock.recv_data = """HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\n\r\n"""
+
+        self.ap = AirPlay('127.0.0.1', 916, 'test')
+
+        self.data = b'abcdefghijklmnopqrstuvwxyz' * 1024
+
+        fd, path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+
+        self.test_url = self.ap.serve(path, max_connections=None)
+        self.testfile = path
+
+    def tearDown(self):
+        MediaServer.stop_shared()
+        os.remove(self.testfile)
+
+    def test_connection_closed(self):
+        """When max_connections is None the connection is closed after each request"""
+        url = urlparse(self.test_url)
+        conn = HTTPConnection(url.hostname, url.port, timeout=5)
+
+        conn.request('GET', url.path)
+        response = conn.getresponse()
+
+        assert response.version == 10
+        assert response.read() == self.data
+
+        conn.close()
+
+
+class TestRangeHTTPServerSendRange(unittest.TestCase):
+    def setUp(self):
+        self.data = b'abcdefghijklmnopqrstuvwxyz' * 1024
+
+        fd, path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+        self.testfile = path
+
+        self.server_sock, self.client_sock = socket.socketpair()
+
+        # just the handler, without a request to handle
+        class Handler(RangeHTTPServer):
+            def __init__(self):
+                pass
+
+        self.http = Handler()
+        self.http.server = Mock(block_cache=None, pacer=None, readahead=None)
+        self.http.connection = self.server_sock
+        self.http.wfile = self.server_sock.makefile('wb', 0)
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+        os.remove(self.testfile)
+
+    def send_range(self, first, last):
+        with open(self.testfile, 'rb') as fh:
+            self.http.send_range(fh, first, last)
+
+        self.server_sock.shutdown(socket.SHUT_WR)
+
+        received = b''
+        while True:
+            chunk = self.client_sock.recv(65536)
+            if not chunk:
+                return received
+            received += chunk
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'os.sendfile() is not available')
+    def test_sendfile(self):
+        """When sendfile is enabled the requested range is sent with os.sendfile()"""
+        self.http.use_sendfile = True
+
+        with patch('airplay.http_server.os.sendfile', side_effect=os.sendfile) as sendfile:
+            assert self.send_range(10, 5000) == self.data[10:5000]
+
+        assert sendfile.called
+
+    @unittest.skipUnless(hasattr(os, 'sendfile'), 'os.sendfile() is not available')
+    def test_sendfile_unsupported(self):
+        """When sendfile() isn't supported for the socket/file we fall back to read()/write()"""
+        self.http.use_sendfile = True
+
+        with patch('airplay.http_server.os.sendfile', side_effect=OSError(errno.EINVAL, 'Invalid argument')):
+            assert self.send_range(0, len(self.data)) == self.data
+
+    def test_copy(self):
+        """When sendfile is disabled, the requested range is copied through python"""
+        self.http.use_sendfile = False
+
+        with patch('airplay.http_server.os') as mock_os:
+            assert self.send_range(1, 4) == self.data[1:4]
+
+        assert not mock_os.sendfile.called
+
+    def test_cached(self):
+        """When the server has a block cache, the start and end of the file are sent from it"""
+        self.http.server.block_cache = BlockCache(block_size=1024, window=4096)
+
+        # the middle of the file is sent directly, the rest from the cache
+        assert self.send_range(100, len(self.data) - 100) == self.data[100:-100]
+
+        assert self.http.server.block_cache.stats()['misses'] == 8
+        assert self.http.server.block_cache.stats()['hits'] == 0
+
+    def test_paced(self):
+        """When the server has a pacer, the range is sent in chunks that are throttled to the client's rate"""
+        self.http.use_sendfile = False
+        self.http.client_address = ('127.0.0.1', 12345)
+        self.http.server.pacer = Pacer(client_rate=1024 * 1024)
+
+        with patch('airplay.pacing.Stream.throttle') as throttle:
+            assert self.send_range(0, len(self.data)) == self.data
+
+        assert sum(call[0][0] for call in throttle.call_args_list) == len(self.data)
+
+        # the stream is removed once the response is sent
+        assert self.http.server.pacer.stats()['streams'] == []
+        assert self.http.stream is None
+
+    def test_adaptive_chunks(self):
+        """Chunks start at buffer_size and double up to copy_size"""
+        self.http.use_sendfile = False
+        self.http.buffer_size = 10
+        self.http.copy_size = 80
+
+        sizes = []
+        real_write = self.http.wfile.write
+
+        def write(data):
+            sizes.append(len(data))
+            return real_write(data)
+
+        # python 2's file objects can't be patched, so stand in for the whole file
+        self.http.wfile = Mock(write=Mock(side_effect=write))
+        assert self.send_range(0, 400) == self.data[0:400]
+
+        assert sizes[:5] == [10, 20, 40, 80, 80]
+
+    @unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'os.posix_fadvise() is not available')
+    def test_fadvise(self):
+        """The kernel is told the range will be read sequentially"""
+        with patch('airplay.readahead.os.posix_fadvise') as fadvise:
+            self.send_range(10, 5000)
+
+        fadvise.assert_any_call(ANY, 10, 4990, os.POSIX_FADV_SEQUENTIAL)
+        fadvise.assert_any_call(ANY, 10, 4990, os.POSIX_FADV_WILLNEED)
+
+    def test_read_ahead(self):
+        """When the server reads ahead, the window follows the range as it's sent"""
+        self.http.use_sendfile = False
+        self.http.client_address = ('127.0.0.1', 12345)
+        self.http.server.readahead = ReadAhead(size=4096)
+
+        with patch.object(ReadAhead, 'schedule') as schedule:
+            assert self.send_range(0, len(self.data)) == self.data
+
+        # the first window is read as soon as the range starts, then each one as the last is half used
+        assert schedule.call_args_list[0][0][2:] == (0, 4096)
+        assert schedule.call_args_list[-1][0][3] == len(self.data)
+        assert self.http.window is None
+
+
+class TestPacer(unittest.TestCase):
+    def rates(self, pacer):
+        return sorted(round(rate, 2) for _, rate in pacer.stats()['streams'])
+
+    def test_unlimited(self):
+        """Without limits streams are not throttled"""
+        pacer = Pacer()
+        with pacer.stream('a') as stream:
+            assert stream.rate == float('inf')
+            assert stream.chunk_size == stream.MAX_CHUNK
+
+            with patch('airplay.pacing.time.sleep') as sleep:
+                stream.throttle(100 * 1024 * 1024)
+            assert not sleep.called
+
+    def test_fair_share(self):
+        """The total rate is split evenly between streams"""
+        pacer = Pacer(rate=100)
+        with pacer.stream('a'), pacer.stream('b'):
+            assert self.rates(pacer) == [50, 50]
+
+            with pacer.stream('b'):
+                assert self.rates(pacer) == [33.33] * 3
+
+        assert self.rates(pacer) == []
+
+    def test_client_limit(self):
+        """A client limited to less than its share leaves the rest to the others"""
+        pacer = Pacer(rate=100, client_rate=10)
+        with pacer.stream('a'), pacer.stream('a'), pacer.stream('b'):
+            assert self.rates(pacer) == [5, 5, 10]
+
+        pacer = Pacer(rate=100, client_rate=80)
+        with pacer.stream('a'), pacer.stream('b'):
+            with pacer.stream('c'):
+                assert self.rates(pacer) == [33.33] * 3
+            assert self.rates(pacer) == [50, 50]
+
+    def test_client_limit_only(self):
+        """Without a total rate each client gets its own limit"""
+        pacer = Pacer(client_rate=10)
+        with pacer.stream('a'), pacer.stream('b'):
+            assert self.rates(pacer) == [10, 10]
+
+    def test_throttle(self):
+        """Sending more than the bucket holds sleeps long enough to stay at the stream's rate"""
+        bucket = TokenBucket(rate=1000, burst=1000)
+        assert bucket.consume(1000) == 0
+
+        delay = bucket.consume(500)
+        assert .4 < delay <= .5
+
+
+class TestPipeline(unittest.TestCase):
+    SCRUB = 'HTTP/1.1 200 OK\r\nContent-Type: text/parameters\r\nContent-Length: 40\r\n\r\n' \
+            'duration: 83.124794\r\nposition: 14.467000'
+    OK = 'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n'
+
+    @patch('airplay.airplay.socket', new_callable=lambda: MockSocket)
+    def setUp(self, mock):
+        mock.sock = MockSocket()
+        self.ap = AirPlay('192.0.2.23', 916, 'test')
+
+    def test_one_write(self):
+        """Queued commands are sent in a single write, and the responses matched in order"""
+        self.ap.control_socket.recv_data = [self.OK + self.SCRUB, self.OK]
+
+        with self.ap.pipeline() as batch:
+            rate = batch.rate(1.0)
+            scrub = batch.scrub()
+            stop = batch.stop()
+
+            assert not rate.done
+            self.assertRaises(RuntimeError, lambda: rate.value)
+
+        # binary plists are only asked for where they can be read
+        assert self.ap.control_socket.send_data == (
+            b'POST /rate?value=1.0 HTTP/1.1\r\nContent-Length: 0\r\n\r\n' +
+            build_request('/scrub', headers=accept_headers('GET')) +
+            b'POST /stop HTTP/1.1\r\nContent-Length: 0\r\n\r\n'
+        )
+        if BINARY_PLISTS:
+            assert b'\r\nAccept: application/x-apple-binary-plist, text/x-apple-plist+xml\r\n' in \
+                self.ap.control_socket.send_data
+
+        assert rate.value is True
+        assert scrub.value == {'duration': 83.124794, 'position': 14.467}
+        assert stop.value is True
+
+    def test_scrub_position(self):
+        """Seeking queues the POST and the GET that reads the position back"""
+        self.ap.control_socket.recv_data = [self.OK, self.SCRUB]
+
+        batch = self.ap.pipeline()
+        scrub = batch.scrub(14.467)
+        assert len(batch) == 2
+
+        assert len(batch.execute()) == 2
+        assert scrub.value['position'] == 14.467
+
+    def test_error(self):
+        """Every response is read even if one can't be decoded, then the first error is raised"""
+        self.ap.control_socket.recv_data = [
+            'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nhi',
+            self.SCRUB,
+        ]
+
+        batch = self.ap.pipeline()
+        info = batch.playback_info()
+        scrub = batch.scrub()
+
+        self.assertRaises(RuntimeError, batch.execute)
+        self.assertRaises(RuntimeError, lambda: info.value)
+        assert scrub.value['duration'] == 83.124794
+
+    def test_exception(self):
+        """Nothing is sent if the with block raises"""
+        def go():
+            with self.ap.pipeline() as batch:
+                batch.stop()
+                raise KeyError
+
+        self.assertRaises(KeyError, go)
+        assert self.ap.control_socket.send_data == ''
+
+
+class TestResponseParser(unittest.TestCase):
+    RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 5\r\n\r\nhello'
+
+    def test_byte_at_a_time(self):
+        """A response fed one byte at a time is parsed once it's complete"""
+        parser = ResponseParser()
+
+        responses = []
+        for ii in range(len(self.RESPONSE)):
+            responses.extend(parser.feed(self.RESPONSE[ii:ii + 1]))
+            if ii < len(self.RESPONSE) - 1:
+                assert responses == []
+
+        assert len(responses) == 1
+        assert responses[0].status == 200
+        assert responses[0].reason == 'OK'
+        assert responses[0].getheader('Content-Type') == 'text/plain'
+        assert responses[0].body == b'hello'
+        assert parser.pending == 0
+
+    def test_several(self):
+        """Several responses in one read are all returned, and a partial one is kept"""
+        parser = ResponseParser()
+
+        responses = parser.feed(self.RESPONSE * 2 + self.RESPONSE[:10])
+        assert [response.body for response in responses] == [b'hello', b'hello']
+        assert parser.pending == 10
+
+        assert parser.feed(self.RESPONSE[10:])[0].body == b'hello'
+
+    def test_no_content_length(self):
+        """Responses without a Content-Length have no body"""
+        response = ResponseParser().feed(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: PTTH/1.0\r\n\r\n')[0]
+
+        assert response.status == 101
+        assert response.body == b''
+
+    def test_switching_protocols(self):
+        """Parsing stops after 101 Switching Protocols, and what follows can be parsed as requests"""
+        parser = ResponseParser()
+        event = FakeDevice.event('video', 'playing')
+
+        responses = parser.feed(FakeDevice.SWITCHING + event[:50])
+        assert [response.status for response in responses] == [101]
+        assert parser.feed(event[50:]) == []
+
+        requests = RequestParser().feed(parser.unparsed())
+        assert requests[0].method == 'POST'
+        assert requests[0].path == '/event'
+        assert decode_event(requests[0].path, requests[0].getheader('content-type'), requests[0].body)['state'] == \
+            'playing'
+
+    def test_invalid(self):
+        """ProtocolError is raised for things that aren't HTTP responses"""
+        for data in (
+            b'SSH-2.0-OpenSSH\r\n\r\n',
+            b'HTTP/1.1 abc OK\r\n\r\n',
+            b'HTTP/1.1 200 OK\r\nno colon\r\n\r\n',
+            b'HTTP/1.1 200 OK\r\nContent-Length: lots\r\n\r\n',
+            b'HTTP/1.1 200 OK\r\nContent-Length: -1\r\n\r\n',
+        ):
+            self.assertRaises(ProtocolError, ResponseParser().feed, data)
+
+    def test_oversized(self):
+        """ProtocolError is raised rather than buffering without limit"""
+        parser = ResponseParser()
+        parser.max_head = 100
+
+        self.assertRaises(ProtocolError, parser.feed, b'HTTP/1.1 200 OK\r\n' + b'X-Foo: bar\r\n' * 20)
+
+        parser = ResponseParser()
+        parser.max_body = 100
+
+        self.assertRaises(ProtocolError, parser.feed, b'HTTP/1.1 200 OK\r\nContent-Length: 101\r\n\r\n')
+
+
+class TestSubscription(unittest.TestCase):
+    @staticmethod
+    def event(category, state):
+        return {'category': category, 'state': state}
+
+    def test_filter(self):
+        """Events are matched by category and state"""
+        sub = Subscription(categories=['video', 'photo'], states=['playing'])
+
+        assert sub.deliver(None, self.event('video', 'playing'))
+        assert sub.deliver(None, self.event('photo', 'playing'))
+        assert not sub.deliver(None, self.event('video', 'paused'))
+        assert not sub.deliver(None, self.event('slideshow', 'playing'))
+
+        # exceptions always match
+        assert sub.deliver(None, RuntimeError())
+
+        assert sub.qsize() == 3
+
+    def test_callback(self):
+        """Events are passed to the callback instead of being queued"""
+        callback = Mock()
+        sub = Subscription(callback=callback)
+
+        sub.deliver('device', self.event('video', 'paused'))
+
+        callback.assert_called_once_with('device', self.event('video', 'paused'))
+        assert sub.qsize() == 0
+
+    def test_drop_oldest(self):
+        """The oldest events are dropped when the queue is full"""
+        sub = Subscription(maxsize=2)
+        for state in ('loading', 'paused', 'playing'):
+            sub.put(self.event('video', state))
+
+        assert [sub.get()['state'] for _ in range(2)] == ['paused', 'playing']
+        assert sub.dropped == 1
+
+    def test_drop_newest(self):
+        """New events are dropped when the queue is full"""
+        sub = Subscription(maxsize=2, overflow=Subscription.DROP_NEWEST)
+        for state in ('loading', 'paused', 'playing'):
+            sub.put(self.event('video', state))
+
+        assert [sub.get()['state'] for _ in range(2)] == ['loading', 'paused']
+        assert sub.dropped == 1
+
+    def test_coalesce(self):
+        """When the queue is full, queued events of the same category are replaced by the latest"""
+        sub = Subscription(categories=None, maxsize=3, overflow=Subscription.COALESCE)
+        sub.put(self.event('video', 'loading'))
+        sub.put(self.event('photo', 'paused'))
+        sub.put(self.event('video', 'paused'))
+        sub.put(self.event('video', 'playing'))
+
+        assert [sub.get()['state'] for _ in range(2)] == ['paused', 'playing']
+        assert sub.dropped == 2
+
+        # when there isn't one of the same category, the oldest goes
+        sub.put(self.event('video', 'stopped'))
+        sub.put(self.event('photo', 'playing'))
+        sub.put(self.event('slideshow', 'playing'))
+        sub.put(self.event('screen', 'playing'))
+
+        assert [sub.get()['category'] for _ in range(3)] == ['photo', 'slideshow', 'screen']
+        assert sub.dropped == 3
+
+    def test_exception_not_dropped(self):
+        """The exception that ends the events is queued even when the queue is full"""
+        sub = Subscription(maxsize=1, overflow=Subscription.DROP_NEWEST)
+        sub.put(self.event('video', 'paused'))
+        sub.put(RuntimeError())
+
+        assert sub.qsize() == 2
+
+        events = iter(sub)
+        assert next(events)['state'] == 'paused'
+        self.assertRaises(RuntimeError, next, events)
+
+    def test_get(self):
+        """get() raises queue.Empty when there's nothing to return"""
+        sub = Subscription()
+
+        self.assertRaises(queue.Empty, sub.get, False)
+
+        start = time.time()
+        self.assertRaises(queue.Empty, sub.get, True, .05)
+        assert time.time() - start >= .05
+
+        threading.Timer(.05, sub.put, [self.event('video', 'paused')]).start()
+        assert sub.get(timeout=1)['state'] == 'paused'
+
+    def test_bad_overflow(self):
+        """ValueError is raised for an unknown overflow policy"""
+        self.assertRaises(ValueError, Subscription, overflow='explode')
+
+
+class TestPlaybackRecords(unittest.TestCase):
+    PLAYING = {
+        'category': 'video',
+        'sessionID': 13,
+        'state': 'playing',
+        'params': {
+            'duration': 1801.0,
+            'position': 14.4,
+            'rate': 1.0,
+            'loadedTimeRanges': [{'start': 0.0, 'duration': 60.0}],
+        }
+    }
+
+    def test_event(self):
+        """Events have the common fields as attributes, and still look like the plist"""
+        event = PlaybackEvent.from_plist(self.PLAYING)
+
+        assert (event.category, event.state, event.session_id, event.reason) == ('video', 'playing', 13, None)
+        assert (event.position, event.duration, event.rate) == (14.4, 1801.0, 1.0)
+
+        assert event == self.PLAYING
+        assert event.raw == self.PLAYING
+        assert event['state'] == 'playing'
+        assert event['params']['loadedTimeRanges'] == [{'start': 0.0, 'duration': 60.0}]
+        assert event.get('reason') is None
+        assert 'reason' not in event
+        assert sorted(event) == ['category', 'params', 'sessionID', 'state']
+
+        self.assertRaises(KeyError, lambda: event['reason'])
+
+        # python 2's Mapping doesn't have __slots__, so records there have a __dict__ too
+        if sys.version_info >= (3, ):
+            self.assertRaises(AttributeError, setattr, event, 'other', 1)
+
+    def test_event_without_params(self):
+        """Events without params don't keep anything but the slots"""
+        plist = {'category': 'video', 'state': 'stopped', 'reason': 'ended', 'sessionID': 13}
+        event = PlaybackEvent.from_plist(plist)
+
+        assert event._extra is None and event._params is None
+        assert event.position is None
+        assert dict(event) == plist
+
+    def test_info(self):
+        """playback_info() results have the common fields as attributes, and still look like the plist"""
+        plist = dict(self.PLAYING['params'], readyToPlay=True, uuid='x')
+        info = PlaybackInfo.from_plist(plist)
+
+        assert (info.position, info.ready_to_play, info.likely_to_keep_up) == (14.4, True, None)
+        assert info == plist
+        assert info['uuid'] == 'x'
+        assert len(info) == 6
+
+        info = PlaybackInfo(position=1.0, rate=0.0)
+        assert dict(info) == {'position': 1.0, 'rate': 0.0}
+        self.assertRaises(TypeError, PlaybackInfo, speed=1.0)
+
+    def test_parsed(self):
+        """The parsers and playback_info() produce them"""
+        assert isinstance(EventParser().feed(FakeDevice.event('video', 'paused'))[0], PlaybackEvent)
+
+        assert playback_info_result(False) is False
+        assert isinstance(playback_info_result({'position': 1.0}), PlaybackInfo)
+
+
+class TestEventParser(unittest.TestCase):
+    VIDEO_EVENT = FakeDevice.event('video', 'playing')
+    PHOTO_EVENT = FakeDevice.event('photo', 'paused')
+
+    def test_coalesced(self):
+        """Several events received in one read are all returned, in order"""
+        events = EventParser().feed(self.VIDEO_EVENT + self.PHOTO_EVENT + self.VIDEO_EVENT)
+
+        assert [event['category'] for event in events] == ['video', 'photo', 'video']
+
+    def test_fragmented(self):
+        """An event split over many reads is returned once it's complete"""
+        parser = EventParser()
+
+        data = self.PHOTO_EVENT + self.VIDEO_EVENT
+        events = []
+        for ii in range(len(data)):
+            events.extend(parser.feed(data[ii:ii + 1]))
+
+        assert [event['state'] for event in events] == ['paused', 'playing']
+        assert parser.pending == 0
+
+    def test_invalid(self):
+        """ProtocolError is raised for requests that aren't events"""
+        self.assertRaises(ProtocolError, EventParser().feed, b'POST /foo HTTP/1.1\r\nContent-Length: 0\r\n\r\n')
+        self.assertRaises(
+            ProtocolError,
+            EventParser().feed,
+            b'POST /event HTTP/1.1\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nhi'
+        )
+
+
+class TestAccessLog(unittest.TestCase):
+    def test_write(self):
+        """Records are written as JSON lines when they are logged"""
+        fh = StringIO()
+        log = AccessLog(fh)
+        log.log({'status': 200, 'bytes': 10})
+        log.log({'status': 206, 'bytes': 4})
+        log.close()
+
+        assert [json.loads(line) for line in fh.getvalue().splitlines()] == [
+            {'status': 200, 'bytes': 10},
+            {'status': 206, 'bytes': 4},
+        ]
+        assert log.stats()['written'] == 2
+
+    def test_full(self):
+        """Records are dropped rather than blocking when the writer can't keep up"""
+        log = AccessLog(StringIO(), max_queue=1)
+        log.close()
+
+        log._queue.put({})
+        log.log({})
+
+        assert log.stats()['dropped'] == 1
+
+    def test_write_error(self):
+        """Records that can't be written are dropped, and the writer keeps going"""
+        class FailingFile(StringIO):
+            fail = True
+
+            def write(self, data):
+                if self.fail:
+                    self.fail = False
+                    raise IOError(errno.ENOSPC, 'No space left on device')
+                return StringIO.write(self, data)
+
+        fh = FailingFile()
+        log = AccessLog(fh)
+        log.log({'status': 200})
+        assert wait_until(lambda: log.stats()['dropped'] == 1)
+
+        log.log({'status': 206})
+        log.close()
+
+        assert log.stats() == {'written': 1, 'dropped': 1, 'queued': 0}
+        assert json.loads(fh.getvalue()) == {'status': 206}
+
+    def test_close_dead_writer(self):
+        """close() doesn't wait for a writer that has stopped"""
+        log = AccessLog(StringIO(), max_queue=1)
+        log.close()
+
+        log._thread = threading.Thread(target=lambda: None)
+        log._thread.start()
+        log._thread.join()
+        log._queue.put({})
+
+        start = monotonic()
+        log.close()
+        assert monotonic() - start < 1
+
+    def test_requests(self):
+        """The media server logs each request with its range, status, size and timings"""
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'abcdefghijklmnopqrstuvwxyz')
+        os.close(fd)
+
+        fd, log_path = tempfile.mkstemp()
+        os.close(fd)
+
+        try:
+            with MediaServer(mode='thread', access_log=log_path) as server:
+                url_path = server.register(path)
+
+                conn = HTTPConnection('127.0.0.1', server.server_address[1])
+                conn.request('GET', url_path, headers={'Range': 'bytes=1-4'})
+                assert conn.getresponse().read() == b'bcde'
+                conn.request('GET', '/missing')
+                conn.getresponse().read()
+                conn.close()
+
+            with open(log_path) as fh:
+                ranged, missing = [json.loads(line) for line in fh]
+        finally:
+            os.remove(path)
+            os.remove(log_path)
+
+        assert ranged['client'] == '127.0.0.1'
+        assert ranged['method'] == 'GET'
+        assert ranged['path'] == url_path
+        assert ranged['range'] == 'bytes=1-4'
+        assert ranged['status'] == 206
+        assert ranged['bytes'] == 4
+        assert 0 <= ranged['ttfb'] <= ranged['duration']
+
+        assert missing['status'] == 400
+        assert missing['bytes'] == 0
+        assert missing['ttfb'] is None
+
+
+class TestReadAhead(unittest.TestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'x' * 100000)
+        os.close(fd)
+        self.testfile = path
+        self.stats = os.stat(path)
+
+        self.readahead = ReadAhead(size=10000)
+
+    def tearDown(self):
+        self.readahead.close()
+        os.remove(self.testfile)
+
+    def test_read(self):
+        """Data is read ahead on the background thread"""
+        window = self.readahead.window('a', self.testfile, self.stats, 0, 100000)
+        window.advance(4000)
+        window.advance(6000)
+
+        self.readahead.close()
+
+        stats = self.readahead.stats()
+        assert stats['scheduled'] == 2
+        assert stats['bytes'] == 16000
+        assert stats['misses'] == 1
+
+    def test_read_without_fadvise(self):
+        """Without posix_fadvise() the data is read and thrown away"""
+        with patch('airplay.readahead.advise', return_value=False):
+            assert self.readahead.read(self.testfile, 99000, 200000) == 1000
+
+    def test_hits(self):
+        """A request that starts in data already read ahead for that client is a hit"""
+        # don't start the background thread
+        with patch.object(self.readahead, '_thread', Mock()):
+            self.readahead.window('a', self.testfile, self.stats, 0, 100000).advance(5000)
+
+            # resumed inside the data we read ahead
+            self.readahead.window('a', self.testfile, self.stats, 12000, 100000)
+            # a different client, and a seek past it
+            self.readahead.window('b', self.testfile, self.stats, 12000, 100000)
+            self.readahead.window('a', self.testfile, self.stats, 50000, 100000)
+
+        stats = self.readahead.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 3
+        assert stats['clients'] == 2
+
+    def test_queue_full(self):
+        """When the background thread can't keep up, read aheads are dropped"""
+        self.readahead._queue = queue.Queue(1)
+
+        with patch.object(self.readahead, '_thread', Mock()):
+            self.readahead.window('a', self.testfile, self.stats, 0, 100000)
+            self.readahead.window('b', self.testfile, self.stats, 0, 100000)
+
+        assert self.readahead.stats()['dropped'] == 1
+
+
+class TestParseByteRanges(unittest.TestCase):
+    HEADERS = [
+        '', 'bytes=0-0', 'bytes=1-4', 'bytes=0-', 'bytes=25-', 'bytes=26-', 'bytes=-1', 'bytes=-10',
+        'bytes=-100', 'bytes=-0', 'bytes=-', 'bytes=4-1', 'bytes=10-1000', 'bytes=26-30', 'bytes=007-009',
+        'bytes=a-b', 'pages=1-2', 'foo',
+    ]
+
+    def parse(self, parser, value, size):
+        try:
+            return parser(value, size)
+        except httpheader.RangeUnsatisfiableError:
+            return 416
+        except ValueError:
+            return 400
+
+    def test_same_as_httpheader(self):
+        """The fast path returns the same results and errors as the httpheader parser"""
+        for size in (0, 1, 26):
+            for value in self.HEADERS:
+                assert self.parse(parse_byte_ranges, value, size) == self.parse(_parse_byte_ranges, value, size), \
+                    (value, size)
+
+    def test_results(self):
+        """Ranges are returned with exclusive ends, clamped to the file size"""
+        assert parse_byte_ranges('', 26) is None
+        assert parse_byte_ranges('bytes=1-4', 26) == [(1, 5)]
+        assert parse_byte_ranges('bytes=20-', 26) == [(20, 26)]
+        assert parse_byte_ranges('bytes=-5', 26) == [(21, 26)]
+        assert parse_byte_ranges('bytes=20-100', 26) == [(20, 26)]
+
+        self.assertRaises(httpheader.RangeUnsatisfiableError, parse_byte_ranges, 'bytes=30-', 26)
+        self.assertRaises(ValueError, parse_byte_ranges, 'bytes=2-1', 26)
+
+    def test_fallback(self):
+        """Multiple ranges are parsed by httpheader"""
+        with patch('airplay.http_server.httpheader.parse_range_header',
+                   side_effect=httpheader.parse_range_header) as parser:
+            assert parse_byte_ranges('bytes=1-4,9-9, -2', 26) == [(1, 5), (9, 10), (24, 26)]
+            assert parser.called
+
+            parser.reset_mock()
+            parse_byte_ranges('bytes=1-4', 26)
+            assert not parser.called
+
+
+class TestStatCache(unittest.TestCase):
+    def setUp(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'abcdefghijklmnopqrstuvwxyz')
+        os.close(fd)
+        self.testfile = path
+
+        self.cache = StatCache(ttl=60)
+
+    def tearDown(self):
+        try:
+            os.remove(self.testfile)
+        except OSError:
+            pass
+
+    def test_cached(self):
+        """The file is only stat()ed once within the ttl"""
+        stats = self.cache.stat(self.testfile)
+
+        with patch('airplay.cache.os.stat') as mock_stat:
+            assert self.cache.stat(self.testfile) is stats
+
+        assert not mock_stat.called
+
+    def test_expired(self):
+        """Once the ttl has passed the file is stat()ed again and changes are noticed"""
+        self.cache.ttl = 0
+
+        stats = self.cache.stat(self.testfile)
+        etag, last_modified = self.cache.validators(self.testfile, stats)
+
+        # unchanged files keep the same validators
+        assert self.cache.validators(self.testfile, self.cache.stat(self.testfile)) == (etag, last_modified)
+
+        with open(self.testfile, 'ab') as fh:
+            fh.write(b'more')
+
+        stats = self.cache.stat(self.testfile)
+        assert stats.st_size == 30
+        assert self.cache.validators(self.testfile, stats)[0] != etag
+
+    def test_missing(self):
+        """Files that can't be stat()ed raise and aren't cached"""
+        os.remove(self.testfile)
+
+        self.assertRaises(EnvironmentError, self.cache.stat, self.testfile)
+        assert self.testfile not in self.cache._entries
+
+
+class TestBlockCache(unittest.TestCase):
+    def setUp(self):
+        self.data = b'abcdefghijklmnopqrstuvwxyz' * 1024
+
+        fd, path = tempfile.mkstemp()
+        os.write(fd, self.data)
+        os.close(fd)
+        self.testfile = path
+
+        self.cache = BlockCache(max_bytes=4096, block_size=1024, window=2048)
+
+    def tearDown(self):
+        os.remove(self.testfile)
+
+    def read(self, block):
+        with open(self.testfile, 'rb') as fh:
+            return self.cache.read(fh, os.fstat(fh.fileno()), block)
+
+    def test_split(self):
+        """Only the start and end of the file are cacheable"""
+        size = len(self.data)
+
+        assert self.cache.split(0, size, size) == [
+            (0, 2048, True),
+            (2048, 24576, False),
+            (24576, size, True)
+        ]
+
+        assert self.cache.split(3000, 4000, size) == [(3000, 4000, False)]
+        assert self.cache.split(0, 100, 100) == [(0, 100, True)]
+
+    def test_hit_miss(self):
+        """Blocks are read from the file once, then served from memory"""
+        assert self.read(1) == self.data[1024:2048]
+        assert self.read(1) == self.data[1024:2048]
+
+        stats = self.cache.stats()
+        assert stats['misses'] == 1
+        assert stats['hits'] == 1
+        assert stats['bytes'] == 1024
+
+    def test_eviction(self):
+        """The least recently used blocks are evicted to stay within the byte budget"""
+        for block in range(4):
+            self.read(block)
+
+        # touch block 0 so block 1 is the least recently used
+        self.read(0)
+        self.read(4)
+
+        stats = self.cache.stats()
+        assert stats['evictions'] == 1
+        assert stats['bytes'] == 4096
+
+        self.read(0)
+        assert self.cache.stats()['hits'] == 2
+
+        self.read(1)
+        assert self.cache.stats()['misses'] == 6
+
+    def test_modified_file(self):
+        """Blocks of a file that has changed are not served from the cache"""
+        self.read(0)
+
+        with open(self.testfile, 'wb') as fh:
+            fh.write(b'z' * 2048)
+        os.utime(self.testfile, (0, 0))
+
+        assert self.read(0) == b'z' * 1024
+        assert self.cache.stats()['misses'] == 2
+
+    def test_clear(self):
+        """Clearing the cache drops all blocks and counters"""
+        self.read(0)
+        self.cache.clear()
+
+        assert self.cache.stats() == {
+            'hits': 0, 'misses': 0, 'evictions': 0, 'blocks': 0, 'bytes': 0, 'max_bytes': 4096
+        }
+
+
+@unittest.skipUnless(sys.version_info >= (3, 6), 'AsyncAirPlay requires python 3.6')
+class TestAsyncAirPlay(unittest.TestCase):
+    VIDEO_EVENT = FakeDevice.event('video', 'paused')
+    PHOTO_EVENT = FakeDevice.event('photo', 'paused')
+
+    def setUp(self):
+        self.device = FakeDevice()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.ap = AsyncAirPlay('127.0.0.1', self.device.port, 'test')
+        self.wait(self.ap.connect())
+
+    def tearDown(self):
+        self.wait(self.ap.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.device.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_connect_failed(self):
+        """ValueError is raised when we can't connect"""
+        self.device.close()
+        self.assertRaises(ValueError, self.wait, AsyncAirPlay('127.0.0.1', self.device.port).connect())
+
+    def test_not_connected(self):
+        """RuntimeError is raised if commands are sent before connecting"""
+        self.assertRaises(RuntimeError, self.wait, AsyncAirPlay('127.0.0.1', self.device.port).stop())
+
+    def test_commands(self):
+        """Commands are sent like AirPlay's, and their responses decoded the same way"""
+        self.device.responses = [
+            FakeDevice.OK,
+            FakeDevice.OK,
+            FakeDevice.SCRUB,
+            FakeDevice.plist({'duration': 1801.0}),
+        ]
+
+        assert self.wait(self.ap.rate(1.0)) is True
+        assert self.wait(self.ap.scrub(14.467)) == {'duration': 83.124794, 'position': 14.467}
+        assert self.wait(self.ap.playback_info()) == {'duration': 1801.0}
+
+        assert self.device.requests == [
+            b'POST /rate?value=1.0 HTTP/1.1',
+            b'POST /scrub?position=14.467 HTTP/1.1',
+            b'GET /scrub HTTP/1.1',
+            b'GET /playback-info HTTP/1.1',
+        ]
+
+    def test_properties(self):
+        """Properties are read and set with binary plists"""
+        self.device.responses = [
+            TestAirPlayControls.binary_plist({'errorCode': 0, 'value': 1}),
+            TestAirPlayControls.binary_plist({'errorCode': 0}),
+        ]
+
+        assert self.wait(self.ap.get_property('reverseEndTime')) == 1
+        assert self.wait(self.ap.set_property('reverseEndTime', 2)) is True
+
+        assert self.device.requests == [
+            b'GET /getProperty?reverseEndTime HTTP/1.1',
+            b'PUT /setProperty?reverseEndTime HTTP/1.1',
+        ]
+
+    def test_timeout(self):
+        """A command that times out closes the connection, so its late response isn't returned to the next"""
+        def slow():
+            time.sleep(.3)
+            return FakeDevice.scrub(1.0)
+
+        self.device.responses = [slow, FakeDevice.scrub(2.0), FakeDevice.scrub(3.0)]
+        self.ap.timeout = .1
+
+        self.assertRaises(asyncio.TimeoutError, self.wait, self.ap.scrub())
+        self.assertRaises(RuntimeError, self.wait, self.ap.scrub())
+
+        self.wait(self.ap.connect())
+        assert self.wait(self.ap.scrub())['position'] == 2.0
+        assert self.wait(self.ap.scrub())['position'] == 3.0
+
+    def test_concurrent(self):
+        """Commands issued at the same time each get their own response"""
+        self.device.responses = [FakeDevice.OK, FakeDevice.NOT_FOUND] * 5
+
+        results = self.wait(asyncio.gather(*[
+            self.ap.stop() for _ in range(10)
+        ]))
+
+        assert results == [True, False] * 5
+
+    def test_closed(self):
+        """ConnectionError is raised if the device closes the connection"""
+        self.device.responses = [None]
+
+        self.assertRaises(ConnectionError, self.wait, self.ap.stop())
+
+    def test_events(self):
+        """Video events are yielded from the Reverse HTTP connection, and acknowledged"""
+        self.device.events = [self.PHOTO_EVENT, self.VIDEO_EVENT, self.VIDEO_EVENT]
+
+        events = self.ap.events()
+        assert self.wait(events.__anext__())['state'] == 'paused'
+        assert self.wait(events.__anext__())['category'] == 'video'
+        self.wait(events.aclose())
+
+        assert wait_until(lambda: self.device.acks >= 2)
+
+    def test_events_upgrade_failed(self):
+        """RuntimeError is raised if the device doesn't switch protocols"""
+        self.device.upgrade = FakeDevice.NOT_FOUND
+
+        self.assertRaises(RuntimeError, self.wait, self.ap.events().__anext__())
+
+    def test_events_reconnect(self):
+        """When the event connection is lost, it's made again"""
+        self.device.events = [self.VIDEO_EVENT]
+        self.ap.backoff = 0
+
+        events = self.ap.events()
+        assert self.wait(events.__anext__())['state'] == 'paused'
+
+        # the device drops the connection, and sends the events again on the new one
+        self.device.connections[-1].shutdown(socket.SHUT_RDWR)
+        assert self.wait(events.__anext__())['state'] == 'paused'
+        self.wait(events.aclose())
+
+        # the control connection, and two event connections
+        assert len(self.device.connections) == 3
+
+    def test_events_lost(self):
+        """OSError is raised if the event connection is lost and can't be made again"""
+        self.device.events = [self.VIDEO_EVENT]
+        self.ap.backoff = 0
+        self.ap.retries = 1
+
+        events = self.ap.events()
+        assert self.wait(events.__anext__())['state'] == 'paused'
+
+        self.device.close()
+        self.device.connections[-1].shutdown(socket.SHUT_RDWR)
+        self.assertRaises(OSError, self.wait, events.__anext__())
+
+    def test_serve_not_connected(self):
+        """RuntimeError is raised if files are served before connecting"""
+        self.assertRaises(RuntimeError, self.wait, AsyncAirPlay('127.0.0.1', self.device.port).serve(__file__))
+
+    def test_serve(self):
+        """Files are served by the shared media server"""
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'hello')
+        os.close(fd)
+
+        try:
+            url = self.wait(self.ap.serve(path, mode='thread'))
+            assert urlopen(Request(url)).read() == b'hello'
+        finally:
+            MediaServer.stop_shared()
+            os.remove(path)
+
+    @patch('airplay.airplay.socket.socket')
+    @patch('airplay.airplay.ServiceBrowser', new_callable=lambda: FakeServiceBrowser)
+    @patch('airplay.airplay.Zeroconf', new_callable=lambda: FakeZeroconf)
+    def test_find(self, zc, sb, sock):
+        """Devices are discovered in an executor and connected"""
+        sb.name = 'test-device.foo.bar'
+        sb.info = zc.info = Mock(address=socket.inet_aton('127.0.0.1'), port=self.device.port)
+
+        devices = self.wait(AsyncAirPlay.find(timeout=2, fast=True))
+
+        assert len(devices) == 1
+        assert devices[0].name == 'test-device'
+        assert devices[0].port == self.device.port
+
+        self.wait(devices[0].close())
+
+
+class TestAirPlayReconnect(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.ap = AirPlay('127.0.0.1', self.device.port, backoff=0)
+
+    def tearDown(self):
+        self.device.close()
+
+    def test_replay(self):
+        """Idempotent commands are sent again on a new connection when the connection fails"""
+        self.device.responses = [None, FakeDevice.SCRUB, None, FakeDevice.OK]
+
+        assert self.ap.scrub() == {'duration': 83.124794, 'position': 14.467}
+        assert self.ap.rate(0.5) is True
+
+        assert self.device.requests == [
+            b'GET /scrub HTTP/1.1', b'GET /scrub HTTP/1.1',
+            b'POST /rate?value=0.5 HTTP/1.1', b'POST /rate?value=0.5 HTTP/1.1'
+        ]
+        assert len(self.device.connections) == 3
+
+    def test_no_replay(self):
+        """Other commands aren't sent again, but the next command reconnects"""
+        self.device.responses = [None, FakeDevice.OK]
+
+        self.assertRaises(socket.error, self.ap.play, 'http://192.0.2.114/movie.mp4')
+        assert self.ap.stop() is True
+
+        assert self.device.requests == [b'POST /play HTTP/1.1', b'POST /stop HTTP/1.1']
+
+    def test_retries(self):
+        """socket.error is raised once the command has failed `retries` times"""
+        self.device.responses = [None] * 4
+
+        self.assertRaises(socket.error, self.ap.playback_info)
+        assert len(self.device.requests) == 4
+
+    def test_idle_closed(self):
+        """A connection the device closed while it was idle is replaced before a command is sent on it"""
+        self.device.responses = [FakeDevice.OK]
+
+        assert wait_until(lambda: self.device.connections)
+        self.device.connections[0].shutdown(socket.SHUT_RDWR)
+        time.sleep(.1)
+
+        self.ap.IDLE_CHECK = 0
+        assert self.ap.play('http://192.0.2.114/movie.mp4') is True
+        assert len(self.device.connections) == 2
+
+    def test_protocol_error(self):
+        """A response that can't be parsed is raised, and the next command reconnects with a clean parser"""
+        self.device.responses = [b'garbage\r\n\r\n', FakeDevice.OK, FakeDevice.OK]
+
+        self.assertRaises(ProtocolError, self.ap.rate, 1.0)
+        assert self.ap.rate(1.0) is True
+        assert self.ap.rate(0.0) is True
+
+        assert len(self.device.connections) == 2
+
+    def test_pipeline_protocol_error(self):
+        """Responses left over from a pipeline that failed aren't returned to later commands"""
+        self.device.responses = [b'garbage\r\n\r\n', FakeDevice.SCRUB, FakeDevice.OK]
+
+        batch = self.ap.pipeline()
+        batch.rate(1.0)
+        batch.scrub()
+        self.assertRaises(ProtocolError, batch.execute)
+
+        assert self.ap.stop() is True
+        assert len(self.device.connections) == 2
+
+    def test_backoff(self):
+        """The first reconnect is immediate, then the wait doubles up to MAX_BACKOFF"""
+        self.ap.backoff = 0.5
+
+        assert [self.ap._backoff(attempt) for attempt in range(1, 10)] == [0, 0.5, 1, 2, 4, 8, 16, 30, 30]
+
+    def test_keepalive(self):
+        """TCP keepalive is turned on for the control socket, with probes after 10s idle where supported"""
+        sock = self.ap.control_socket
+
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 10
+
+
+class TestAirPlayStats(unittest.TestCase):
+    def setUp(self):
+        self.device = FakeDevice()
+        self.ap = AirPlay('127.0.0.1', self.device.port, backoff=0)
+
+    def tearDown(self):
+        self.ap.close()
+        self.device.close()
+
+    def test_commands(self):
+        """Each endpoint's latency, and errors, are counted"""
+        self.device.responses = [FakeDevice.OK, FakeDevice.OK, FakeDevice.NOT_FOUND, FakeDevice.SCRUB]
+
+        self.ap.rate(1.0)
+        self.ap.rate(0.0)
+        self.ap.stop()
+        self.ap.scrub()
+
+        stats = self.ap.stats()
+        assert stats['commands'] == 4
+        assert stats['errors'] == 1
+        assert stats['connects'] == 1
+        assert stats['reconnects'] == 0
+        assert stats['bytes_sent'] == len(b''.join(
+            build_request(*args, **kwargs) for (args, kwargs) in (
+                (('/rate', 'POST'), {'value': 1.0}),
+                (('/rate', 'POST'), {'value': 0.0}),
+                (('/stop', 'POST'), {}),
+                (('/scrub', ), {'headers': accept_headers('GET')}),
+            )
+        ))
+        assert stats['bytes_received'] == len(FakeDevice.OK * 2 + FakeDevice.NOT_FOUND + FakeDevice.SCRUB)
+
+        assert sorted(stats['endpoints']) == ['GET /scrub', 'POST /rate', 'POST /stop']
+
+        rate = stats['endpoints']['POST /rate']
+        assert rate['count'] == 2
+        assert rate['errors'] == 0
+        assert 0 < rate['min'] <= rate['mean'] <= rate['max'] <= rate['p99']
+        assert sum(rate['buckets'].values()) == 2
+
+        assert stats['endpoints']['POST /stop']['errors'] == 1
+
+    def test_reconnects(self):
+        """Reconnects, retries and commands that fail are counted"""
+        self.device.responses = [None, FakeDevice.OK, None]
+
+        self.ap.rate(1.0)
+        self.assertRaises(socket.error, self.ap.play, 'http://192.0.2.114/movie.mp4')
+
+        # play() isn't sent again, so only rate() reconnected
+        stats = self.ap.stats()
+        assert stats['connects'] == 2
+        assert stats['reconnects'] == 1
+        assert stats['retries'] == 1
+        assert stats['errors'] == 1
+        assert stats['endpoints']['POST /play']['errors'] == 1
+
+    def test_pipeline(self):
+        """Commands sent in a pipeline are counted"""
+        self.device.responses = [FakeDevice.OK, FakeDevice.SCRUB]
+
+        with self.ap.pipeline() as batch:
+            batch.rate(1.0)
+            batch.scrub()
+
+        stats = self.ap.stats()
+        assert stats['commands'] == 2
+        assert stats['endpoints']['GET /scrub']['count'] == 1
+        assert stats['bytes_received'] == len(FakeDevice.OK + FakeDevice.SCRUB)
+
+    def test_protocol_errors(self):
+        """Commands answered with something that can't be parsed are counted as errors"""
+        self.device.responses = [b'garbage\r\n\r\n', b'garbage\r\n\r\n', FakeDevice.OK]
+
+        self.assertRaises(ProtocolError, self.ap.rate, 1.0)
+
+        batch = self.ap.pipeline()
+        batch.stop()
+        batch.scrub()
+        self.assertRaises(ProtocolError, batch.execute)
+
+        stats = self.ap.stats()
+        assert stats['commands'] == 3
+        assert stats['errors'] == 3
+        assert stats['endpoints']['POST /rate']['errors'] == 1
+        assert stats['endpoints']['POST /stop']['errors'] == 1
+        assert stats['endpoints']['GET /scrub']['errors'] == 1
+
+    def test_reset(self):
+        """reset_stats() starts again from zero"""
+        self.device.responses = [FakeDevice.OK]
+        self.ap.stop()
+
+        self.ap.reset_stats()
+
+        assert self.ap.stats() == {
+            'commands': 0, 'errors': 0, 'bytes_sent': 0, 'bytes_received': 0, 'connects': 0, 'reconnects': 0,
+            'retries': 0, 'endpoints': {}
+        }
+
+
+class TestHistogram(unittest.TestCase):
+    def test_empty(self):
+        """An empty histogram has no latencies"""
+        snapshot = Histogram().snapshot()
+
+        assert snapshot['count'] == 0
+        assert snapshot['mean'] is None
+        assert snapshot['p50'] is None
+        assert snapshot['buckets'] == {}
+
+    def test_percentiles(self):
+        """Percentiles are the upper bound of the bucket they fall in"""
+        histogram = Histogram()
+        for seconds in [0.003] * 90 + [0.2] * 9 + [30.0]:
+            histogram.add(seconds)
+
+        snapshot = histogram.snapshot()
+        assert snapshot['count'] == 100
+        assert snapshot['min'] == 0.003
+        assert snapshot['max'] == 30.0
+        assert snapshot['p50'] == 0.005
+        assert snapshot['p90'] == 0.005
+        assert snapshot['p99'] == 0.25
+        assert histogram.percentile(100) == 30.0
+        assert snapshot['buckets'] == {'<=0.005': 90, '<=0.25': 9, 'inf': 1}
+
+
+class TestPlaybackState(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = patch('airplay.playback.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.ap = Mock()
+        self.ap.scrub.return_value = {'duration': 60.0, 'position': 10.0}
+        self.state = PlaybackState(self.ap, interval=5.0, tolerance=0.5)
+
+    def test_unknown(self):
+        """The position is None until it's known"""
+        assert self.state.state == 'loading'
+        assert self.state.position is None
+
+    def test_predict(self):
+        """The position is extrapolated from the rate and the time since it was known"""
+        self.state.update({'state': 'playing', 'position': 10.0, 'duration': 60.0})
+
+        self.now += 2.5
+        assert self.state.position == 12.5
+
+        # it doesn't go past the end
+        self.now += 100
+        assert self.state.position == 60.0
+
+    def test_params(self):
+        """The position, duration and rate are read from the params of playing events"""
+        self.state.update({'state': 'playing', 'params': {'position': 10.0, 'duration': 60.0, 'rate': 1.0}})
+
+        self.now += 1
+        assert self.state.position == 11.0
+        assert self.state.duration == 60.0
+
+    def test_playback_event(self):
+        """PlaybackEvents are read through their attributes"""
+        self.state.update(PlaybackEvent.from_plist(
+            {'state': 'playing', 'params': {'position': 10.0, 'duration': 60.0, 'rate': 2.0}}
+        ))
+
+        self.now += 1
+        assert self.state.position == 12.0
+        assert self.state.duration == 60.0
+
+    def test_paused(self):
+        """The position doesn't move when paused"""
+        self.state.update({'state': 'playing', 'position': 10.0, 'duration': 60.0})
+        self.now += 2
+
+        self.state.update({'state': 'paused'})
+        assert self.state.rate == 0.0
+
+        self.now += 10
+        assert self.state.position == 12.0
+
+        self.state.update({'state': 'playing', 'rate': 2.0})
+        self.now += 1
+        assert self.state.position == 14.0
+
+    def test_refresh_interval(self):
+        """refresh() only asks the device once every interval"""
+        assert self.state.refresh() is True
+        assert self.state.position == 10.0
+        assert self.state.duration == 60.0
+
+        self.now += 1
+        assert self.state.refresh() is False
+        assert self.state.refresh(force=True) is True
+
+        assert self.ap.scrub.call_count == 2
+
+    def test_refresh_tolerance(self):
+        """The prediction is only corrected when it's out by more than tolerance"""
+        self.state.update({'state': 'playing', 'position': 10.0, 'duration': 60.0})
+        self.now += 5
+
+        self.ap.scrub.return_value = {'duration': 60.0, 'position': 15.2}
+        self.state.refresh()
+        assert round(self.state.drift, 3) == 0.2
+        assert self.state.position == 15.0
+
+        self.now += 5
+        self.ap.scrub.return_value = {'duration': 60.0, 'position': 21.0}
+        self.state.refresh()
+        assert round(self.state.drift, 3) == 1.0
+        assert self.state.position == 21.0
+
+    def test_seek(self):
+        """seek() predicts the new position without reading it back"""
+        self.ap._command.return_value = True
+        self.state.update({'state': 'playing', 'position': 10.0, 'duration': 60.0})
+
+        assert self.state.seek(30.0) is True
+        self.ap._command.assert_called_once_with('/scrub', 'POST', position=30.0)
+        assert not self.ap.scrub.called
+
+        self.now += 1
+        assert self.state.position == 31.0
+
+
+class TestDeviceGroup(unittest.TestCase):
+    def setUp(self):
+        self.fakes = [FakeDevice(delay=.2) for _ in range(4)]
+        self.group = DeviceGroup([AirPlay('127.0.0.1', fake.port, str(ii)) for (ii, fake) in enumerate(self.fakes)])
+
+    def tearDown(self):
+        self.group.close()
+        for fake in self.fakes:
+            fake.close()
+
+    def test_concurrent(self):
+        """Commands are sent to every device at once, and results returned in order"""
+        for fake in self.fakes:
+            fake.responses = [FakeDevice.OK]
+        self.fakes[1].responses = [FakeDevice.NOT_FOUND]
+
+        start = time.time()
+        results = self.group.play('http://192.0.2.114/wall.mp4', 0.5)
+        assert time.time() - start < .6
+
+        assert [result.device for result in results] == self.group.devices
+        assert [result.value for result in results] == [True, False, True, True]
+        assert all(result.ok and result.latency >= .2 for result in results)
+
+        for fake in self.fakes:
+            assert fake.requests == [b'POST /play HTTP/1.1']
+
+    def test_error(self):
+        """An error on one device is returned in its result, and doesn't affect the others"""
+        for fake in self.fakes:
+            fake.responses = [FakeDevice.SCRUB]
+        self.fakes[2].responses = [None]
+        self.group.devices[2].retries = 0
+
+        results = self.group.scrub()
+
+        assert [result.ok for result in results] == [True, True, False, True]
+        assert isinstance(results[2].error, socket.error)
+        assert results[0].value == {'duration': 83.124794, 'position': 14.467}
+
+    def test_order(self):
+        """Commands are run on each device in the order they were sent"""
+        for fake in self.fakes:
+            fake.delay = 0
+            fake.responses = [FakeDevice.OK, FakeDevice.OK]
+
+        self.group.rate(0)
+        self.group.stop()
+
+        for fake in self.fakes:
+            assert fake.requests == [b'POST /rate?value=0.0 HTTP/1.1', b'POST /stop HTTP/1.1']
+
+    def test_call_at(self):
+        """call_at() starts the command on each device at its own time"""
+        for fake in self.fakes:
+            fake.delay = 0
+            fake.responses = [FakeDevice.OK]
+
+        now = monotonic()
+        times = [now + .2, now + .1, None, now + .3]
+        results = self.group.call_at(times, 'stop')
+
+        assert results[2].started < now + .1
+        for (result, at) in zip(results, times):
+            assert result.ok
+            if at is not None:
+                assert result.started >= at
+
+        self.assertRaises(ValueError, self.group.call_at, times[:2], 'stop')
+
+    def test_closed(self):
+        """RuntimeError is raised once the group is closed"""
+        self.group.close()
+
+        self.assertRaises(RuntimeError, self.group.stop)
+
+
+class TestSyncedPlayback(unittest.TestCase):
+    def setUp(self):
+        self.fakes = [FakeDevice(delay=delay) for delay in (0.02, 0.2, 0.1)]
+        self.group = DeviceGroup([AirPlay('127.0.0.1', fake.port) for fake in self.fakes])
+        self.sync = SyncedPlayback(self.group)
+
+    def tearDown(self):
+        self.group.close()
+        for fake in self.fakes:
+            fake.close()
+
+    def test_measure(self):
+        """The one way latency is half the median round trip"""
+        for fake in self.fakes:
+            fake.responses = [FakeDevice.SCRUB] * 3
+
+        latency = self.sync.measure(3)
+
+        for (one_way, fake) in zip(latency, self.fakes):
+            assert fake.delay / 2 <= one_way < fake.delay / 2 + .05
+
+    def test_start(self):
+        """rate(1.0) is sent early by each device's latency, so it arrives at all of them at the target time"""
+        for fake in self.fakes:
+            fake.delay = 0
+            fake.responses = [FakeDevice.OK] * 3 + [FakeDevice.plist({'readyToPlay': True}), FakeDevice.OK]
+        self.sync.latency = [0.01, 0.1, 0.05]
+
+        at, target = time.time() + 0.5, monotonic() + 0.5
+        with patch.object(self.group, 'call_at', wraps=self.group.call_at) as call_at:
+            results = self.sync.start('http://192.0.2.114/wall.mp4', 12.5, at=at)
+        assert all(result.ok for result in results)
+
+        for fake in self.fakes:
+            assert fake.requests == [
+                b'POST /play HTTP/1.1',
+                b'POST /rate?value=0.0 HTTP/1.1',
+                b'POST /scrub?position=12.5 HTTP/1.1',
+                b'GET /playback-info HTTP/1.1',
+                b'POST /rate?value=1.0 HTTP/1.1'
+            ]
+
+        times, method = call_at.call_args[0][:2]
+        assert method == 'rate'
+        for (at, latency) in zip(times, self.sync.latency):
+            assert abs(at - (target - latency)) < .01
+
+    def test_start_failed(self):
+        """RuntimeError is raised if a device can't load the url"""
+        for fake in self.fakes:
+            fake.responses = [FakeDevice.OK] * 3
+        self.fakes[2].responses = [None]
+
+        self.assertRaises(RuntimeError, self.sync.start, 'http://192.0.2.114/wall.mp4')
+
+    def test_wait_ready(self):
+        """wait_ready() polls until every device is ready"""
+        for fake in self.fakes:
+            fake.delay = 0
+            fake.responses = [FakeDevice.plist({'readyToPlay': True})] * 2
+        self.fakes[1].responses = [FakeDevice.plist({'readyToPlay': False}), FakeDevice.plist({'readyToPlay': True})]
+
+        assert self.sync.wait_ready(interval=0.01) is True
+        assert len(self.fakes[0].requests) == 2
+
+        for fake in self.fakes:
+            fake.responses = [FakeDevice.plist({'readyToPlay': True})] * 2
+        self.fakes[1].responses = [FakeDevice.OK] * 2
+        assert self.sync.wait_ready(timeout=0.015, interval=0.01) is False
+
+    def test_correct(self):
+        """Devices that drift are seeked to where the rest of the group is"""
+        start = monotonic()
+
+        def playing(offset):
+            return lambda: FakeDevice.scrub(10 + offset + monotonic() - start)
+
+        for (fake, offset) in zip(self.fakes, (0.0, 0.02, 1.0)):
+            fake.responses = [playing(offset), FakeDevice.OK]
+        self.sync.latency = [0.01, 0.1, 0.05]
+
+        drift = self.sync.correct(tolerance=0.3)
+
+        assert abs(drift[0]) < .1
+        assert abs(drift[1]) < .1
+        assert abs(drift[2] - 1) < .1
+        assert len(self.fakes[0].requests) == 1
+        assert len(self.fakes[1].requests) == 1
+
+        # it was seeked to where the others would be when the request arrived
+        seek = self.fakes[2].requests[1]
+        assert seek.startswith(b'POST /scrub?position=')
+        position = float(seek.split(b'=')[1].split(b' ')[0])
+        assert abs(position - (10 + self.fakes[2].times[1] - start)) < .1
+
+    def test_drift(self):
+        """Devices that don't answer have no drift"""
+        for fake in self.fakes:
+            fake.delay = 0
+            fake.responses = [FakeDevice.scrub(20)]
+        self.fakes[0].responses = [FakeDevice.NOT_FOUND]
+
+        assert self.sync.drift()[0] is None
+
+
+class FakeZeroconf(object):
+    def __init__(self, info=None):
+        self.info = info
+
+    def get_service_info(self, *args, **kwargs):
+        return self.info
+
+    def close(self):
+        pass
+
+
+class FakeServiceBrowser(object):
+    name = 'fake-service.local'
+    info = None
+
+    def __init__(self, *args, **kwargs):
+        self.handler = kwargs.get('handlers')[0]
+        self.handler(FakeZeroconf(self.info), args[1], self.name, ServiceStateChange.Added)
+
+
+class MockSocket(object):
+    sock = None
+    timeout = None
+    error = socket.error
+    AF_INET = socket.AF_INET
+    SOCK_STREAM = socket.SOCK_STREAM
+    SOL_SOCKET = socket.SOL_SOCKET
+    SO_KEEPALIVE = socket.SO_KEEPALIVE
+    IPPROTO_TCP = socket.IPPROTO_TCP
+    TCP_KEEPIDLE = getattr(socket, 'TCP_KEEPIDLE', None)
+    TCP_KEEPINTVL = getattr(socket, 'TCP_KEEPINTVL', None)
+    TCP_KEEPCNT = getattr(socket, 'TCP_KEEPCNT', None)
+    MSG_PEEK = socket.MSG_PEEK
+
+    def __init__(self, *args, **kwargs):
+        self.send_data = ''
+        self.recv_data = ''
+        self.options = {}
+
+    def setsockopt(self, level, option, value):
+        self.options[(level, option)] = value
+
+    def recv(self, size=None, flags=0):
+        try:
+            basestring
+        except NameError:
+            basestring = str
+
+        if isinstance(self.recv_data, basestring):
+            data = self.recv_data
+        elif flags & socket.MSG_PEEK:
+            data = self.recv_data[0] if self.recv_data else ''
+        else:
+            try:
+                data = self.recv_data.pop(0)
+            except IndexError:
+                raise socket.timeout
+
+        try:
+            return bytes(data, 'UTF-8')
         except TypeError:
             return data
 
     def send(self, data, **kwargs):
         self.send_data = data
 
+    def sendall(self, data, **kwargs):
+        self.send_data = data
+
     def connect(self, *args, **kwargs):
         pass
 
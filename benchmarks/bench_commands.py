@@ -0,0 +1,155 @@
+"""Measure how many control commands per second AirPlay can send to a device
+
+A fake AirPlay device on localhost answers /scrub, /rate and /playback-info the
+way a real one does.  Each command is timed with the buffered ResponseParser
+used by AirPlay._command(), and with the previous single recv() +
+HTTPResponse(FakeSocket()) approach, which can't read responses larger than
+one recv() (the large /playback-info below).  A sweep of commands is also
+timed sent one at a time and with AirPlay.pipeline().  Use --rtt to simulate
+the network latency to a real device.
+
+    $ python benchmarks/bench_commands.py --commands 5000 --rtt 2
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    from httplib import HTTPResponse
+except ImportError:
+    from http.client import HTTPResponse
+
+try:
+    from plistlib import writePlistToString as plist_dumps
+except ImportError:
+    from plistlib import dumps as plist_dumps
+
+try:
+    import SocketServer
+except ImportError:
+    import socketserver as SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from airplay import AirPlay  # NOQA
+from airplay.airplay import FakeSocket  # NOQA
+
+
+def response(content_type=None, body=b''):
+    head = 'HTTP/1.1 200 OK\r\nContent-Length: {0}\r\n'.format(len(body))
+    if content_type:
+        head += 'Content-Type: {0}\r\n'.format(content_type)
+    return (head + '\r\n').encode('ascii') + body
+
+
+RESPONSES = {
+    b'GET /scrub': response('text/parameters', b'duration: 83.124794\r\nposition: 14.467000'),
+    b'POST /rate': response(),
+    b'GET /playback-info': response('text/x-apple-plist+xml', plist_dumps({
+        'duration': 1801.0,
+        'position': 14.4,
+        'rate': 1.0,
+        'loadedTimeRanges': [{'start': float(ii), 'duration': 1.0} for ii in range(250)],
+        'seekableTimeRanges': [{'start': 0.0, 'duration': 1801.0}],
+    })),
+}
+
+
+class FakeDevice(SocketServer.BaseRequestHandler):
+    # seconds to wait before answering what was received, to simulate a network round trip
+    rtt = 0
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        buf = b''
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buf += data
+
+            if self.rtt:
+                time.sleep(self.rtt)
+
+            while b'\r\n\r\n' in buf:
+                head, buf = buf.split(b'\r\n\r\n', 1)
+                request_line = head.split(b'\r\n', 1)[0]
+                method, uri, _ = request_line.split(b' ')
+                self.request.sendall(RESPONSES[method + b' ' + uri.split(b'?')[0]])
+
+
+def legacy_command(ap, uri, method='GET'):
+    """What AirPlay._command() used to do: one recv() parsed by HTTPResponse"""
+    ap.control_socket.send('{0} {1} HTTP/1.1\r\nContent-Length: 0\r\n\r\n'.format(method, uri).encode('ascii'))
+
+    resp = HTTPResponse(FakeSocket(ap.control_socket.recv(8192)))
+    resp.begin()
+    return resp.read()
+
+
+def sweep(ap):
+    for _ in range(4):
+        ap.rate(1.0)
+        ap.scrub()
+
+
+def pipelined_sweep(ap):
+    with ap.pipeline() as batch:
+        for _ in range(4):
+            batch.rate(1.0)
+            batch.scrub()
+
+
+def run(label, command, count):
+    start = time.time()
+    for _ in range(count):
+        command()
+    elapsed = time.time() - start
+
+    print('{0:<40} {1:>12.0f}'.format(label, count / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commands', type=int, default=5000, help='Commands to send per test')
+    parser.add_argument('--rtt', type=float, default=0, help='Simulated network round trip in ms')
+    args = parser.parse_args()
+
+    FakeDevice.rtt = args.rtt / 1000.0
+
+    SocketServer.ThreadingTCPServer.allow_reuse_address = True
+    server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0), FakeDevice)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    host, port = server.server_address
+
+    ap = AirPlay(host, port)
+    ap.control_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    legacy = AirPlay(host, port)
+    legacy.control_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    print('{0:<40} {1:>12}'.format('command', 'calls/s'))
+    try:
+        run('scrub() single recv', lambda: legacy_command(legacy, '/scrub'), args.commands)
+        run('scrub() ResponseParser', ap.scrub, args.commands)
+        run('rate() single recv', lambda: legacy_command(legacy, '/rate?value=1.0', 'POST'), args.commands)
+        run('rate() ResponseParser', lambda: ap.rate(1.0), args.commands)
+        run('playback_info() ResponseParser', ap.playback_info, args.commands)
+        run('rate() + scrub() x4 sequential', lambda: sweep(ap), args.commands // 8)
+        run('rate() + scrub() x4 pipelined', lambda: pipelined_sweep(ap), args.commands // 8)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Measure the memory each event and playback_info() result takes as a dict vs. PlaybackEvent and PlaybackInfo
+
+Each plist is decoded `--number` times and kept, the way a history buffer
+would, and the memory allocated while doing so is measured with tracemalloc.
+
+    $ python benchmarks/bench_event_memory.py --number 100000
+"""
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+try:
+    from plistlib import writePlistToString as plist_dumps
+    from plistlib import readPlistFromString as plist_loads
+except ImportError:
+    from plistlib import dumps as plist_dumps
+    from plistlib import loads as plist_loads
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from airplay.models import PlaybackEvent, PlaybackInfo  # NOQA
+
+PARAMS = {
+    'duration': 1801.0,
+    'position': 14.4,
+    'rate': 1.0,
+    'readyToPlay': 1,
+    'playbackLikelyToKeepUp': True,
+    'playbackBufferEmpty': False,
+    'playbackBufferFull': False,
+    'loadedTimeRanges': [{'start': 0.0, 'duration': 60.0}],
+    'seekableTimeRanges': [{'start': 0.0, 'duration': 1801.0}],
+}
+
+PLISTS = (
+    ('paused event', PlaybackEvent, {'category': 'video', 'state': 'paused', 'sessionID': 13}),
+    ('playing event', PlaybackEvent, {'category': 'video', 'state': 'playing', 'sessionID': 13, 'params': PARAMS}),
+    ('playback_info()', PlaybackInfo, PARAMS),
+)
+
+
+def measure(func, body, number):
+    """Returns the bytes allocated per item to keep `number` results of func(body)"""
+    gc.collect()
+    tracemalloc.start()
+
+    kept = [func(body) for _ in range(number)]
+
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+
+    return size / float(number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000, help='Plists to decode and keep per measurement')
+    args = parser.parse_args()
+
+    print('{0:<18} {1:>12} {2:>12} {3:>9}'.format('plist', 'dict bytes', 'typed bytes', 'saving'))
+    for (label, cls, plist) in PLISTS:
+        body = plist_dumps(plist)
+
+        as_dict = measure(plist_loads, body, args.number)
+        typed = measure(lambda body: cls.from_plist(plist_loads(body)), body, args.number)
+
+        print('{0:<18} {1:>12.0f} {2:>12.0f} {3:>8.0f}%'.format(
+            label, as_dict, typed, (1 - typed / as_dict) * 100
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Measure how many events per second can be received from a device over Reverse HTTP
+
+Events are parsed with the incremental EventParser, fed one event at a
+time, in 64KB reads holding many events, and in 1448 byte (one TCP segment)
+pieces, and with the previous approach of building an AirPlayEvent request
+handler around each recv(), which only works when a read holds exactly one
+event.  Then a fake device on localhost sends a burst of events through
+AirPlay.events().
+
+    $ python benchmarks/bench_events.py --events 20000
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    from plistlib import writePlistToString as plist_dumps
+except ImportError:
+    from plistlib import dumps as plist_dumps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from airplay import AirPlay  # NOQA
+from airplay.airplay import AirPlayEvent, FakeSocket  # NOQA
+from airplay.protocol import EventParser  # NOQA
+
+
+def event(state):
+    """A video event like the ones sent while playing"""
+    body = plist_dumps({
+        'category': 'video',
+        'sessionID': 13,
+        'state': state,
+        'params': {
+            'duration': 1801.0,
+            'position': 14.4,
+            'rate': 1.0,
+            'readyToPlay': 1,
+            'playbackLikelyToKeepUp': True,
+            'loadedTimeRanges': [{'start': 0.0, 'duration': 60.0}],
+            'seekableTimeRanges': [{'start': 0.0, 'duration': 1801.0}],
+        }
+    })
+
+    head = 'POST /event HTTP/1.1\r\nContent-Type: text/x-apple-plist+xml\r\nContent-Length: {0}\r\n\r\n'
+
+    return head.format(len(body)).encode('ascii') + body
+
+
+def chunks(data, size):
+    return [data[ii:ii + size] for ii in range(0, len(data), size)]
+
+
+class QuietEvent(AirPlayEvent):
+    def log_message(self, *args):
+        pass
+
+
+def legacy(reads):
+    received = 0
+    for data in reads:
+        try:
+            QuietEvent(FakeSocket(data), ('192.0.2.23', 7000), None).event
+            received += 1
+        except Exception:
+            pass
+
+    return received
+
+
+def incremental(reads):
+    parser = EventParser()
+
+    received = 0
+    for data in reads:
+        received += len(parser.feed(data))
+
+    return received
+
+
+def run(label, func, reads, count):
+    start = time.time()
+    received = func(reads)
+    elapsed = time.time() - start
+
+    print('{0:<44} {1:>12.0f} {2:>10}'.format(label, count / elapsed, '{0}/{1}'.format(received, count)))
+
+
+class FakeDevice(object):
+    """Accepts the control connection and the upgrade, then sends `count` events as fast as it can"""
+
+    def __init__(self, count):
+        self.count = count
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        request = conn.recv(65536)
+        if not request.startswith(b'POST /reverse'):
+            return
+
+        conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\nContent-Length: 0\r\n\r\n')
+
+        # read the acknowledgements so the connection doesn't back up
+        reader = threading.Thread(target=self.drain, args=(conn,))
+        reader.daemon = True
+        reader.start()
+
+        data = event('playing')
+        for _ in range(self.count):
+            conn.sendall(data)
+
+    def drain(self, conn):
+        while conn.recv(65536):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=20000, help='Events to receive per test')
+    args = parser.parse_args()
+
+    data = event('playing')
+    stream = data * args.events
+
+    print('{0:<44} {1:>12} {2:>10}'.format('test', 'events/s', 'received'))
+
+    run('AirPlayEvent, one event per read', legacy, [data] * args.events, args.events)
+    run('AirPlayEvent, 64KB reads', legacy, chunks(stream, 65536), args.events)
+    run('EventParser, one event per read', incremental, [data] * args.events, args.events)
+    run('EventParser, 64KB reads', incremental, chunks(stream, 65536), args.events)
+    run('EventParser, 1448 byte reads', incremental, chunks(stream, 1448), args.events)
+
+    device = FakeDevice(args.events)
+    ap = AirPlay('127.0.0.1', device.port)
+
+    start = time.time()
+    received = 0
+    for _ in ap.events():
+        received += 1
+        if received == args.events:
+            break
+    elapsed = time.time() - start
+    ap.close()
+
+    print('{0:<44} {1:>12.0f} {2:>10}'.format(
+        'AirPlay.events() over localhost', args.events / elapsed, '{0}/{1}'.format(received, args.events)
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""Compare the fast Range header parser against the vendored httpheader parser
+
+    $ python benchmarks/bench_range_parser.py --number 100000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from airplay.http_server import parse_byte_ranges, _parse_byte_ranges  # NOQA
+
+
+HEADERS = ('bytes=0-1', 'bytes=1048576-', 'bytes=-65536', 'bytes=0-1,1048576-')
+SIZE = 4 * 1024 * 1024 * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000, help='Headers to parse per measurement')
+    args = parser.parse_args()
+
+    print('{0:<22} {1:>14} {2:>14} {3:>9}'.format('header', 'httpheader us', 'fast path us', 'speedup'))
+    for header in HEADERS:
+        results = []
+        for func in (_parse_byte_ranges, parse_byte_ranges):
+            seconds = min(timeit.repeat(lambda: func(header, SIZE), number=args.number, repeat=3))
+            results.append(seconds / args.number * 1000000)
+
+        print('{0:<22} {1:>14.2f} {2:>14.2f} {3:>8.1f}x'.format(
+            header, results[0], results[1], results[0] / results[1]
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Measure seek-to-first-byte latency of RangeHTTPServer
+
+A "seek" is simulated by several clients issuing overlapping range requests
+at the same time, the way an AirPlay device probes a file after a seek.
+Latency is measured from sending the request to receiving the first byte of
+the body, with the single-connection server and the threaded keep-alive server.
+
+    $ python benchmarks/bench_seek_latency.py --parallel 4 --seeks 20
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from airplay.media_server import MediaServer  # NOQA
+
+
+class Client(object):
+    def __init__(self, address, url_path):
+        self.address = address
+        self.path = url_path
+        self.sock = None
+
+    def get(self, first, last):
+        """Fetch a range and return the seconds until the first body byte arrived"""
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address)
+
+        start = time.time()
+        self.sock.sendall(
+            'GET {0} HTTP/1.1\r\nHost: bench\r\nRange: bytes={1}-{2}\r\n\r\n'.format(
+                self.path, first, last
+            ).encode('ascii')
+        )
+
+        data = b''
+        while b'\r\n\r\n' not in data:
+            data += self.sock.recv(65536)
+
+        head, body = data.split(b'\r\n\r\n', 1)
+        headers = dict(
+            line.split(': ', 1) for line in head.decode('ascii').split('\r\n')[1:]
+        )
+
+        while not body:
+            body = self.sock.recv(65536)
+        ttfb = time.time() - start
+
+        remaining = int(headers['Content-Length']) - len(body)
+        while remaining > 0:
+            remaining -= len(self.sock.recv(min(remaining, 1024 * 1024)))
+
+        if head.startswith(b'HTTP/1.0') or headers.get('Connection') == 'close':
+            self.sock.close()
+            self.sock = None
+
+        return ttfb
+
+
+def run(path, size, parallel, seeks, span, max_connections, keep_alive_timeout):
+    server = MediaServer(max_connections=max_connections, keep_alive_timeout=keep_alive_timeout)
+    server.start()
+
+    address = ('127.0.0.1', server.server_address[1])
+    url_path = server.register(path)
+
+    clients = [Client(address, url_path) for _ in range(parallel)]
+    latencies = []
+
+    def probe(client, first):
+        latencies.append(client.get(first, min(first + span, size) - 1))
+
+    try:
+        for _ in range(seeks):
+            position = random.randrange(0, size - span)
+            threads = [
+                threading.Thread(target=probe, args=(client, position + ii * span // 2))
+                for ii, client in enumerate(clients)
+            ]
+            for tt in threads:
+                tt.start()
+            for tt in threads:
+                tt.join()
+    finally:
+        server.stop()
+
+    latencies.sort()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=256, help='Size of the test file in MiB')
+    parser.add_argument('--parallel', type=int, default=4, help='Overlapping range requests per seek')
+    parser.add_argument('--seeks', type=int, default=20, help='Number of seeks to simulate')
+    parser.add_argument('--span', type=int, default=8, help='Size of each range request in MiB')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.mp4')
+    chunk = os.urandom(1024 * 1024)
+    for _ in range(args.size):
+        os.write(fd, chunk)
+    os.close(fd)
+
+    size = args.size * 1024 * 1024
+    span = min(args.span * 1024 * 1024, size // 2)
+
+    try:
+        print('{0:<28} {1:>10} {2:>10} {3:>10}'.format('server', 'p50 ms', 'p90 ms', 'max ms'))
+        for label, max_connections, keep_alive_timeout in (
+            ('single connection', None, None),
+            ('threaded + keep-alive', 16, 15),
+        ):
+            latencies = run(path, size, args.parallel, args.seeks, span, max_connections, keep_alive_timeout)
+            print('{0:<28} {1:>10.2f} {2:>10.2f} {3:>10.2f}'.format(
+                label,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * .9)] * 1000,
+                latencies[-1] * 1000
+            ))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Compare os.sendfile() against the read()/write() loop in RangeHTTPServer
+
+Serves a temporary file to a local client and reports throughput and the
+CPU time used by the server process for full and partial (206) responses.
+
+    $ python benchmarks/bench_sendfile.py --size 512 --requests 3
+"""
+import argparse
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from airplay.http_server import RangeHTTPServer  # NOQA
+
+
+def serve(path, use_sendfile, requests, queue):
+    class Handler(RangeHTTPServer):
+        def log_message(self, *args, **kwargs):
+            pass
+
+    Handler.use_sendfile = use_sendfile
+
+    httpd = Handler.create(('127.0.0.1', 0), max_connections=None, cache_bytes=None)
+
+    queue.put((httpd.server_address, httpd.catalog.add(path)))
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    for _ in range(requests):
+        httpd.handle_request()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+
+    queue.put((after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime))
+
+
+def fetch(address, url_path, byte_range=None):
+    sock = socket.create_connection(address)
+    request = 'GET {0} HTTP/1.0\r\n'.format(url_path)
+    if byte_range:
+        request += 'Range: bytes={0}-{1}\r\n'.format(*byte_range)
+    sock.sendall((request + '\r\n').encode('ascii'))
+
+    buf = bytearray(1024 * 1024)
+    received = 0
+    while True:
+        read = sock.recv_into(buf)
+        if not read:
+            break
+        received += read
+
+    sock.close()
+    return received
+
+
+def run(path, use_sendfile, requests, byte_range=None):
+    queue = Queue()
+    server = Process(target=serve, args=(path, use_sendfile, requests, queue))
+    server.start()
+    address, url_path = queue.get(True)
+
+    received = 0
+    start = time.time()
+    for _ in range(requests):
+        received += fetch(address, url_path, byte_range)
+    elapsed = time.time() - start
+
+    cpu = queue.get(True)
+    server.join()
+
+    return received, elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=256, help='Size of the test file in MiB')
+    parser.add_argument('--requests', type=int, default=3, help='Requests per mode')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.mp4')
+    chunk = os.urandom(1024 * 1024)
+    for _ in range(args.size):
+        os.write(fd, chunk)
+    os.close(fd)
+
+    size = args.size * 1024 * 1024
+    partial = (size // 4, size - size // 4 - 1)
+
+    try:
+        print('{0:<10} {1:<10} {2:>12} {3:>14}'.format('response', 'mode', 'MiB/s', 'server CPU s'))
+        for label, byte_range in (('200 full', None), ('206 range', partial)):
+            for mode, use_sendfile in (('read/write', False), ('sendfile', True)):
+                received, elapsed, cpu = run(path, use_sendfile, args.requests, byte_range)
+                print('{0:<10} {1:<10} {2:>12.1f} {3:>14.3f}'.format(
+                    label, mode, received / elapsed / 1024 / 1024, cpu
+                ))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
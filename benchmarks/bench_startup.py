@@ -0,0 +1,67 @@
+"""Measure how long it takes the media server to start serving a file
+
+For each server mode, reports the time from starting the server until
+serve() returns a URL, and until the first byte of the file is received.
+
+    $ python benchmarks/bench_startup.py --runs 20
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from airplay.media_server import MediaServer  # NOQA
+
+
+def first_byte(address, url_path):
+    sock = socket.create_connection(address)
+    sock.sendall('GET {0} HTTP/1.0\r\nRange: bytes=0-0\r\n\r\n'.format(url_path).encode('ascii'))
+
+    data = b''
+    while b'\r\n\r\n' not in data or data.endswith(b'\r\n\r\n'):
+        data += sock.recv(4096)
+
+    sock.close()
+
+
+def run(path, mode):
+    start = time.time()
+
+    server = MediaServer(mode=mode)
+    server.start()
+    url_path = server.register(path)
+    registered = time.time() - start
+
+    first_byte(('127.0.0.1', server.server_address[1]), url_path)
+    received = time.time() - start
+
+    server.stop()
+
+    return registered, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help='Number of times to start each server')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.mp4')
+    os.write(fd, os.urandom(1024 * 1024))
+    os.close(fd)
+
+    try:
+        print('{0:<10} {1:>16} {2:>16}'.format('mode', 'url ready ms', 'first byte ms'))
+        for mode in MediaServer.MODES:
+            results = sorted(run(path, mode) for _ in range(args.runs))
+            registered, received = results[len(results) // 2]
+            print('{0:<10} {1:>16.2f} {2:>16.2f}'.format(mode, registered * 1000, received * 1000))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,7 @@ setup(
     install_requires=[
         'zeroconf',
         'click',
+        'selectors34; python_version < "3.4"',
     ],
 
     tests_require=[